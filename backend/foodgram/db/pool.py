@@ -0,0 +1,211 @@
+import atexit
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from django.db.utils import OperationalError
+
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                5.0, 10.0)
+EVENTS = ('opened', 'reused', 'closed', 'ping_failed', 'timeout')
+
+_pools = {}
+_pools_lock = threading.Lock()
+# Соединения, унаследованные дочерним процессом после fork. Закрывать их
+# нельзя (сокет общий с родителем), а сборщик мусора закрыл бы их сам.
+_inherited = []
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+class ConnectionPool:
+    """
+    Пул соединений с БД одного процесса, общий для всех потоков: не больше
+    max_size открытых соединений, поток без свободного соединения ждёт до
+    timeout секунд. Перед выдачей соединение старше max_age секунд
+    закрывается, а остальные при pre_ping проверяются функцией ping. При
+    возврате reset сбрасывает состояние сессии; соединение, на котором она
+    упала, закрывается.
+    """
+
+    def __init__(self, max_size, timeout=10, max_age=None, pre_ping=True,
+                 ping=None, reset=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.pre_ping = pre_ping
+        self.ping = ping
+        self.reset = reset
+        self._condition = threading.Condition()
+        # Стек (соединение, время открытия, поколение): сверху самые
+        # недавно использованные, снизу те, что дольше всех простаивают.
+        self._idle = []
+        self._in_use = {}
+        self.generation = 0
+        self.counters = dict.fromkeys(EVENTS, 0)
+        # [счётчики корзин..., +Inf, сумма], как в recipes.metrics.Histogram.
+        self.waits = [0] * (len(WAIT_BUCKETS) + 1) + [0]
+
+    @property
+    def size(self):
+        return len(self._idle) + len(self._in_use)
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def acquire(self, connect):
+        """
+        Соединение из пула или новое, открытое функцией connect. Вернуть
+        его нужно через release().
+        """
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._condition:
+            while not self._idle and self.size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters['timeout'] += 1
+                    raise PoolTimeout(
+                        f'Нет свободного соединения с БД за {self.timeout} с '
+                        f'(в пуле {self.max_size}).')
+                self._condition.wait(remaining)
+            self._observe_wait(time.monotonic() - started)
+            # Пока соединение проверяется или открывается, место в пуле
+            # за ним уже занято.
+            entry = self._idle.pop() if self._idle else None
+            token = object()
+            self._in_use[token] = None
+        try:
+            if entry is not None and self._is_usable(entry):
+                self._count('reused')
+                connection, created, _ = entry
+            else:
+                if entry is not None:
+                    self._close(entry[0])
+                connection, created = connect(), time.monotonic()
+                self._count('opened')
+        except BaseException:
+            with self._condition:
+                del self._in_use[token]
+                self._condition.notify()
+            raise
+        with self._condition:
+            del self._in_use[token]
+            self._in_use[id(connection)] = (created, self.generation)
+        return connection
+
+    def release(self, connection):
+        """Возвращает соединение в пул или закрывает его."""
+        with self._condition:
+            created, generation = self._in_use.pop(id(connection))
+        keep = (generation == self.generation
+                and not self._is_expired(created) and self._reset(connection))
+        if not keep:
+            self._close(connection)
+        with self._condition:
+            if keep and generation == self.generation:
+                self._idle.append((connection, created, generation))
+            elif keep:
+                # Пул закрыли, пока соединение сбрасывалось.
+                self._close(connection)
+            self._condition.notify()
+
+    def close(self):
+        """
+        Закрывает свободные соединения. Занятые закроются при возврате:
+        их поколение уже не совпадёт с поколением пула.
+        """
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self.generation += 1
+            self._condition.notify_all()
+        for connection, _, _ in idle:
+            self._close(connection)
+
+    def _observe_wait(self, value):
+        self.waits[bisect_left(WAIT_BUCKETS, value)] += 1
+        self.waits[-1] += value
+
+    def _count(self, event):
+        with self._condition:
+            self.counters[event] += 1
+
+    def _is_expired(self, created):
+        return (self.max_age is not None
+                and time.monotonic() - created > self.max_age)
+
+    def _is_usable(self, entry):
+        connection, created, _ = entry
+        if getattr(connection, 'closed', False) or self._is_expired(created):
+            return False
+        if self.pre_ping and self.ping is not None:
+            try:
+                self.ping(connection)
+            except Exception:
+                self._count('ping_failed')
+                return False
+        return True
+
+    def _reset(self, connection):
+        if getattr(connection, 'closed', False):
+            return False
+        if self.reset is None:
+            return True
+        try:
+            self.reset(connection)
+        except Exception:
+            return False
+        return True
+
+    def _close(self, connection):
+        self._count('closed')
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+def get_pool(key, options, **callbacks):
+    """
+    Пул процесса для key, созданный с options из DATABASES['POOL'] при
+    первом обращении. None, если пул выключен (MAX_SIZE = 0).
+    """
+    if not options.get('MAX_SIZE'):
+        return None
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(
+                options['MAX_SIZE'], timeout=options.get('TIMEOUT', 10),
+                max_age=options.get('MAX_AGE'),
+                pre_ping=options.get('PRE_PING', True), **callbacks,
+            )
+    return pool
+
+
+def get_pools():
+    """Пулы процесса: (псевдоним БД, имя БД) -> ConnectionPool."""
+    with _pools_lock:
+        return dict(_pools)
+
+
+def close_pools(name=None):
+    """Закрывает пулы соединений с БД name или, без name, все пулы."""
+    for (_, pool_name), pool in get_pools().items():
+        if name is None or pool_name == name:
+            pool.close()
+
+
+def _forget_pools():
+    for pool in _pools.values():
+        _inherited.extend(connection for connection, _, _ in pool._idle)
+    _pools.clear()
+
+
+atexit.register(close_pools)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_pools)
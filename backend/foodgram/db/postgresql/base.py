@@ -0,0 +1,83 @@
+import functools
+import time
+
+from django.db.backends.postgresql import base
+from django.utils.asyncio import async_unsafe
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from ..pool import get_pool
+from .creation import DatabaseCreation
+
+# Соединение, которое простаивало дольше, проверяется перед запросом, даже
+# если его не возвращали в пул (management-команды, фоновые потоки).
+IDLE_PING_AFTER = 30
+
+
+def ping(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+
+
+def reset(connection):
+    """Откатывает транзакцию и сбрасывает параметры и временные таблицы."""
+    if connection.info.transaction_status != TRANSACTION_STATUS_IDLE:
+        connection.rollback()
+    # DISCARD ALL нельзя выполнить внутри транзакции. Режим autocommit
+    # Django восстановит при следующем подключении.
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute('DISCARD ALL')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    Бэкенд PostgreSQL с пулом соединений процесса (DATABASES['POOL'], см.
+    foodgram/db/pool.py). Закрытие соединения в Django — в конце запроса
+    при CONN_MAX_AGE = 0 или в close_old_connections() потоков — возвращает
+    его в пул, а подключение берёт свободное из пула.
+    """
+    creation_class = DatabaseCreation
+
+    last_used = 0.0
+    # Пул, из которого взято текущее соединение.
+    connection_pool = None
+
+    @property
+    def pool(self):
+        # Тестовая база меняет NAME у того же объекта, поэтому пул
+        # выбирается при каждом обращении.
+        return get_pool((self.alias, self.settings_dict['NAME']),
+                        self.settings_dict.get('POOL', {}),
+                        ping=ping, reset=reset)
+
+    @async_unsafe
+    def get_new_connection(self, conn_params):
+        # connect() сам вызывает ensure_connection().
+        self.last_used = time.monotonic()
+        self.connection_pool = self.pool
+        if self.connection_pool is None:
+            return super().get_new_connection(conn_params)
+        connection = self.connection_pool.acquire(functools.partial(
+            super().get_new_connection, conn_params))
+        # Родительский метод задаёт уровень изоляции только для нового
+        # соединения, set_session() на соединении сохраняется.
+        self.isolation_level = self.settings_dict['OPTIONS'].get(
+            'isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection_pool is None or self.connection is None:
+            super()._close()
+            return
+        with self.wrap_database_errors:
+            self.connection_pool.release(self.connection)
+
+    def ensure_connection(self):
+        if (self.connection is not None and self.connection_pool is not None
+                and self.connection_pool.pre_ping and not self.in_atomic_block
+                and time.monotonic() - self.last_used > IDLE_PING_AFTER
+                and not self.is_usable()):
+            # Сломанное соединение пул при возврате закроет.
+            self.close()
+        super().ensure_connection()
+        self.last_used = time.monotonic()
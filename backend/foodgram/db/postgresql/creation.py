@@ -0,0 +1,24 @@
+from django.db.backends.postgresql import creation
+
+from ..pool import close_pools
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    """
+    Перед созданием, копированием и удалением тестовой базы закрывает
+    соединения с ней в пулах: PostgreSQL не даёт удалить базу или
+    использовать её как шаблон, пока к ней кто-то подключён.
+    """
+
+    def _create_test_db(self, verbosity, autoclobber, keepdb=False):
+        close_pools(self._get_test_db_name())
+        return super()._create_test_db(verbosity, autoclobber, keepdb)
+
+    def _clone_test_db(self, suffix, verbosity, keepdb=False):
+        self.connection.close()
+        close_pools(self.connection.settings_dict['NAME'])
+        return super()._clone_test_db(suffix, verbosity, keepdb)
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        close_pools(test_database_name)
+        return super()._destroy_test_db(test_database_name, verbosity)
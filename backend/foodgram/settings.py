@@ -25,6 +25,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'recipes.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -62,8 +63,54 @@ DATABASES = {
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD', 'password'),
         'HOST': os.environ.get('SQL_HOST', 'localhost'),
         'PORT': os.environ.get('SQL_PORT', '5432'),
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 0)),
+        # Пул соединений PostgreSQL в каждом процессе (foodgram/db): не
+        # больше MAX_SIZE соединений, ожидание свободного до TIMEOUT
+        # секунд, пересоздание через MAX_AGE секунд и проверка SELECT 1
+        # перед выдачей при PRE_PING. С пулом CONN_MAX_AGE оставляем 0:
+        # соединение возвращается в пул в конце каждого запроса.
+        'POOL': {
+            'MAX_SIZE': int(os.environ.get('DB_POOL_SIZE', 0)),
+            'TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+            'MAX_AGE': int(os.environ.get('DB_POOL_MAX_AGE', 1800)),
+            'PRE_PING': int(os.environ.get('DB_POOL_PRE_PING', 1)),
+        },
+    }
+}
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # Тестовая база в файле: тесты параллельных запросов
+    # (ConcurrentToggleTests) пишут из нескольких потоков. Общая база в
+    # памяти блокирует таблицы без ожидания (database table is locked), а
+    # файл ждёт освобождения блокировки. Django удаляет файл после тестов.
+    DATABASES['default']['TEST'] = {'NAME': BASE_DIR / 'test_db.sqlite3'}
+POSTGRESQL_ENGINES = ('django.db.backends.postgresql',
+                      'django.db.backends.postgresql_psycopg2')
+if (DATABASES['default']['POOL']['MAX_SIZE']
+        and DATABASES['default']['ENGINE'] in POSTGRESQL_ENGINES):
+    DATABASES['default']['ENGINE'] = 'foodgram.db.postgresql'
+
+# locmem и file работают без внешних сервисов; кэш file (или redis,
+# memcached) общий для всех процессов сервера.
+CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+    'memcached': 'django.core.cache.backends.memcached.PyMemcacheCache',
+}
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'locmem')
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS.get(CACHE_BACKEND, CACHE_BACKEND),
+        'LOCATION': os.environ.get(
+            'CACHE_LOCATION',
+            str(BASE_DIR / 'cache') if CACHE_BACKEND == 'file' else ''
+        ),
     }
 }
+if CACHE_BACKEND in ('locmem', 'file'):
+    CACHES['default']['OPTIONS'] = {
+        'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', 10000)),
+    }
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -108,7 +155,7 @@ REST_FRAMEWORK = {
     ],
 
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'recipes.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination'
                                 '.PageNumberPagination',
@@ -128,3 +175,53 @@ DJOSER = {
         'user_list': ["rest_framework.permissions.AllowAny"],
     }
 }
+
+SHOPPING_LIST_PDF_FONT = os.environ.get(
+    'SHOPPING_LIST_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+)
+SHOPPING_LIST_PDF_CACHE_TIMEOUT = 60 * 60 * 24
+
+RECIPE_IMAGE_MAX_BYTES = int(
+    os.environ.get('RECIPE_IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+RECIPE_IMAGE_MAX_PIXELS = int(
+    os.environ.get('RECIPE_IMAGE_MAX_PIXELS', 40_000_000))
+RECIPE_IMAGE_WORKERS = int(os.environ.get('RECIPE_IMAGE_WORKERS', 2))
+RECIPE_IMAGE_VARIANTS = {
+    'normalized': {'size': (1600, 1600), 'format': 'JPEG'},
+    'webp': {'size': (1600, 1600), 'format': 'WEBP'},
+    'thumbnail': {'size': (300, 300), 'format': 'JPEG'},
+    'thumbnail_webp': {'size': (300, 300), 'format': 'WEBP'},
+}
+
+RECIPE_IMAGE_SIZES = ((300, 300), (600, 600), (1200, 1200))
+# Префикс internal-локации nginx для отдачи файлов через X-Accel-Redirect,
+# например /media-internal/. Пустое значение - файлы отдаёт Django.
+MEDIA_ACCEL_REDIRECT_PREFIX = os.environ.get('MEDIA_ACCEL_REDIRECT_PREFIX', '')
+# Файлы медиа, использованные позже этого срока (в секундах), не удаляются.
+MEDIA_ORPHAN_GRACE_PERIOD = int(
+    os.environ.get('MEDIA_ORPHAN_GRACE_PERIOD', 60 * 60))
+
+# Срок хранения закэшированных страниц ленты рецептов в секундах,
+# 0 - не кэшировать.
+RECIPE_RESPONSE_CACHE_TIMEOUT = int(
+    os.environ.get('RECIPE_RESPONSE_CACHE_TIMEOUT', 60))
+
+# Кэш токенов аутентификации в памяти процесса: число записей и срок
+# жизни в секундах. TOKEN_CACHE_SHARED добавляет общий уровень в CACHES.
+# С CACHE_BACKEND=locmem кэш токенов работает только при
+# TOKEN_CACHE_SINGLE_PROCESS=1: сброс записей виден лишь своему процессу.
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_TIMEOUT = int(os.environ.get('TOKEN_CACHE_TIMEOUT', 300))
+TOKEN_CACHE_SHARED = int(os.environ.get('TOKEN_CACHE_SHARED', 0))
+TOKEN_CACHE_SINGLE_PROCESS = int(
+    os.environ.get('TOKEN_CACHE_SINGLE_PROCESS', 0))
+
+# Асинхронное чтение ленты, тегов, ингредиентов и профилей при запуске
+# через ASGI (uvicorn); запросы к БД выполняются в пуле из
+# ASYNC_READ_THREADS потоков.
+ASYNC_READ_API = int(os.environ.get('ASYNC_READ_API', 0))
+ASYNC_READ_THREADS = int(os.environ.get('ASYNC_READ_THREADS', 32))
+
+# Заголовок Server-Timing и гистограммы по маршрутам на /api/metrics.
+REQUEST_METRICS_ENABLED = int(os.environ.get('REQUEST_METRICS_ENABLED', 1))
@@ -1,7 +1,11 @@
 from django.contrib import admin
 from django.urls import include, path
 
+from recipes.views import resized_image
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('recipes.urls')),
+    path('media/r/<int:width>x<int:height>/<path:path>', resized_image,
+         name='resized-image'),
 ]
@@ -0,0 +1,14 @@
+def post_worker_init(worker):
+    from django.db import DatabaseError
+
+    from recipes.ingredient_index import ingredient_index
+
+    try:
+        ingredient_index.build()
+    except DatabaseError as error:
+        worker.log.warning('Индекс ингредиентов не построен: %s', error)
+        return
+    worker.log.info(
+        'Индекс ингредиентов: %(size)d записей, построен за '
+        '%(build_time).3f с, %(memory)d байт', ingredient_index.stats()
+    )
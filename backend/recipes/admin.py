@@ -3,17 +3,20 @@ from import_export import resources
 from import_export.admin import ImportExportModelAdmin
 
 from .models import (CustomUser, Favorite, Ingredient, Recipe,
-                     RecipeIngredient, ShoppingCart, Subscription, Tag)
+                     RecipeIngredient, ShoppingCart, ShoppingCartIngredient,
+                     Subscription, Tag)
 
 
 @admin.register(CustomUser)
 class CustomUserAdmin(admin.ModelAdmin):
-    list_display = ('id', 'email', 'username', 'first_name', 'last_name')
+    list_display = ('id', 'email', 'username', 'first_name', 'last_name',
+                    'recipes_count', 'subscribers_count')
 
 
 @admin.register(Recipe)
 class RecipeAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'text', 'cooking_time')
+    list_display = ('id', 'name', 'text', 'cooking_time', 'favorites_count',
+                    'shopping_carts_count')
     search_fields = ('name',)
     list_filter = ('id', 'name', 'cooking_time')
     empty_value_display = '-пусто-'
@@ -30,6 +33,9 @@ class TagAdmin(admin.ModelAdmin):
 class IngredientResource(resources.ModelResource):
     class Meta:
         model = Ingredient
+        # Повторный импорт обновляет строки, а не создаёт дубликаты.
+        import_id_fields = ('name', 'measurement_unit')
+        skip_unchanged = True
 
 
 @admin.register(Ingredient)
@@ -69,3 +75,11 @@ class ShoppingCartAdmin(admin.ModelAdmin):
     search_fields = ('user',)
     list_filter = ('id', 'user', 'recipe')
     empty_value_display = '-пусто-'
+
+
+@admin.register(ShoppingCartIngredient)
+class ShoppingCartIngredientAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'ingredient', 'amount')
+    search_fields = ('user__email',)
+    list_filter = ('user',)
+    empty_value_display = '-пусто-'
@@ -0,0 +1,90 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.http import HttpResponse
+
+# Маршруты API, которые при ASYNC_READ_API обслуживаются асинхронно.
+ASYNC_READ_ROUTES = {
+    'Recipe-list', 'Recipe-detail', 'Tag-list', 'Tag-detail',
+    'Ingredient-list', 'Ingredient-detail', 'Users-list', 'Users-detail',
+    'Users-me',
+}
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Пул потоков для запросов к БД из асинхронных представлений. В Django
+    4.0 у ORM нет асинхронного API, а sync_to_async с thread_sensitive
+    выполняет весь синхронный код процесса в одном потоке. У каждого
+    потока пула своё соединение с БД, поэтому ожидание БД одним запросом
+    не задерживает остальные.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.ASYNC_READ_THREADS,
+                thread_name_prefix='async-read',
+            )
+    return _executor
+
+
+def render_in_thread(view, request, args, kwargs):
+    timer = getattr(request, '_metrics_timer', None)
+    try:
+        with connection.execute_wrapper(timer) if timer else nullcontext():
+            response = view(request, *args, **kwargs)
+            if not hasattr(response, 'render'):
+                return response
+            started = time.perf_counter()
+            response.render()
+            request._metrics_render = time.perf_counter() - started
+    finally:
+        # Соединения потоков пула живут по правилам CONN_MAX_AGE, как
+        # соединения синхронного сервера между запросами.
+        close_old_connections()
+    # Готовый ответ без render(), иначе Django снова отрисует его
+    # в общем синхронном потоке.
+    return HttpResponse(response.content, status=response.status_code,
+                        headers=dict(response.items()))
+
+
+def async_read_view(view):
+    """
+    Асинхронная обёртка представления DRF: чтение выполняется в пуле
+    потоков (get_executor), а запись — как обычное синхронное
+    представление, в общем потоке Django.
+    """
+    write_view = sync_to_async(view)
+
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in READ_METHODS:
+            return await write_view(request, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), functools.partial(
+            render_in_thread, view, request, args, kwargs))
+
+    # Атрибуты представления DRF (cls, actions, csrf_exempt) нужны
+    # reverse(), метрикам и CsrfViewMiddleware.
+    wrapper.__dict__.update(view.__dict__)
+    wrapper.__name__ = view.__name__
+    return wrapper
+
+
+def use_async_reads(patterns):
+    """Подменяет представления маршрутов ASYNC_READ_ROUTES в patterns."""
+    for pattern in patterns:
+        if pattern.name in ASYNC_READ_ROUTES:
+            pattern.callback = async_read_view(pattern.callback)
+    return patterns
@@ -0,0 +1,160 @@
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.authentication import TokenAuthentication
+
+from .generations import bump_generation_on_commit, get_generation
+
+SHARED_KEY_PREFIX = 'auth-token'
+# Кэши Django, в которых поколение пользователя видно только своему
+# процессу (или не хранится вовсе).
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',
+                        'django.core.cache.backends.dummy.DummyCache')
+
+
+def user_generation_name(user_id):
+    return f'auth:{user_id}'
+
+
+def invalidate_user_tokens(user_id):
+    """
+    Делает недействительными закэшированные токены пользователя во всех
+    процессах: кэш токенов работает, только если поколение общее (см.
+    TokenCache.enabled).
+    """
+    bump_generation_on_commit(user_generation_name(user_id))
+
+
+class TokenCache:
+    """
+    LRU-кэш токен -> (пользователь, токен) в памяти процесса с временем
+    жизни записи. Запись действительна, пока не изменилось поколение
+    пользователя (invalidate_user_tokens). Если включён общий уровень,
+    промахи локального кэша сначала ищутся в кэше Django.
+
+    Кэш выключен, если поколение пользователя видно не всем процессам
+    сервера: с кэшем Django в памяти процесса (locmem) смена пароля в
+    одном воркере не сбросила бы запись в другом. С locmem кэш работает
+    только при TOKEN_CACHE_SINGLE_PROCESS, когда воркер один.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.reset_stats()
+
+    @property
+    def max_size(self):
+        return settings.TOKEN_CACHE_SIZE
+
+    @property
+    def timeout(self):
+        return settings.TOKEN_CACHE_TIMEOUT
+
+    @property
+    def enabled(self):
+        backend = settings.CACHES['default']['BACKEND']
+        if backend not in PROCESS_LOCAL_CACHES:
+            return True
+        return (backend == PROCESS_LOCAL_CACHES[0]
+                and settings.TOKEN_CACHE_SINGLE_PROCESS)
+
+    @property
+    def shared(self):
+        return settings.TOKEN_CACHE_SHARED
+
+    def reset_stats(self):
+        self.stats = {'hit': 0, 'shared_hit': 0, 'miss': 0}
+
+    @staticmethod
+    def shared_key(key):
+        # Сам токен в имени ключа кэша не хранится.
+        return (f'{SHARED_KEY_PREFIX}:'
+                f'{hashlib.sha256(key.encode()).hexdigest()}')
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None and self._is_valid(entry):
+            self._count('hit')
+            return entry[2], entry[3]
+        if self.shared:
+            entry = cache.get(self.shared_key(key))
+            if entry is not None and self._is_valid(entry):
+                self._store(key, entry)
+                self._count('shared_hit')
+                return entry[2], entry[3]
+        self._count('miss')
+        return None
+
+    def _count(self, result):
+        with self._lock:
+            self.stats[result] += 1
+
+    def set(self, key, user, token):
+        # Запись живёт не дольше timeout: это ограничивает и гонку, когда
+        # пользователь изменился между чтением из БД и записью в кэш.
+        entry = (time.monotonic() + self.timeout,
+                 get_generation(user_generation_name(user.pk)), user, token)
+        self._store(key, entry)
+        if self.shared:
+            # Монотонное время процесса в общем кэше бессмысленно, срок
+            # задаёт таймаут кэша.
+            cache.set(self.shared_key(key), (float('inf'), *entry[1:]),
+                      self.timeout)
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _is_valid(self, entry):
+        expires, generation, user, _ = entry
+        return expires > time.monotonic() and generation == get_generation(
+            user_generation_name(user.pk))
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.shared:
+            cache.delete(self.shared_key(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication без запроса к БД на каждый вызов API: пары токен -
+    пользователь берутся из TokenCache, если он включён. Выход (удаление
+    токена), смена пароля и деактивация пользователя сбрасывают записи
+    через сигналы.
+    """
+
+    def authenticate_credentials(self, key):
+        if not token_cache.enabled:
+            return super().authenticate_credentials(key)
+        cached = token_cache.get(key)
+        if cached is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, user, token)
+        else:
+            user, token = cached
+        # Каждый запрос получает свою копию: представления могут менять
+        # request.user, а записи кэша разделяются между потоками.
+        user, token = copy.copy(user), copy.copy(token)
+        token.user = user
+        return user, token
+
+
+token_cache = TokenCache()
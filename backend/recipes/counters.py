@@ -0,0 +1,57 @@
+from django.apps import apps
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+# Денормализованные счётчики:
+# (модель, поле счётчика, считаемая модель, поле связи с моделью)
+COUNTERS = (
+    ('recipes.Recipe', 'favorites_count', 'recipes.Favorite', 'recipe'),
+    ('recipes.Recipe', 'shopping_carts_count', 'recipes.ShoppingCart',
+     'recipe'),
+    ('recipes.CustomUser', 'recipes_count', 'recipes.Recipe', 'author'),
+    ('recipes.CustomUser', 'subscribers_count', 'recipes.Subscription',
+     'author'),
+)
+
+
+def change_counter(model, pks, field, delta):
+    """
+    Атомарно меняет счётчик field у объектов pks на delta, не опуская
+    его ниже нуля.
+    """
+    return model.objects.filter(pk__in=pks).update(
+        **{field: Greatest(F(field) + delta, 0)}
+    )
+
+
+def actual_count(source, link):
+    return Coalesce(
+        Subquery(
+            source.objects.filter(
+                **{link: OuterRef('pk')}
+            ).order_by().values(link).annotate(
+                count=Count('pk')
+            ).values('count')
+        ),
+        0
+    )
+
+
+def reconcile_counters(repair=True):
+    """
+    Сверяет счётчики с фактическими количествами и при repair
+    исправляет расхождения. Возвращает количество расхождений по полям.
+    """
+    drift = {}
+    for model_label, field, source_label, link in COUNTERS:
+        model = apps.get_model(model_label)
+        source = apps.get_model(source_label)
+        drifted = model.objects.annotate(
+            actual=actual_count(source, link)
+        ).exclude(**{field: F('actual')})
+        drift[f'{model_label}.{field}'] = drifted.count()
+        if repair and drift[f'{model_label}.{field}']:
+            model.objects.filter(pk__in=drifted.values('pk')).update(
+                **{field: actual_count(source, link)}
+            )
+    return drift
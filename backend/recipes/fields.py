@@ -0,0 +1,45 @@
+from io import BytesIO
+
+from django.conf import settings
+from drf_extra_fields.fields import Base64ImageField
+from PIL import Image
+from rest_framework.exceptions import ValidationError
+
+
+class BoundedBase64ImageField(Base64ImageField):
+    """
+    Base64ImageField с ограничениями на размер файла и число пикселей.
+    Размер проверяется до декодирования base64, число пикселей — по
+    заголовку изображения, до декодирования самой картинки.
+    """
+    default_error_messages = {
+        'too_large': 'Размер изображения не должен превышать {max_bytes} байт',
+        'too_many_pixels': (
+            'Изображение не должно содержать больше {max_pixels} пикселей'
+        ),
+    }
+
+    @property
+    def max_bytes(self):
+        return settings.RECIPE_IMAGE_MAX_BYTES
+
+    @property
+    def max_pixels(self):
+        return settings.RECIPE_IMAGE_MAX_PIXELS
+
+    def to_internal_value(self, base64_data):
+        if isinstance(base64_data, str):
+            payload = base64_data.rpartition(';base64,')[2]
+            if len(payload) * 3 // 4 > self.max_bytes:
+                self.fail('too_large', max_bytes=self.max_bytes)
+        return super().to_internal_value(base64_data)
+
+    def get_file_extension(self, filename, decoded_file):
+        try:
+            with Image.open(BytesIO(decoded_file)) as image:
+                width, height = image.size
+        except (OSError, Image.DecompressionBombError):
+            raise ValidationError(self.INVALID_FILE_MESSAGE)
+        if width * height > self.max_pixels:
+            self.fail('too_many_pixels', max_pixels=self.max_pixels)
+        return super().get_file_extension(filename, decoded_file)
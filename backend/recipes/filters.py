@@ -1,11 +1,18 @@
 from rest_framework import filters
 
+from .ingredient_index import ingredient_index
+from .search import search_recipes, search_words
+from .tag_masks import filter_by_tags
+
 
 class RecipeFilterBackend(filters.BaseFilterBackend):
     def filter_queryset(self, request, queryset, view):
         tags = request.query_params.getlist('tags')
         if len(tags) != 0:
-            queryset = queryset.filter(tags__slug__in=tags).distinct()
+            queryset = filter_by_tags(
+                queryset, tags,
+                match_all=request.query_params.get('tags_match') == 'all'
+            )
         author = request.query_params.get('author')
         if author is not None:
             queryset = queryset.filter(author__id=author)
@@ -16,5 +23,34 @@ class RecipeFilterBackend(filters.BaseFilterBackend):
         return queryset
 
 
+class RecipeSearchFilter(filters.BaseFilterBackend):
+    """
+    Полнотекстовый поиск по названию и описанию рецепта. Результаты
+    упорядочены по релевантности; при пагинации по курсору порядок
+    остаётся хронологическим.
+    """
+    search_param = 'search'
+
+    def filter_queryset(self, request, queryset, view):
+        term = request.query_params.get(self.search_param, '')
+        if not term.strip():
+            return queryset
+        # Без слов (например, ?search=!) ранжировать нечего.
+        if not search_words(term):
+            return queryset.none()
+        return search_recipes(queryset, term).order_by(
+            '-search_rank', '-pub_date', '-pk')
+
+
 class IngredientSearchFilter(filters.SearchFilter):
+    """
+    Поиск ингредиентов по индексу в памяти: сначала совпадения по началу
+    названия, затем по вхождению.
+    """
     search_param = 'name'
+
+    def filter_queryset(self, request, queryset, view):
+        term = request.query_params.get(self.search_param, '')
+        if view.action != 'list' or not term.strip():
+            return super().filter_queryset(request, queryset, view)
+        return ingredient_index.search(term)
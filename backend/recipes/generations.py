@@ -0,0 +1,52 @@
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+KEY_PREFIX = 'generation'
+
+
+def _key(name):
+    return f'{KEY_PREFIX}:{name}'
+
+
+def _initial_value():
+    # После вытеснения ключа из кэша счётчик не должен вернуться к уже
+    # выданному значению, поэтому начинаем с текущего времени.
+    return int(time.time() * 1000)
+
+
+def get_generation(name):
+    """
+    Текущее поколение данных name, общее для всех процессов,
+    если кэш общий (см. CACHES).
+    """
+    key = _key(name)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, _initial_value(), timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generation(name):
+    """
+    Сдвигает поколение name, инвалидируя всё, что на него завязано.
+    """
+    key = _key(name)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        generation = _initial_value()
+        cache.set(key, generation, timeout=None)
+        return generation
+
+
+def bump_generation_on_commit(name):
+    """
+    Сдвигает поколение name сразу, чтобы чтения в той же транзакции не
+    получили старые данные, и ещё раз после фиксации: данные, собранные
+    другим процессом до фиксации, останутся под старым поколением.
+    """
+    bump_generation(name)
+    transaction.on_commit(lambda: bump_generation(name))
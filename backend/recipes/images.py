@@ -0,0 +1,238 @@
+import hashlib
+import logging
+import os
+import posixpath
+import re
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .models import Recipe
+from .response_cache import invalidate_recipe_responses
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = Lock()
+
+FORMAT_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'webp': 'image/webp', 'png': 'image/png'}
+RESIZED_IMAGES_DIR = 'cache'
+# Имя уменьшенной копии: <хэш оригинала>.<ширина>x<высота>.<расширение>.
+RESIZED_NAME_RE = re.compile(r'^(?P<digest>[0-9a-f]{64})\.\d+x\d+\.\w+$')
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.RECIPE_IMAGE_WORKERS,
+                thread_name_prefix='recipe-images'
+            )
+        return _executor
+
+
+def variant_name(name, kind, image_format):
+    return f'{name}.{kind}.{FORMAT_EXTENSIONS[image_format]}'
+
+
+def render_variant(image, size, image_format):
+    variant = image.copy()
+    variant.thumbnail(size)
+    if image_format == 'JPEG' and variant.mode != 'RGB':
+        variant = variant.convert('RGB')
+    buffer = BytesIO()
+    # Метаданные (EXIF и пр.) не передаются, поэтому не попадают в файл.
+    variant.save(buffer, image_format, quality=85, optimize=True)
+    return buffer.getvalue()
+
+
+def process_recipe_image(recipe_id, name):
+    """
+    Нормализует изображение рецепта (ориентация по EXIF, перекодирование
+    без метаданных) и строит его варианты из RECIPE_IMAGE_VARIANTS.
+    Оригинал не изменяется. Имя оригинала задаётся его содержимым, поэтому
+    уже построенные варианты переиспользуются.
+    """
+    storage = default_storage
+    try:
+        with storage.open(name) as file:
+            image = ImageOps.exif_transpose(Image.open(file))
+            image.load()
+        variants = {}
+        for kind, options in settings.RECIPE_IMAGE_VARIANTS.items():
+            image_format = options['format']
+            path = variant_name(name, kind, image_format)
+            if not storage.exists(path):
+                content = render_variant(image, options['size'],
+                                         image_format)
+                path = storage.save(path, ContentFile(content))
+            variants[kind] = path
+        if Recipe.objects.filter(pk=recipe_id, image=name).update(
+                image_variants=variants):
+            invalidate_recipe_responses()
+    except Exception:
+        logger.exception('Не удалось обработать изображение %s', name)
+
+
+def process_in_background(recipe_id, name):
+    try:
+        process_recipe_image(recipe_id, name)
+    finally:
+        # Соединения с БД принадлежат потоку пула, закрываем их сами.
+        connections.close_all()
+
+
+def schedule_image_processing(recipe):
+    """
+    Ставит обработку изображения в фоновый пул после коммита транзакции.
+    При RECIPE_IMAGE_WORKERS = 0 обработка выполняется сразу.
+    """
+    recipe_id, name = recipe.pk, recipe.image.name
+
+    def submit():
+        if settings.RECIPE_IMAGE_WORKERS:
+            get_executor().submit(process_in_background, recipe_id, name)
+        else:
+            process_recipe_image(recipe_id, name)
+
+    transaction.on_commit(submit)
+
+
+def release_image(name):
+    """
+    Удаляет файл изображения и его варианты, если на него больше не ссылается
+    ни один рецепт. Файлы, использованные позже MEDIA_ORPHAN_GRACE_PERIOD
+    секунд назад, остаются: их может переиспользовать ещё не закоммиченная
+    загрузка.
+    """
+    storage = default_storage
+    if not name or Recipe.objects.filter(image=name).exists():
+        return
+    try:
+        modified = storage.get_modified_time(name)
+    except FileNotFoundError:
+        return
+    age = (timezone.now() - modified).total_seconds()
+    if age < settings.MEDIA_ORPHAN_GRACE_PERIOD:
+        return
+    digest = image_digest(storage, name)
+    for kind, options in settings.RECIPE_IMAGE_VARIANTS.items():
+        storage.delete(variant_name(name, kind, options['format']))
+    storage.delete(name)
+    delete_resized_images(storage, digest)
+
+
+def schedule_image_release(name):
+    transaction.on_commit(lambda: release_image(name))
+
+
+def is_allowed_size(width, height):
+    return (width, height) in settings.RECIPE_IMAGE_SIZES
+
+
+def resized_image_urls(image):
+    """Ссылки на уменьшенные копии изображения для всех RECIPE_IMAGE_SIZES."""
+    if not image:
+        return {}
+    return {
+        f'{width}x{height}': image.storage.url(
+            f'r/{width}x{height}/{image.name}')
+        for width, height in settings.RECIPE_IMAGE_SIZES
+    }
+
+
+def file_digest(storage, name):
+    digest = hashlib.sha256()
+    with storage.open(name) as file:
+        for chunk in file.chunks():
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_file_digest(storage, name):
+    """
+    file_digest с кэшем по имени и времени изменения файла: старые
+    изображения не перечитываются при каждом обходе.
+    """
+    modified = storage.get_modified_time(name).timestamp()
+    key = ('image-digest:'
+           f'{hashlib.sha256(f"{name}:{modified}".encode()).hexdigest()}')
+    digest = cache.get(key)
+    if digest is None:
+        digest = file_digest(storage, name)
+        cache.set(key, digest, None)
+    return digest
+
+
+def image_digest(storage, name):
+    """
+    Хэш содержимого изображения: у файлов ContentAddressedStorage он
+    совпадает с именем, старые файлы приходится читать.
+    """
+    stem = posixpath.splitext(posixpath.basename(name))[0]
+    if DIGEST_RE.match(stem):
+        return stem
+    return file_digest(storage, name)
+
+
+def resized_image_digest(name):
+    """Хэш оригинала, из которого сделана уменьшенная копия name."""
+    match = RESIZED_NAME_RE.match(posixpath.basename(name))
+    return match and match['digest']
+
+
+def resized_images_dir(digest):
+    return f'{RESIZED_IMAGES_DIR}/{digest[:2]}'
+
+
+def delete_resized_images(storage, digest):
+    """Удаляет все уменьшенные копии изображения с хэшем digest."""
+    directory = resized_images_dir(digest)
+    try:
+        _, files = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for filename in files:
+        if resized_image_digest(filename) == digest:
+            storage.delete(f'{directory}/{filename}')
+
+
+def get_resized_image(name, width, height):
+    """
+    Возвращает имя уменьшенной копии изображения name, создавая её
+    при первом обращении. Имя строится по хэшу содержимого оригинала,
+    поэтому файл по этому имени никогда не меняется.
+    """
+    storage = default_storage
+    key = f'resized-image:{width}x{height}:{name}'
+    resized_name = cache.get(key)
+    if resized_name is not None and storage.exists(resized_name):
+        return resized_name
+    source_format = os.path.splitext(name)[1].lower()
+    image_format = 'PNG' if source_format in ('.png', '.gif') else 'JPEG'
+    digest = file_digest(storage, name)
+    resized_name = (
+        f'{resized_images_dir(digest)}/{digest}.{width}x{height}.'
+        f'{FORMAT_EXTENSIONS[image_format]}'
+    )
+    if not storage.exists(resized_name):
+        with storage.open(name) as file:
+            image = ImageOps.exif_transpose(Image.open(file))
+            content = render_variant(image, (width, height), image_format)
+        saved_name = storage.save(resized_name, ContentFile(content))
+        if saved_name != resized_name:
+            # Копию одновременно создал другой запрос.
+            storage.delete(saved_name)
+    cache.set(key, resized_name, None)
+    return resized_name
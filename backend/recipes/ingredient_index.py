@@ -0,0 +1,148 @@
+import bisect
+import logging
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .generations import bump_generation, get_generation
+from .models import Ingredient
+
+logger = logging.getLogger(__name__)
+
+GENERATION = 'ingredients'
+
+
+def normalize(value):
+    return value.strip().casefold().replace('ё', 'е')
+
+
+class IngredientIndex:
+    """
+    Индекс справочника ингредиентов в памяти процесса для автодополнения.
+
+    Сначала возвращаются совпадения по началу названия, затем по
+    вхождению подстроки. Раз в check_interval секунд индекс сверяет
+    поколение ингредиентов (см. generations.py) и число и наибольший id
+    записей в БД и перестраивается, если они изменились: с кэшем в памяти
+    процесса поколение другого воркера не видно, а добавление и удаление
+    видны по БД. Правки названий без общего кэша подхватываются не позже
+    чем через max_age секунд после построения.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (ключи, ингредиенты) публикуются одним присваиванием: search()
+        # читает их без блокировки и не должна увидеть списки разных
+        # построений.
+        self._data = ([], [])
+        self._fingerprint = None
+        self._checked_at = 0.0
+        self._built_at = 0.0
+        self.build_time = None
+        self.memory = 0
+
+    @property
+    def check_interval(self):
+        return getattr(settings, 'INGREDIENT_INDEX_CHECK_INTERVAL', 1.0)
+
+    @property
+    def max_age(self):
+        return getattr(settings, 'INGREDIENT_INDEX_MAX_AGE', 300)
+
+    @staticmethod
+    def _current_fingerprint():
+        aggregates = Ingredient.objects.aggregate(count=Count('id'),
+                                                  last=Max('id'))
+        return (get_generation(GENERATION), aggregates['count'],
+                aggregates['last'])
+
+    def build(self):
+        with self._lock:
+            return self._build()
+
+    def _build(self):
+        started = time.perf_counter()
+        fingerprint = self._current_fingerprint()
+        ingredients = sorted(
+            (
+                (normalize(name), Ingredient(
+                    id=pk, name=name, measurement_unit=measurement_unit))
+                for pk, name, measurement_unit in
+                Ingredient.objects.values_list(
+                    'id', 'name', 'measurement_unit').iterator()
+            ),
+            key=lambda item: (item[0], item[1].pk)
+        )
+        self._data = ([key for key, _ in ingredients],
+                      [ingredient for _, ingredient in ingredients])
+        self._fingerprint = fingerprint
+        self._checked_at = self._built_at = time.monotonic()
+        self.build_time = time.perf_counter() - started
+        self.memory = self._memory()
+        logger.info(
+            'Индекс ингредиентов построен: %d записей за %.1f мс, ~%d КБ',
+            len(ingredients), self.build_time * 1000, self.memory // 1024
+        )
+        return self
+
+    def _memory(self):
+        keys, ingredients = self._data
+        size = sys.getsizeof(keys) + sys.getsizeof(ingredients)
+        for key, ingredient in zip(keys, ingredients):
+            size += sys.getsizeof(key) + sys.getsizeof(ingredient)
+            size += sys.getsizeof(ingredient.__dict__)
+            size += sys.getsizeof(ingredient.name)
+            size += sys.getsizeof(ingredient.measurement_unit)
+        return size
+
+    def invalidate(self):
+        self._fingerprint = None
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        if (self._fingerprint is not None
+                and now - self._checked_at < self.check_interval):
+            return
+        with self._lock:
+            if (self._fingerprint is not None
+                    and now - self._built_at < self.max_age):
+                if now - self._checked_at < self.check_interval:
+                    return
+                self._checked_at = now
+                if self._current_fingerprint() == self._fingerprint:
+                    return
+            self._build()
+
+    def search(self, term):
+        self._ensure_fresh()
+        keys, ingredients = self._data
+        term = normalize(term)
+        if not term:
+            return list(ingredients)
+        start = bisect.bisect_left(keys, term)
+        end = bisect.bisect_left(keys, term + '\uffff', start)
+        results = ingredients[start:end]
+        results.extend(
+            ingredient for key, ingredient in zip(keys, ingredients)
+            if term in key and not key.startswith(term)
+        )
+        return results
+
+    def stats(self):
+        return {
+            'size': len(self._data[0]),
+            'generation': self._fingerprint and self._fingerprint[0],
+            'build_time': self.build_time,
+            'memory': self.memory,
+        }
+
+
+def invalidate_ingredient_index():
+    bump_generation(GENERATION)
+    ingredient_index.invalidate()
+
+
+ingredient_index = IngredientIndex()
@@ -0,0 +1,138 @@
+import csv
+import json
+import re
+import time
+from io import StringIO
+from itertools import islice
+from pathlib import Path
+
+from django.db import connection, transaction
+
+from .ingredient_index import invalidate_ingredient_index
+from .models import Ingredient
+
+NAME_MAX_LENGTH = Ingredient._meta.get_field('name').max_length
+UNIT_MAX_LENGTH = Ingredient._meta.get_field('measurement_unit').max_length
+JSON_CHUNK_SIZE = 64 * 1024
+JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_json_array(file, chunk_size=JSON_CHUNK_SIZE):
+    """
+    Разбирает JSON-массив по одному элементу, читая файл кусками,
+    чтобы не держать весь документ в памяти.
+    """
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('Ожидается JSON-массив')
+    position = 1
+    eof = False
+    while True:
+        position = JSON_SEPARATORS.match(buffer, position).end()
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            item, end = None, None
+        # Значение, упёршееся в конец буфера, может быть обрезано.
+        if end is None or end == len(buffer) and not eof:
+            if eof:
+                raise ValueError('Незавершённый JSON-массив')
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        position = end
+        yield item
+
+
+def read_ingredients(path):
+    """Пары (название, единица измерения) из CSV без заголовка или JSON."""
+    path = Path(path)
+    with open(path, encoding='utf-8', newline='') as file:
+        if path.suffix.lower() == '.json':
+            for item in iter_json_array(file):
+                yield item.get('name', ''), item.get('measurement_unit', '')
+        else:
+            for row in csv.reader(file):
+                if row:
+                    yield row[0], row[1] if len(row) > 1 else ''
+
+
+def unique_ingredients(rows, stats):
+    """Отбрасывает пустые, слишком длинные и повторяющиеся строки."""
+    seen = set()
+    for name, measurement_unit in rows:
+        stats['read'] += 1
+        row = (name.strip(), measurement_unit.strip())
+        if (not all(row) or len(row[0]) > NAME_MAX_LENGTH
+                or len(row[1]) > UNIT_MAX_LENGTH):
+            stats['skipped'] += 1
+        elif row in seen:
+            stats['duplicates'] += 1
+        else:
+            seen.add(row)
+            yield row
+
+
+def _copy_batch(batch):
+    """
+    На PostgreSQL пачка уходит через COPY во временную таблицу и оттуда
+    одной вставкой с ON CONFLICT DO NOTHING по уникальному ограничению.
+    """
+    buffer = StringIO()
+    csv.writer(buffer).writerows(batch)
+    buffer.seek(0)
+    table = Ingredient._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'CREATE TEMPORARY TABLE ingredient_staging '
+            '(name varchar, measurement_unit varchar) ON COMMIT DROP'
+        )
+        cursor.copy_expert(
+            'COPY ingredient_staging (name, measurement_unit) '
+            'FROM STDIN WITH (FORMAT csv)',
+            buffer
+        )
+        cursor.execute(
+            f'INSERT INTO {table} (name, measurement_unit) '
+            'SELECT name, measurement_unit FROM ingredient_staging '
+            'ON CONFLICT (name, measurement_unit) DO NOTHING'
+        )
+        created = cursor.rowcount
+        cursor.execute('DROP TABLE ingredient_staging')
+    return created
+
+
+def load_ingredients(rows, batch_size=5000):
+    """
+    Добавляет в справочник ингредиенты, которых в нём ещё нет, пачками
+    по batch_size. Существующие строки не трогает, поэтому повторная
+    загрузка того же файла ничего не меняет. Возвращает статистику.
+    """
+    stats = {'read': 0, 'skipped': 0, 'duplicates': 0, 'created': 0}
+    started = time.perf_counter()
+    rows = unique_ingredients(rows, stats)
+    with transaction.atomic():
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            if connection.vendor == 'postgresql':
+                stats['created'] += _copy_batch(batch)
+                continue
+            before = Ingredient.objects.count()
+            Ingredient.objects.bulk_create(
+                (Ingredient(name=name, measurement_unit=measurement_unit)
+                 for name, measurement_unit in batch),
+                batch_size=batch_size, ignore_conflicts=True
+            )
+            stats['created'] += Ingredient.objects.count() - before
+        if stats['created']:
+            # Массовая вставка не вызывает сигналов сохранения.
+            transaction.on_commit(invalidate_ingredient_index)
+    stats['elapsed'] = time.perf_counter() - started
+    return stats
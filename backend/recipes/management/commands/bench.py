@@ -0,0 +1,298 @@
+import json
+import math
+import random
+import secrets
+import tempfile
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from recipes.models import (Favorite, Ingredient, Recipe, ShoppingCart,
+                            Subscription, Tag)
+from recipes.seeding import Seeder
+
+User = get_user_model()
+
+PASSWORD = 'bench-Password-42'
+IMAGE = (
+    'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAAD'
+    'UlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=='
+)
+CART_ITEMS = 20
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = ('Замеряет задержку (p50/p95), число запросов и пиковую память '
+            'для каждого маршрута API на синтетических данных и сравнивает '
+            'результат с базовым.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--recipes', type=int, default=1000)
+        parser.add_argument(
+            '--ingredients-file',
+            default=settings.BASE_DIR.parent / 'data' / 'ingredients.csv',
+        )
+        parser.add_argument('--ingredients-per-recipe', type=int, default=8)
+        parser.add_argument('--favorites', type=int, default=5000)
+        parser.add_argument('--subscriptions', type=int, default=1000)
+        parser.add_argument(
+            '--iterations', type=int, default=20,
+            help='Сколько раз выполнять запрос к каждому маршруту.'
+        )
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument(
+            '--output', default='bench.json',
+            help='Файл для результатов в формате JSON.'
+        )
+        parser.add_argument(
+            '--baseline',
+            help='Файл с результатами предыдущего запуска для сравнения.'
+        )
+        parser.add_argument(
+            '--threshold', type=float, default=0.25,
+            help='Допустимый относительный рост p95 и памяти.'
+        )
+        parser.add_argument(
+            '--current-db', action='store_true',
+            help='Работать в текущей базе, а не во временной тестовой. '
+                 'Созданные данные останутся в базе.'
+        )
+
+    def handle(self, *args, **options):
+        old_name = None
+        if not options['current_db']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(
+                    ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+                    MEDIA_ROOT=tempfile.mkdtemp(), RECIPE_IMAGE_WORKERS=0):
+                self.seed(options)
+                results = self.run_benchmarks(options['iterations'])
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+        report = {
+            'volumes': {
+                key: options[key] for key in (
+                    'users', 'recipes', 'ingredients_per_recipe',
+                    'favorites', 'subscriptions',
+                )
+            },
+            'iterations': options['iterations'],
+            'database': connection.vendor,
+            'endpoints': results,
+        }
+        with open(options['output'], 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:<40} p50 {result["p50_ms"]:8.2f} мс  '
+                f'p95 {result["p95_ms"]:8.2f} мс  '
+                f'запросов {result["queries"]:3}  '
+                f'память {result["peak_memory_kb"]:8.1f} КБ'
+            )
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['threshold'])
+
+    def seed(self, options):
+        # Префикс уникален, чтобы повторный запуск в той же базе
+        # (--current-db) не конфликтовал с уже созданными пользователями.
+        seeder = Seeder(seed=options['seed'],
+                        prefix=f'bench{secrets.token_hex(4)}-',
+                        ingredients_file=options['ingredients_file'])
+        user_ids, self.recipe_ids = seeder.run(
+            users=options['users'], recipes=options['recipes'],
+            ingredients_per_recipe=options['ingredients_per_recipe'],
+            favorites=options['favorites'], shopping_carts=0,
+            subscriptions=options['subscriptions'],
+        )
+        # Запросы идут от имени самого активного пользователя.
+        self.user = User.objects.get(pk=user_ids[0])
+        self.user.set_password(PASSWORD)
+        self.user.save()
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+        rng = random.Random(options['seed'])
+        for recipe_id in rng.sample(self.recipe_ids,
+                                    min(CART_ITEMS, len(self.recipe_ids))):
+            ShoppingCart.objects.get_or_create(
+                user=self.user, recipe_id=recipe_id)
+        self.author = User.objects.exclude(pk=self.user.pk).filter(
+            pk__in=user_ids).first()
+        # Парные маршруты (добавить/удалить) должны начинать с пустого
+        # состояния, иначе первый запрос вернёт ошибку.
+        Favorite.objects.filter(
+            user=self.user, recipe_id=self.recipe_ids[-1]).delete()
+        ShoppingCart.objects.filter(
+            user=self.user, recipe_id=self.recipe_ids[-1]).delete()
+        Subscription.objects.filter(
+            user=self.user, author=self.author).delete()
+
+    def endpoints(self):
+        """Маршруты из recipes/urls.py: (имя, метод, адрес, данные)."""
+        recipe = Recipe.objects.filter(author=self.user).first() or (
+            Recipe.objects.create(author=self.user, name='Рецепт автора',
+                                  text='Текст', cooking_time=10,
+                                  image='images/bench.png'))
+        other = self.recipe_ids[-1]
+        tag = Tag.objects.first()
+        ingredient = Ingredient.objects.first()
+        recipe_data = {
+            'name': 'Новый рецепт', 'text': 'Текст', 'cooking_time': 10,
+            'image': IMAGE, 'tags': [tag.pk],
+            'ingredients': [{'id': ingredient.pk, 'amount': 10}],
+        }
+        batch = {'recipes': self.recipe_ids[:20]}
+        return [
+            ('recipes-list', 'get', '/api/recipes/', None),
+            ('recipes-list-cursor', 'get', '/api/recipes/?cursor=', None),
+            ('recipes-list-tags', 'get',
+             f'/api/recipes/?tags={tag.slug}', None),
+            ('recipes-list-favorited', 'get',
+             '/api/recipes/?is_favorited=1', None),
+            ('recipes-search', 'get', '/api/recipes/?search=рецепт', None),
+            ('recipes-detail', 'get', f'/api/recipes/{other}/', None),
+            ('recipes-create', 'post', '/api/recipes/', recipe_data),
+            ('recipes-update', 'patch', f'/api/recipes/{recipe.pk}/',
+             recipe_data),
+            ('recipes-delete', 'delete', '/api/recipes/{created}/', None),
+            ('recipes-favorite-add', 'post',
+             f'/api/recipes/{other}/favorite/', None),
+            ('recipes-favorite-remove', 'delete',
+             f'/api/recipes/{other}/favorite/', None),
+            ('recipes-cart-add', 'post',
+             f'/api/recipes/{other}/shopping_cart/', None),
+            ('recipes-cart-remove', 'delete',
+             f'/api/recipes/{other}/shopping_cart/', None),
+            ('recipes-favorite-batch-add', 'post',
+             '/api/recipes/favorite/', batch),
+            ('recipes-favorite-batch-remove', 'delete',
+             '/api/recipes/favorite/', batch),
+            ('recipes-cart-batch-add', 'post',
+             '/api/recipes/shopping_cart/', batch),
+            ('recipes-cart-batch-remove', 'delete',
+             '/api/recipes/shopping_cart/', batch),
+            ('recipes-download-txt', 'get',
+             '/api/recipes/download_shopping_cart/?format=txt', None),
+            ('recipes-download-pdf', 'get',
+             '/api/recipes/download_shopping_cart/?format=pdf', None),
+            ('tags-list', 'get', '/api/tags/', None),
+            ('tags-detail', 'get', f'/api/tags/{tag.pk}/', None),
+            ('ingredients-list', 'get', '/api/ingredients/', None),
+            ('ingredients-search', 'get',
+             '/api/ingredients/?name=сах', None),
+            ('ingredients-detail', 'get',
+             f'/api/ingredients/{ingredient.pk}/', None),
+            ('users-list', 'get', '/api/users/', None),
+            ('users-detail', 'get', f'/api/users/{self.author.pk}/', None),
+            ('users-me', 'get', '/api/users/me/', None),
+            ('users-create', 'post', '/api/users/', {
+                'username': 'new{run}{iteration}',
+                'email': 'new{run}{iteration}@bench.ru',
+                'first_name': 'Имя', 'last_name': 'Фамилия',
+                'password': PASSWORD,
+            }),
+            ('users-set-password', 'post', '/api/users/set_password/', {
+                'current_password': PASSWORD, 'new_password': PASSWORD,
+            }),
+            ('users-subscriptions', 'get', '/api/users/subscriptions/',
+             None),
+            ('users-subscribe', 'post',
+             f'/api/users/{self.author.pk}/subscribe/', None),
+            ('users-unsubscribe', 'delete',
+             f'/api/users/{self.author.pk}/subscribe/', None),
+            ('auth-token-login', 'post', '/api/auth/token/login/', {
+                'email': self.user.email, 'password': PASSWORD,
+            }),
+        ]
+
+    def request(self, client, method, url, data, context):
+        url = url.format(**context)
+        if isinstance(data, dict):
+            data = {
+                key: value.format(**context) if isinstance(value, str)
+                else value
+                for key, value in data.items()
+            }
+        response = getattr(client, method)(url, data, format='json')
+        if response.streaming:
+            b''.join(response.streaming_content)
+        if method == 'post' and url == '/api/recipes/':
+            context['created'] = response.data['id']
+        return response
+
+    def run_benchmarks(self, iterations):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        context = {'created': 0, 'iteration': 0, 'run': secrets.token_hex(4)}
+        endpoints = self.endpoints()
+        results = {}
+        # Первый проход измеряет запросы и память, остальные — только время,
+        # чтобы инструментирование не искажало задержку.
+        samples = {name: [] for name, *_ in endpoints}
+        for iteration in range(iterations + 1):
+            context['iteration'] = iteration
+            for name, method, url, data in endpoints:
+                if iteration == 0:
+                    tracemalloc.start()
+                    with CaptureQueriesContext(connection) as queries:
+                        response = self.request(
+                            client, method, url, data, context)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    results[name] = {
+                        'status': response.status_code,
+                        'queries': len(queries),
+                        'peak_memory_kb': round(peak / 1024, 1),
+                    }
+                    continue
+                started = time.perf_counter()
+                self.request(client, method, url, data, context)
+                samples[name].append(
+                    (time.perf_counter() - started) * 1000)
+        for name, values in samples.items():
+            if not values:
+                values = [0.0]
+            results[name]['p50_ms'] = round(percentile(values, 50), 3)
+            results[name]['p95_ms'] = round(percentile(values, 95), 3)
+        return results
+
+    def compare(self, results, baseline_path, threshold):
+        with open(baseline_path, encoding='utf-8') as file:
+            baseline = json.load(file)['endpoints']
+        regressions = 0
+        for name, result in results.items():
+            old = baseline.get(name)
+            if old is None:
+                self.stdout.write(f'+ {name}: нет в базовом прогоне')
+                continue
+            changes = []
+            if result['status'] != old['status']:
+                changes.append(f'статус {old["status"]} -> '
+                               f'{result["status"]}')
+            if result['queries'] > old['queries']:
+                changes.append(f'запросов {old["queries"]} -> '
+                               f'{result["queries"]}')
+            for key in ('p95_ms', 'peak_memory_kb'):
+                if result[key] > old[key] * (1 + threshold):
+                    changes.append(f'{key} {old[key]} -> {result[key]}')
+            if changes:
+                regressions += 1
+                self.stdout.write(f'- {name}: ' + ', '.join(changes))
+        if regressions:
+            raise CommandError(f'Регрессий относительно {baseline_path}: '
+                               f'{regressions}')
+        self.stdout.write('Регрессий относительно базового прогона нет')
@@ -0,0 +1,217 @@
+import asyncio
+import json
+import secrets
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from django.urls import include, path
+
+from recipes.async_views import use_async_reads
+from recipes.management.commands.bench import percentile
+from recipes.seeding import Seeder
+from recipes.urls import router
+
+
+class SyncUrlconf:
+    urlpatterns = [path('api/', include(router.get_urls()))]
+
+
+class AsyncUrlconf:
+    urlpatterns = [path('api/', include(use_async_reads(router.get_urls())))]
+
+
+class DatabaseLatency:
+    """
+    Обёртка execute_wrapper, которая задерживает каждый SQL-запрос, как
+    сетевая задержка до удалённой БД. Подключается ко всем новым
+    соединениям, в том числе в потоках серверов.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.active = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.active:
+            time.sleep(self.seconds)
+        return execute(sql, params, many, context)
+
+    def connection_created(self, sender, connection, **kwargs):
+        # Соединение создаётся внутри execute_wrapper() других обёрток,
+        # которые при выходе снимают последнюю из списка, поэтому задержка
+        # ставится первой.
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.insert(0, self)
+
+    def __enter__(self):
+        self.active = True
+        connection_created.connect(self.connection_created)
+        return self
+
+    def __exit__(self, *exc_info):
+        # Соединения потоков могут пережить замер, поэтому обёртка
+        # остаётся в них, но больше не задерживает запросы.
+        self.active = False
+        connection_created.disconnect(self.connection_created)
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает пропускную способность одного процесса сервера при '
+            'синхронной обработке (WSGI) и асинхронном чтении (ASGI) при '
+            'заданной задержке SQL-запросов.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--recipes', type=int, default=200)
+        parser.add_argument(
+            '--ingredients-file',
+            default=settings.BASE_DIR.parent / 'data' / 'ingredients.csv',
+        )
+        parser.add_argument(
+            '--path', action='append', dest='paths',
+            help='Адрес для запросов, можно указать несколько раз. '
+                 'По умолчанию — первая страница ленты рецептов.'
+        )
+        parser.add_argument(
+            '--requests', type=int, default=200,
+            help='Сколько запросов отправить в каждом режиме.'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=32,
+            help='Число одновременных клиентов.'
+        )
+        parser.add_argument(
+            '--db-latency', type=float, default=5,
+            help='Задержка каждого SQL-запроса, мс.'
+        )
+        parser.add_argument(
+            '--wsgi-threads', type=int, default=1,
+            help='Потоков синхронного процесса: 1 для sync-воркера '
+                 'gunicorn, --threads для gthread.'
+        )
+        parser.add_argument(
+            '--output',
+            help='Файл для результатов в формате JSON.'
+        )
+        parser.add_argument(
+            '--current-db', action='store_true',
+            help='Работать в текущей базе, а не во временной тестовой. '
+                 'Созданные данные останутся в базе.'
+        )
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or ['/api/recipes/']
+        old_name = None
+        if not options['current_db']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # Без кэша ответов, иначе запросы анонимов не дойдут до БД.
+            with override_settings(
+                    ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+                    MEDIA_ROOT=tempfile.mkdtemp(), RECIPE_IMAGE_WORKERS=0,
+                    RECIPE_RESPONSE_CACHE_TIMEOUT=0):
+                Seeder(prefix=f'concurrency{secrets.token_hex(4)}-',
+                       ingredients_file=options['ingredients_file']).run(
+                    users=options['users'], recipes=options['recipes'],
+                    ingredients_per_recipe=8, favorites=0, shopping_carts=0,
+                    subscriptions=0,
+                )
+                with DatabaseLatency(options['db_latency'] / 1000):
+                    results = {
+                        'wsgi': self.run_wsgi(paths, options),
+                        'asgi': self.run_asgi(paths, options),
+                    }
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+        for mode, result in results.items():
+            self.stdout.write(
+                f'{mode:<5} {result["rps"]:8.1f} запросов/с  '
+                f'p50 {result["p50_ms"]:8.2f} мс  '
+                f'p95 {result["p95_ms"]:8.2f} мс  '
+                f'ошибок {result["errors"]}'
+            )
+        if options['output']:
+            report = {
+                'paths': paths,
+                'requests': options['requests'],
+                'concurrency': options['concurrency'],
+                'db_latency_ms': options['db_latency'],
+                'wsgi_threads': options['wsgi_threads'],
+                'asgi_threads': settings.ASYNC_READ_THREADS,
+                'database': connection.vendor,
+                'modes': results,
+            }
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                json.dump(report, file, ensure_ascii=False, indent=2)
+
+    def run_wsgi(self, paths, options):
+        """
+        Синхронный процесс: запросы ждут свободный поток из wsgi-threads,
+        как в очереди sync-воркера gunicorn.
+        """
+        clients = threading.local()
+
+        def get(url):
+            if not hasattr(clients, 'client'):
+                clients.client = Client()
+            try:
+                return clients.client.get(url).status_code
+            finally:
+                # Сервер с CONN_MAX_AGE=0 закрывает соединение после
+                # каждого запроса.
+                connection.close()
+
+        with ThreadPoolExecutor(options['wsgi_threads']) as executor:
+            async def send(client, url):
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(executor, get, url)
+
+            with override_settings(ROOT_URLCONF=SyncUrlconf):
+                return asyncio.run(self.drive(
+                    send, lambda: None, paths, options))
+
+    def run_asgi(self, paths, options):
+        async def send(client, url):
+            return (await client.get(url)).status_code
+
+        with override_settings(ROOT_URLCONF=AsyncUrlconf):
+            return asyncio.run(self.drive(send, AsyncClient, paths, options))
+
+    async def drive(self, send, make_client, paths, options):
+        """
+        Закрытый цикл нагрузки: concurrency клиентов отправляют запросы
+        один за другим, пока не будет отправлено requests запросов.
+        """
+        remaining = iter(range(options['requests']))
+        latencies = []
+        errors = 0
+
+        async def client():
+            nonlocal errors
+            state = make_client()
+            for number in remaining:
+                started = time.perf_counter()
+                status = await send(state, paths[number % len(paths)])
+                latencies.append(time.perf_counter() - started)
+                errors += status >= 400
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client()
+                               for _ in range(options['concurrency'])))
+        elapsed = time.perf_counter() - started
+        return {
+            'rps': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'errors': errors,
+        }
@@ -0,0 +1,175 @@
+import os
+import posixpath
+import re
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from recipes.images import (FORMAT_EXTENSIONS, RESIZED_IMAGES_DIR,
+                            cached_file_digest, resized_image_digest)
+from recipes.models import Recipe
+
+
+def scan_files(path):
+    """Обходит каталог потоком, не загружая список файлов в память."""
+    directories = [path]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+
+
+class Command(BaseCommand):
+    help = ('Удаляет из MEDIA_ROOT изображения, на которые не ссылается '
+            'ни один рецепт, их варианты и уменьшенные копии.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только посчитать осиротевшие файлы, ничего не удалять.'
+        )
+        parser.add_argument(
+            '--grace-period', type=int,
+            default=settings.MEDIA_ORPHAN_GRACE_PERIOD,
+            help='Не трогать файлы, изменённые позже этого числа секунд назад.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Сколько файлов сверять с базой за один запрос.'
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.deadline = time.time() - options['grace_period']
+        self.variant_suffixes = [
+            f'.{kind}.{FORMAT_EXTENSIONS[variant["format"]]}'
+            for kind, variant in settings.RECIPE_IMAGE_VARIANTS.items()
+        ]
+        self.stats = dict.fromkeys(
+            ('scanned', 'recent', 'referenced', 'orphaned', 'bytes'), 0)
+        self.upload_to = Recipe._meta.get_field('image').upload_to
+        self.collect(os.path.join(settings.MEDIA_ROOT, self.upload_to),
+                     self.collect_batch, options['batch_size'])
+        resized_root = os.path.join(settings.MEDIA_ROOT, RESIZED_IMAGES_DIR)
+        if os.path.isdir(resized_root):
+            # Хэши собираются до обхода копий: копии изображений,
+            # загруженных позже, новее deadline и не удаляются.
+            self.legacy_digests = self.get_legacy_digests(
+                options['batch_size'])
+            self.collect(resized_root, self.collect_resized,
+                         options['batch_size'])
+        action = 'найдено' if self.dry_run else 'удалено'
+        self.stdout.write(
+            f'Просмотрено файлов: {self.stats["scanned"]}, '
+            f'недавних: {self.stats["recent"]}, '
+            f'используется: {self.stats["referenced"]}, '
+            f'осиротевших {action}: {self.stats["orphaned"]} '
+            f'({self.stats["bytes"]} байт)'
+        )
+
+    def collect(self, root, collect_batch, batch_size):
+        batch = []
+        if os.path.isdir(root):
+            for entry in scan_files(root):
+                self.stats['scanned'] += 1
+                if entry.stat().st_mtime > self.deadline:
+                    self.stats['recent'] += 1
+                    continue
+                batch.append(entry)
+                if len(batch) >= batch_size:
+                    collect_batch(batch)
+                    batch = []
+        if batch:
+            collect_batch(batch)
+
+    def get_legacy_digests(self, chunk_size):
+        """
+        Хэши изображений, загруженных до ContentAddressedStorage. Имя
+        такого файла не содержит хэша, поэтому файл приходится читать;
+        хэш кэшируется, и неизменившиеся файлы читаются один раз.
+        Хэши изображений с хэшем в имени сверяются с базой по пакетам
+        в referenced_digests.
+        """
+        digests = set()
+        content_addressed = (
+            rf'^{re.escape(self.upload_to)}[0-9a-f]{{64}}(\.[^/.]*)?$')
+        names = Recipe.objects.exclude(image='').exclude(
+            image__regex=content_addressed,
+        ).values_list('image', flat=True).distinct().order_by()
+        for name in names.iterator(chunk_size=chunk_size):
+            try:
+                digests.add(cached_file_digest(default_storage, name))
+            except FileNotFoundError:
+                continue
+        return digests
+
+    def referenced_digests(self, digests):
+        """Хэши из digests, изображения с которыми используются рецептами."""
+        query = Q()
+        for digest in digests:
+            name = f'{self.upload_to}{digest}'
+            query |= Q(image=name) | Q(image__startswith=f'{name}.')
+        referenced = digests & self.legacy_digests
+        if query:
+            names = Recipe.objects.filter(query).values_list(
+                'image', flat=True)
+            referenced.update(
+                posixpath.splitext(posixpath.basename(name))[0]
+                for name in names
+            )
+        return referenced
+
+    def source_name(self, name):
+        """Имя оригинала, к которому относится файл варианта."""
+        for suffix in self.variant_suffixes:
+            if name.endswith(suffix):
+                return name[:-len(suffix)]
+        return name
+
+    def collect_resized(self, entries):
+        digests = {
+            entry.path: resized_image_digest(entry.name) for entry in entries
+        }
+        referenced = self.referenced_digests(
+            {digest for digest in digests.values() if digest})
+        for entry in entries:
+            digest = digests[entry.path]
+            if digest is None or digest in referenced:
+                self.stats['referenced'] += 1
+                continue
+            self.remove(entry)
+
+    def collect_batch(self, entries):
+        sources = {}
+        for entry in entries:
+            name = os.path.relpath(entry.path, settings.MEDIA_ROOT)
+            sources[entry.path] = self.source_name(
+                name.replace(os.sep, '/'))
+        referenced = set(Recipe.objects.filter(
+            image__in=set(sources.values())
+        ).values_list('image', flat=True))
+        for entry in entries:
+            if sources[entry.path] in referenced:
+                self.stats['referenced'] += 1
+                continue
+            self.remove(entry)
+
+    def remove(self, entry):
+        try:
+            stat = os.stat(entry.path)
+            # Файл мог быть переиспользован загрузкой после начала обхода.
+            if stat.st_mtime > self.deadline:
+                self.stats['recent'] += 1
+                return
+            if not self.dry_run:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            return
+        self.stats['orphaned'] += 1
+        self.stats['bytes'] += stat.st_size
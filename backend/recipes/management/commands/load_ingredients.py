@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from recipes.ingredient_loader import load_ingredients, read_ingredients
+
+
+class Command(BaseCommand):
+    help = ('Загружает справочник ингредиентов из CSV или JSON: '
+            'добавляет недостающие, существующие не дублирует.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?',
+            default=settings.BASE_DIR.parent / 'data' / 'ingredients.csv',
+            help='Файл .csv (название, единица измерения) или .json.'
+        )
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        try:
+            stats = load_ingredients(read_ingredients(options['path']),
+                                     batch_size=options['batch_size'])
+        except (OSError, ValueError, AttributeError) as error:
+            raise CommandError(
+                f'Не удалось загрузить {options["path"]}: {error}')
+        self.stdout.write(
+            f'Прочитано {stats["read"]}, добавлено {stats["created"]}, '
+            f'повторов {stats["duplicates"]}, пропущено {stats["skipped"]} '
+            f'за {stats["elapsed"]:.2f} с'
+        )
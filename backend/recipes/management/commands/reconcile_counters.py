@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from recipes.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = 'Сверяет денормализованные счётчики и исправляет расхождения.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только показать расхождения, ничего не исправлять.'
+        )
+
+    def handle(self, *args, **options):
+        drift = reconcile_counters(repair=not options['dry_run'])
+        for counter, count in drift.items():
+            self.stdout.write(f'{counter}: расхождений {count}')
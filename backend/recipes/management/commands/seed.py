@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recipes.models import (Favorite, Recipe, RecipeIngredient, ShoppingCart,
+                            Subscription)
+from recipes.seeding import Seeder
+
+
+class Command(BaseCommand):
+    help = ('Наполняет базу детерминированными синтетическими данными '
+            'для нагрузочного тестирования.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--recipes', type=int, default=10000)
+        parser.add_argument('--ingredients-per-recipe', type=int, default=10)
+        parser.add_argument('--favorites', type=int, default=50000)
+        parser.add_argument('--shopping-carts', type=int, default=5000)
+        parser.add_argument('--subscriptions', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument(
+            '--prefix', default='seed',
+            help='Префикс имён создаваемых пользователей.'
+        )
+        parser.add_argument(
+            '--ingredients-file',
+            default=settings.BASE_DIR.parent / 'data' / 'ingredients.csv',
+            help='CSV с ингредиентами, если таблица ингредиентов пуста.'
+        )
+        parser.add_argument(
+            '--defer-indexes', action='store_true',
+            help='Удалить вторичные индексы на время загрузки.'
+        )
+
+    def handle(self, *args, **options):
+        seeder = Seeder(
+            seed=options['seed'], batch_size=options['batch_size'],
+            prefix=options['prefix'],
+            ingredients_file=options['ingredients_file'],
+            log=self.stdout.write,
+        )
+        counts = {
+            key: options[key] for key in (
+                'users', 'recipes', 'ingredients_per_recipe', 'favorites',
+                'shopping_carts', 'subscriptions',
+            )
+        }
+        with transaction.atomic():
+            if options['defer_indexes']:
+                with seeder.deferred_indexes((
+                        Recipe, RecipeIngredient, Favorite, ShoppingCart,
+                        Subscription)):
+                    seeder.load(**counts)
+            else:
+                seeder.load(**counts)
+            seeder.finish()
@@ -0,0 +1,92 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from recipes.models import (RecipeIngredient, ShoppingCart,
+                            ShoppingCartIngredient)
+from recipes.shopping_list import bump_cart_version
+
+
+class Command(BaseCommand):
+    help = ('Сверяет итоги списков покупок с полным пересчётом '
+            'и при --repair исправляет расхождения.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--repair', action='store_true',
+            help='Исправить найденные расхождения.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Сколько пользователей проверять за один проход.'
+        )
+
+    def handle(self, *args, **options):
+        user_ids = ShoppingCart.objects.values_list(
+            'user_id', flat=True
+        ).order_by().union(
+            ShoppingCartIngredient.objects.values_list(
+                'user_id', flat=True).order_by()
+        ).order_by('user_id')
+        checked = mismatched = 0
+        batch = []
+        for user_id in user_ids.iterator():
+            batch.append(user_id)
+            if len(batch) >= options['batch_size']:
+                mismatched += self.check_batch(batch, options['repair'])
+                checked += len(batch)
+                batch = []
+        if batch:
+            mismatched += self.check_batch(batch, options['repair'])
+            checked += len(batch)
+        action = 'исправлено' if options['repair'] else 'найдено'
+        self.stdout.write(
+            f'Проверено пользователей: {checked}, '
+            f'расхождений {action}: {mismatched}'
+        )
+
+    @staticmethod
+    def expected_totals(user_ids):
+        totals = RecipeIngredient.objects.filter(
+            recipe__shopping_carts__user__in=user_ids
+        ).values(
+            'recipe__shopping_carts__user', 'ingredient'
+        ).annotate(total=Sum('amount')).order_by()
+        return {
+            (row['recipe__shopping_carts__user'], row['ingredient']): (
+                row['total'])
+            for row in totals
+        }
+
+    def check_batch(self, user_ids, repair):
+        with transaction.atomic():
+            expected = self.expected_totals(user_ids)
+            actual = {
+                (row.user_id, row.ingredient_id): row
+                for row in ShoppingCartIngredient.objects.select_for_update(
+                ).filter(user_id__in=user_ids)
+            }
+            to_create, to_update = [], []
+            for key, total in expected.items():
+                row = actual.get(key)
+                if row is None:
+                    to_create.append(ShoppingCartIngredient(
+                        user_id=key[0], ingredient_id=key[1], amount=total))
+                elif row.amount != total:
+                    row.amount = total
+                    to_update.append(row)
+            to_delete = [
+                row.pk for key, row in actual.items() if key not in expected
+            ]
+            broken_users = {
+                row.user_id for row in to_create + to_update
+            } | {key[0] for key in actual.keys() - expected.keys()}
+            if repair and broken_users:
+                ShoppingCartIngredient.objects.bulk_create(to_create)
+                ShoppingCartIngredient.objects.bulk_update(
+                    to_update, ['amount'])
+                ShoppingCartIngredient.objects.filter(
+                    pk__in=to_delete).delete()
+                for user_id in broken_users:
+                    bump_cart_version(user_id)
+        return len(to_create) + len(to_update) + len(to_delete)
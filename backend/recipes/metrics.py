@@ -0,0 +1,171 @@
+import threading
+from bisect import bisect_left
+
+from foodgram.db.pool import WAIT_BUCKETS, get_pools
+
+# Границы корзин гистограмм по умолчанию, как в клиентах Prometheus.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75,
+                    1.0, 2.5, 5.0, 7.5, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+LABELS = ('view', 'action', 'method')
+
+
+class Histogram:
+    """Гистограмма с накопительными корзинами в формате Prometheus."""
+
+    def __init__(self, name, documentation, buckets, label_names=LABELS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.label_names = label_names
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            # [счётчики корзин..., +Inf, сумма]
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} histogram']
+        for labels, series in sorted(self.series.items()):
+            label_text = format_labels(labels, self.label_names)
+            total = 0
+            for bound, count in zip((*self.buckets, '+Inf'), series):
+                total += count
+                lines.append(f'{self.name}_bucket'
+                             f'{{{label_text},le="{bound}"}} {total}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {series[-1]}')
+            lines.append(f'{self.name}_count{{{label_text}}} {total}')
+        return lines
+
+
+class Counter:
+    type = 'counter'
+    suffix = '_total'
+
+    def __init__(self, name, documentation,
+                 label_names=(*LABELS, 'status')):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.series = {}
+
+    def inc(self, labels):
+        self.series[labels] = self.series.get(labels, 0) + 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.type}']
+        for labels, value in sorted(self.series.items()):
+            lines.append(f'{self.name}{self.suffix}'
+                         f'{{{format_labels(labels, self.label_names)}}} '
+                         f'{value}')
+        return lines
+
+
+class Gauge(Counter):
+    type = 'gauge'
+    suffix = ''
+
+
+def format_labels(labels, names=LABELS):
+    return ','.join(
+        f'{name}="{escape(value)}"' for name, value in zip(names, labels))
+
+
+def escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def render_counter(name, documentation, label, values):
+    """Счётчик с одной меткой label из словаря значение метки -> число."""
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} counter']
+    for value, count in sorted(values.items()):
+        lines.append(f'{name}_total{{{label}="{escape(value)}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+class RequestMetrics:
+    """
+    Метрики запросов по маршрутам (представление и действие) в памяти
+    процесса. При нескольких процессах сервера каждый отдаёт свои
+    значения, Prometheus различает их по адресу цели.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = Counter(
+                'foodgram_requests', 'Обработанные запросы.')
+            self.duration = Histogram(
+                'foodgram_request_duration_seconds',
+                'Полное время обработки запроса.', DURATION_BUCKETS)
+            self.db_duration = Histogram(
+                'foodgram_request_db_duration_seconds',
+                'Время SQL-запросов за запрос.', DURATION_BUCKETS)
+            self.queries = Histogram(
+                'foodgram_request_queries',
+                'Число SQL-запросов за запрос.', QUERY_BUCKETS)
+            self.render_duration = Histogram(
+                'foodgram_request_render_duration_seconds',
+                'Время рендеринга ответа.', DURATION_BUCKETS)
+
+    def observe(self, labels, status, duration, db_duration, queries,
+                render_duration):
+        with self._lock:
+            self.requests.inc((*labels, status))
+            self.duration.observe(labels, duration)
+            self.db_duration.observe(labels, db_duration)
+            self.queries.observe(labels, queries)
+            if render_duration is not None:
+                self.render_duration.observe(labels, render_duration)
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for metric in (self.requests, self.duration, self.db_duration,
+                           self.queries, self.render_duration):
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def render_pool_metrics():
+    """
+    Метрики пулов соединений с БД процесса (foodgram/db/pool.py):
+    открытия, переиспользования и закрытия соединений, ожидание свободного
+    соединения и текущий размер пула.
+    """
+    label_names = ('alias', 'database')
+    events = Counter('foodgram_db_pool_events',
+                     'События пула соединений с БД.',
+                     (*label_names, 'event'))
+    waits = Histogram('foodgram_db_pool_wait_seconds',
+                      'Ожидание соединения из пула.', WAIT_BUCKETS,
+                      label_names)
+    connections = Gauge('foodgram_db_pool_connections',
+                        'Соединения пула по состоянию.',
+                        (*label_names, 'state'))
+    for (alias, name), pool in get_pools().items():
+        labels = (alias, name)
+        for event, value in pool.counters.items():
+            events.series[(*labels, event)] = value
+        waits.series[labels] = list(pool.waits)
+        idle = pool.idle
+        connections.series[(*labels, 'idle')] = idle
+        connections.series[(*labels, 'in_use')] = pool.size - idle
+        connections.series[(*labels, 'max')] = pool.max_size
+    lines = []
+    for metric in (events, waits, connections):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from .metrics import request_metrics
+
+HTTP_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+
+class QueryTimer:
+    """Обёртка execute_wrapper: считает SQL-запросы и их суммарное время."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+
+
+class RequestMetricsMiddleware:
+    """
+    Измеряет полное время запроса, время и число SQL-запросов и время
+    рендеринга ответа. Отдаёт их в заголовке Server-Timing и добавляет
+    в гистограммы по маршрутам (см. metrics.py и /api/metrics).
+
+    Работает и в асинхронном стеке: синхронные представления выполняются
+    в потоке запроса, и таймер подключается к соединению этого потока, а
+    асинхронные выполняют запросы к БД в своих потоках и подключают
+    таймер из request сами (см. async_views.py).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Так Django распознаёт асинхронный экземпляр, как в
+            # MiddlewareMixin.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        timer = self.start(request)
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        return self.finish(request, response, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        timer = self.start(request)
+        # ASGIHandler выполняет синхронный код запроса (представления,
+        # sync_to_async с thread_sensitive) в одном потоке со своим
+        # соединением с БД, поэтому таймер ставится и снимается там же.
+        await sync_to_async(add_execute_wrapper)(timer)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(remove_execute_wrapper)(timer)
+        return self.finish(request, response, started)
+
+    @staticmethod
+    def start(request):
+        request._metrics_timer = QueryTimer()
+        request._metrics_render = None
+        return request._metrics_timer
+
+    @staticmethod
+    def finish(request, response, started):
+        duration = time.perf_counter() - started
+        timer = request._metrics_timer
+        render = request._metrics_render
+        timings = [f'app;dur={duration * 1000:.1f}',
+                   f'db;dur={timer.duration * 1000:.1f};'
+                   f'desc="{timer.count} queries"']
+        if render is not None:
+            timings.append(f'render;dur={render * 1000:.1f}')
+        response['Server-Timing'] = ', '.join(timings)
+        request_metrics.observe(
+            route_labels(request), response.status_code, duration,
+            timer.duration, timer.count, render)
+        return response
+
+    def process_template_response(self, request, response):
+        # Django вызывает render() сразу после этого метода, а колбэки
+        # после рендеринга — сразу по его окончании.
+        started = time.perf_counter()
+
+        def rendered(response):
+            request._metrics_render = time.perf_counter() - started
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+def add_execute_wrapper(wrapper):
+    connection.execute_wrappers.append(wrapper)
+
+
+def remove_execute_wrapper(wrapper):
+    connection.execute_wrappers.remove(wrapper)
+
+
+def route_labels(request):
+    """
+    Метки маршрута: имя URL (шаблон, а не конкретный адрес, чтобы число
+    рядов не зависело от данных) и действие viewset, если оно есть.
+    """
+    method = request.method if request.method in HTTP_METHODS else 'OTHER'
+    match = request.resolver_match
+    if match is None:
+        return 'unmatched', '', method
+    actions = getattr(match.func, 'actions', None) or {}
+    return match.view_name, actions.get(method.lower(), ''), method
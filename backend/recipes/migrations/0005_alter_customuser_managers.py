@@ -0,0 +1,20 @@
+# Generated by Django 4.0.1 on 2026-10-18 17:59
+
+from django.db import migrations
+import recipes.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_recipeingredient_unique_recipe_ingredient'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='customuser',
+            managers=[
+                ('objects', recipes.models.CustomUserManager()),
+            ],
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.0.1 on 2026-10-18 18:05
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+# (модель, поле счётчика, считаемая модель, поле связи с моделью)
+COUNTERS = (
+    ('Recipe', 'favorites_count', 'Favorite', 'recipe'),
+    ('Recipe', 'shopping_carts_count', 'ShoppingCart', 'recipe'),
+    ('CustomUser', 'recipes_count', 'Recipe', 'author'),
+    ('CustomUser', 'subscribers_count', 'Subscription', 'author'),
+)
+
+
+def fill_counters(apps, schema_editor):
+    for model_name, field, source_name, link in COUNTERS:
+        model = apps.get_model('recipes', model_name)
+        source = apps.get_model('recipes', source_name)
+        model.objects.update(**{field: Coalesce(
+            Subquery(
+                source.objects.filter(
+                    **{link: OuterRef('pk')}
+                ).order_by().values(link).annotate(
+                    count=Count('pk')
+                ).values('count')
+            ),
+            0
+        )})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_shoppingcartingredient_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='recipes_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Рецептов'),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='subscribers_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Подписчиков'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False, verbose_name='В избранном'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='shopping_carts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В списках покупок'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.1 on 2026-10-18 18:13
+
+from django.db import migrations, models
+import recipes.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_recipe_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='image',
+            field=models.ImageField(storage=recipes.storage.ContentAddressedStorage(), upload_to='images/', verbose_name='Изображение'),
+        ),
+    ]
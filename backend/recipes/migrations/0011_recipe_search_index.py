@@ -0,0 +1,60 @@
+from django.db import migrations
+
+FTS_TABLE = 'recipes_recipe_fts'
+SEARCH_VECTOR_COLUMN = 'search_vector'
+SEARCH_VECTOR_INDEX = 'recipe_search_vector_idx'
+
+
+def create_index(apps, schema_editor):
+    """
+    На PostgreSQL добавляет вычисляемую колонку tsvector по названию и
+    описанию рецепта (конфигурация russian) с GIN-индексом, на SQLite —
+    таблицу FTS5, которую поддерживают сигналы сохранения рецепта.
+    """
+    table = apps.get_model('recipes', 'Recipe')._meta.db_table
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            f'ALTER TABLE {table} ADD COLUMN {SEARCH_VECTOR_COLUMN} tsvector '
+            "GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('russian', coalesce(name, '')), 'A') || "
+            "setweight(to_tsvector('russian', coalesce(text, '')), 'B')"
+            ') STORED'
+        )
+        schema_editor.execute(
+            f'CREATE INDEX {SEARCH_VECTOR_INDEX} ON {table} '
+            f'USING GIN ({SEARCH_VECTOR_COLUMN})'
+        )
+    elif vendor == 'sqlite':
+        # unicode61 не приводит «ё» к «е», поэтому таблица FTS5 хранит
+        # нормализованный текст.
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5('
+            f"name, text, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        schema_editor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, name, text) '
+            "SELECT id, REPLACE(REPLACE(name, 'ё', 'е'), 'Ё', 'Е'), "
+            f"REPLACE(REPLACE(text, 'ё', 'е'), 'Ё', 'Е') FROM {table}"
+        )
+
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        table = apps.get_model('recipes', 'Recipe')._meta.db_table
+        schema_editor.execute(
+            f'ALTER TABLE {table} DROP COLUMN {SEARCH_VECTOR_COLUMN}')
+    elif vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_recipe_image_content_addressed'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
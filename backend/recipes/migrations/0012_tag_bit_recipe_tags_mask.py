@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+
+def fill_tags_masks(apps, schema_editor):
+    Tag = apps.get_model('recipes', 'Tag')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    tags = list(Tag.objects.order_by('pk'))
+    if len(tags) > 63:
+        raise RuntimeError('Маска тегов вмещает не больше 63 тегов')
+    for bit, tag in enumerate(tags):
+        tag.bit = bit
+    Tag.objects.bulk_update(tags, ['bit'])
+    masks = {}
+    for recipe_id, bit in Recipe.tags.through.objects.values_list(
+            'recipe_id', 'tag__bit'):
+        masks[recipe_id] = masks.get(recipe_id, 0) | 1 << bit
+    for recipe_id, mask in masks.items():
+        Recipe.objects.filter(pk=recipe_id).update(tags_mask=mask)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0011_recipe_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='bit',
+            field=models.PositiveSmallIntegerField(editable=False, null=True, verbose_name='Бит в маске тегов'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='tags_mask',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False, verbose_name='Маска тегов'),
+        ),
+        migrations.RunPython(fill_tags_masks, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='tag',
+            name='bit',
+            field=models.PositiveSmallIntegerField(editable=False, unique=True, verbose_name='Бит в маске тегов'),
+        ),
+    ]
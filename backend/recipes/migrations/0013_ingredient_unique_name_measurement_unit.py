@@ -0,0 +1,58 @@
+# Generated by Django 4.0.1 on 2026-10-18 18:34
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def merge_references(model, keep_id, duplicate_id, owner):
+    """
+    Переносит ссылки с дубликата на оставляемый ингредиент. Если у
+    владельца (рецепта или пользователя) есть оба, количества складываются.
+    """
+    for row in model.objects.filter(ingredient_id=duplicate_id):
+        kept = model.objects.filter(
+            ingredient_id=keep_id, **{owner: getattr(row, owner)}).first()
+        if kept is None:
+            row.ingredient_id = keep_id
+            row.save(update_fields=['ingredient'])
+        else:
+            kept.amount += row.amount
+            kept.save(update_fields=['amount'])
+            row.delete()
+
+
+def merge_duplicate_ingredients(apps, schema_editor):
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    RecipeIngredient = apps.get_model('recipes', 'RecipeIngredient')
+    ShoppingCartIngredient = apps.get_model(
+        'recipes', 'ShoppingCartIngredient')
+    duplicates = list(Ingredient.objects.values(
+        'name', 'measurement_unit'
+    ).annotate(keep_id=Min('id'), total=Count('id')).filter(
+        total__gt=1).order_by())
+    for group in duplicates:
+        for duplicate_id in list(Ingredient.objects.filter(
+                name=group['name'],
+                measurement_unit=group['measurement_unit'],
+        ).exclude(pk=group['keep_id']).values_list('pk', flat=True)):
+            merge_references(RecipeIngredient, group['keep_id'],
+                             duplicate_id, 'recipe_id')
+            merge_references(ShoppingCartIngredient, group['keep_id'],
+                             duplicate_id, 'user_id')
+            Ingredient.objects.filter(pk=duplicate_id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0012_tag_bit_recipe_tags_mask'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_ingredients,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='ingredient',
+            constraint=models.UniqueConstraint(fields=('name', 'measurement_unit'), name='unique_ingredient_name_measurement_unit'),
+        ),
+    ]
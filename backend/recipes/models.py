@@ -1,12 +1,37 @@
 from decimal import Decimal
 
 from django.contrib.auth import get_user_model
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
 from django.db import models
-from django.db.models import Exists, OuterRef
+from django.db.models import Exists, OuterRef, Subquery
 from django.utils.datetime_safe import date
 
+from .storage import ContentAddressedStorage
+
+# Маска тегов рецепта хранится в знаковом BigIntegerField.
+MAX_TAGS = 63
+# Наибольший первичный ключ (BigAutoField): большие id из запросов
+# отсекаются до ORM, иначе драйвер БД падает с OverflowError.
+MAX_PK = 2 ** 63 - 1
+
+
+class CustomUserQuerySet(models.QuerySet):
+    def add_subscription_annotation(self, user_id):
+        return self.annotate(
+            is_subscribed=Exists(
+                Subscription.objects.filter(
+                    user__id=user_id,
+                    author__pk=OuterRef('pk')
+                )
+            )
+        )
+
+
+class CustomUserManager(UserManager.from_queryset(CustomUserQuerySet)):
+    pass
+
 
 class CustomUser(AbstractUser):
     email = models.EmailField(verbose_name='Почта', unique=True)
@@ -14,10 +39,16 @@ class CustomUser(AbstractUser):
         verbose_name='Имя', max_length=150, blank=False)
     last_name = models.CharField(
         verbose_name='Фамилия', max_length=150, blank=False)
+    recipes_count = models.PositiveIntegerField(
+        verbose_name='Рецептов', default=0, editable=False)
+    subscribers_count = models.PositiveIntegerField(
+        verbose_name='Подписчиков', default=0, editable=False)
 
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name', 'password']
     USERNAME_FIELD = 'email'
 
+    objects = CustomUserManager()
+
     class Meta:
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
@@ -43,6 +74,11 @@ class Tag(models.Model):
         max_length=200,
         unique=True
     )
+    bit = models.PositiveSmallIntegerField(
+        verbose_name='Бит в маске тегов',
+        unique=True,
+        editable=False,
+    )
 
     class Meta:
         verbose_name = 'Тег'
@@ -51,6 +87,19 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if self.bit is None:
+            self.bit = self.free_bit()
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def free_bit(cls):
+        used = set(cls.objects.values_list('bit', flat=True))
+        for bit in range(MAX_TAGS):
+            if bit not in used:
+                return bit
+        raise ValidationError(f'Нельзя создать больше {MAX_TAGS} тегов')
+
 
 class Ingredient(models.Model):
     name = models.CharField(
@@ -65,12 +114,30 @@ class Ingredient(models.Model):
     class Meta:
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['name', 'measurement_unit'],
+                name='unique_ingredient_name_measurement_unit'
+            )
+        ]
 
     def __str__(self):
         return self.name
 
 
 class RecipeQuerySet(models.QuerySet):
+    def latest_per_author(self, limit):
+        """
+        Не более limit последних рецептов каждого автора одним запросом.
+        """
+        return self.filter(
+            pk__in=Subquery(
+                Recipe.objects.filter(
+                    author=OuterRef('author')
+                ).order_by('-pub_date', '-pk').values('pk')[:limit]
+            )
+        ).order_by('-pub_date', '-pk')
+
     def add_user_annotations(self, user_id):
         return self.annotate(
             is_favorited=Exists(
@@ -84,6 +151,12 @@ class RecipeQuerySet(models.QuerySet):
                     user__id=user_id,
                     recipe__pk=OuterRef('pk')
                 )
+            ),
+            author_is_subscribed=Exists(
+                Subscription.objects.filter(
+                    user__id=user_id,
+                    author__pk=OuterRef('author')
+                )
             )
         )
 
@@ -100,7 +173,17 @@ class Recipe(models.Model):
         verbose_name='Название',
         max_length=200,
     )
-    image = models.ImageField(verbose_name='Изображение', upload_to='images/')
+    image = models.ImageField(
+        verbose_name='Изображение',
+        upload_to='images/',
+        storage=ContentAddressedStorage(),
+    )
+    image_variants = models.JSONField(
+        verbose_name='Варианты изображения',
+        default=dict,
+        blank=True,
+        editable=False,
+    )
     text = models.TextField(
         verbose_name='Описание',
     )
@@ -114,19 +197,36 @@ class Recipe(models.Model):
         related_name='recipes',
         verbose_name='Теги',
     )
+    tags_mask = models.BigIntegerField(
+        verbose_name='Маска тегов',
+        default=0,
+        db_index=True,
+        editable=False,
+    )
     cooking_time = models.PositiveIntegerField(
         verbose_name='Время приготовления (в минутах)',
     )
     pub_date = models.DateField(default=date.today,
                                 verbose_name='Дата публикации',
                                 db_index=True)
+    favorites_count = models.PositiveIntegerField(
+        verbose_name='В избранном', default=0, editable=False,
+        db_index=True)
+    shopping_carts_count = models.PositiveIntegerField(
+        verbose_name='В списках покупок', default=0, editable=False)
 
     objects = RecipeQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
-        ordering = ['-pub_date']
+        ordering = ['-pub_date', '-id']
+        indexes = [
+            models.Index(
+                fields=['-pub_date', '-id'],
+                name='recipe_pub_date_id_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -233,3 +333,36 @@ class ShoppingCart(models.Model):
                 name='unique_shoppingCart_user_recipe'
             )
         ]
+
+
+class ShoppingCartIngredient(models.Model):
+    """
+    Суммарное количество ингредиента в списке покупок пользователя.
+    Поддерживается при изменении корзины и рецептов в ней.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="shopping_cart_ingredients",
+        verbose_name='Пользователь',
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        verbose_name='Ингредиент',
+    )
+    amount = models.DecimalField(
+        max_digits=12,
+        decimal_places=1,
+        verbose_name='Кол-во',
+    )
+
+    class Meta:
+        verbose_name = 'Ингредиент в списке покупок'
+        verbose_name_plural = 'Ингредиенты в списке покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_shopping_cart_ingredient'
+            )
+        ]
@@ -1,4 +1,14 @@
-from rest_framework.pagination import PageNumberPagination
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import date
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .models import MAX_PK
 
 
 class LimitPagination(PageNumberPagination):
@@ -8,3 +18,114 @@ class LimitPagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'limit'
     max_page_size = 100
+
+
+class RecipeCursorPagination(BasePagination):
+    """
+    Пагинация ленты рецептов по ключу (pub_date, id) без COUNT и OFFSET.
+    Курсоры next и previous непрозрачны для клиента.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = LimitPagination.page_size_query_param
+    page_size = LimitPagination.page_size
+    max_page_size = LimitPagination.max_page_size
+    invalid_cursor_message = 'Неверный курсор'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor[2]
+        if cursor is None:
+            queryset = queryset.order_by('-pub_date', '-pk')
+        elif reverse:
+            pub_date, pk, _ = cursor
+            queryset = queryset.filter(
+                Q(pub_date__gt=pub_date) | Q(pub_date=pub_date, pk__gt=pk)
+            ).order_by('pub_date', 'pk')
+        else:
+            pub_date, pk, _ = cursor
+            queryset = queryset.filter(
+                Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, pk__lt=pk)
+            ).order_by('-pub_date', '-pk')
+        results = list(queryset[:page_size + 1])
+        has_more = len(results) > page_size
+        results = results[:page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.page = results
+        return results
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            value = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            pub_date, pk, reverse = value.split(':')
+            pub_date, pk = date.fromisoformat(pub_date), int(pk)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not 0 < pk <= MAX_PK:
+            raise NotFound(self.invalid_cursor_message)
+        return pub_date, pk, reverse == 'r'
+
+    def encode_cursor(self, recipe, reverse):
+        value = f'{recipe.pub_date.isoformat()}:{recipe.pk}:'
+        value += 'r' if reverse else 'f'
+        return replace_query_param(
+            self.base_url, self.cursor_query_param,
+            urlsafe_b64encode(value.encode('ascii')).decode('ascii')
+        )
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+
+class RecipePagination(LimitPagination):
+    """
+    Постраничная пагинация page/limit, а при наличии параметра cursor
+    (в том числе пустого) — пагинация по ключу.
+    """
+    cursor_pagination_class = RecipeCursorPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_paginator = None
+        if self.cursor_pagination_class.cursor_query_param in (
+                request.query_params):
+            self.cursor_paginator = self.cursor_pagination_class()
+            return self.cursor_paginator.paginate_queryset(
+                queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
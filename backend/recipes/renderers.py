@@ -0,0 +1,37 @@
+from collections.abc import Iterator
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+class PassthroughRenderer(BaseRenderer):
+    """
+    Рендерер для выбора формата выгрузки через ?format= и Accept,
+    сами данные формирует представление. Ответы с ошибками (401, 404,
+    406), которые DRF отдаёт словарём, кодируются в JSON и отдаются
+    с типом application/json.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, (bytes, str, Iterator)):
+            return data
+        renderer = JSONRenderer()
+        response = (renderer_context or {}).get('response')
+        if response is not None:
+            response['Content-Type'] = renderer.media_type
+        return renderer.render(data)
+
+
+class PlainTextRenderer(PassthroughRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+
+class CSVRenderer(PassthroughRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class PDFRenderer(PassthroughRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
@@ -0,0 +1,160 @@
+import hashlib
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from rest_framework.response import Response
+
+from .generations import bump_generation_on_commit, get_generation
+from .models import Favorite, ShoppingCart, Subscription
+
+GENERATION = 'recipes'
+KEY_PREFIX = 'recipe-response'
+PAGE_KEY_PREFIX = 'recipe-page'
+# Параметры, от которых зависит ответ ленты. Запросы с другими
+# параметрами не кэшируются, чтобы случайные значения не засоряли кэш.
+CACHEABLE_PARAMS = {
+    'page', 'limit', 'cursor', 'tags', 'tags_match', 'author', 'search',
+    'is_favorited', 'is_in_shopping_cart', 'format',
+}
+# Фильтры по спискам пользователя: такую страницу нельзя разделить.
+PERSONAL_PARAMS = {'is_favorited', 'is_in_shopping_cart'}
+# Множества id из списков пользователя: модель, поле с id.
+USER_SETS = (
+    (Favorite, 'recipe_id'),
+    (ShoppingCart, 'recipe_id'),
+    (Subscription, 'author_id'),
+)
+USER_SETS_TIMEOUT = 60 * 60 * 24
+
+
+def invalidate_recipe_responses():
+    bump_generation_on_commit(GENERATION)
+
+
+def user_set_generation_name(model, user_id):
+    return f'{model._meta.model_name}-ids:{user_id}'
+
+
+def invalidate_user_set(model, user_id):
+    """Сбрасывает закэшированное множество id списка model пользователя."""
+    bump_generation_on_commit(user_set_generation_name(model, user_id))
+
+
+def get_user_sets(user_id):
+    """
+    Множества id избранных рецептов, рецептов в корзине и авторов из
+    подписок пользователя. Каждое хранится в кэше под своим поколением и
+    сбрасывается только изменением своего списка.
+    """
+    keys = [
+        f'{user_set_generation_name(model, user_id)}:'
+        f'{get_generation(user_set_generation_name(model, user_id))}'
+        for model, _ in USER_SETS
+    ]
+    cached = cache.get_many(keys)
+    sets = []
+    for key, (model, field) in zip(keys, USER_SETS):
+        ids = cached.get(key)
+        if ids is None:
+            ids = frozenset(model.objects.filter(
+                user_id=user_id).values_list(field, flat=True))
+            cache.set(key, ids, USER_SETS_TIMEOUT)
+        sets.append(ids)
+    return sets
+
+
+def response_cache_key(prefix, request, view):
+    """
+    Ключ ответа по нормализованным параметрам запроса. Ключ включает
+    поколение рецептов, поэтому запись рецепта, тега или ингредиента
+    делает недействительными все страницы сразу.
+    """
+    params = request.query_params
+    normalized = urlencode(sorted(
+        (key, value) for key in params for value in params.getlist(key)
+    ))
+    # Ссылки next/previous абсолютные, поэтому в ключе есть адрес сайта.
+    digest = hashlib.md5('|'.join((
+        request.build_absolute_uri(request.path), view.action,
+        request.accepted_media_type, normalized,
+    )).encode()).hexdigest()
+    return f'{prefix}:{get_generation(GENERATION)}:{digest}'
+
+
+def personalize(recipe, favorites, carts, subscriptions):
+    author = recipe['author']
+    return {
+        **recipe,
+        'is_favorited': recipe['id'] in favorites,
+        'is_in_shopping_cart': recipe['id'] in carts,
+        'author': {**author, 'is_subscribed': author['id'] in subscriptions},
+    }
+
+
+class RecipeResponseCacheMixin:
+    """
+    Кэширует ответы list и retrieve. Анонимным пользователям отдаются
+    готовые байты. Для авторизованных страница собирается один раз без
+    учёта пользователя и хранится общей, а is_favorited,
+    is_in_shopping_cart и is_subscribed подставляются из множеств id
+    пользователя (get_user_sets).
+
+    Счётчики избранного и покупок обновляются без сигналов и в
+    закэшированном ответе могут отставать на RECIPE_RESPONSE_CACHE_TIMEOUT
+    секунд.
+    """
+    # Представление строит страницу без аннотаций пользователя.
+    shared_page = False
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        params = set(request.query_params)
+        if (not settings.RECIPE_RESPONSE_CACHE_TIMEOUT
+                or not CACHEABLE_PARAMS.issuperset(params)):
+            return handler(request, *args, **kwargs)
+        if request.user.is_authenticated:
+            if PERSONAL_PARAMS & params:
+                return handler(request, *args, **kwargs)
+            return self.personalized_response(
+                handler, request, *args, **kwargs)
+        if request.accepted_renderer.format != 'json':
+            return handler(request, *args, **kwargs)
+        key = response_cache_key(KEY_PREFIX, request, self)
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            response.add_post_render_callback(lambda rendered: cache.set(
+                key, (rendered.content, rendered['Content-Type']),
+                settings.RECIPE_RESPONSE_CACHE_TIMEOUT
+            ))
+        return response
+
+    def personalized_response(self, handler, request, *args, **kwargs):
+        key = response_cache_key(PAGE_KEY_PREFIX, request, self)
+        data = cache.get(key)
+        if data is None:
+            self.shared_page = True
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            data = response.data
+            cache.set(key, data, settings.RECIPE_RESPONSE_CACHE_TIMEOUT)
+        sets = get_user_sets(request.user.pk)
+        if self.action == 'retrieve':
+            return Response(personalize(data, *sets))
+        return Response({
+            **data,
+            'results': [personalize(recipe, *sets)
+                        for recipe in data['results']],
+        })
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args,
+                                    **kwargs)
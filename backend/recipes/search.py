@@ -0,0 +1,94 @@
+import re
+
+from django.db import connection
+from django.db.models import F
+from django.db.models.expressions import RawSQL
+
+from .ingredient_index import normalize
+from .models import Recipe
+
+# Колонку tsvector (PostgreSQL) и таблицу FTS5 (SQLite) создаёт миграция
+# 0011_recipe_search_index.
+FTS_TABLE = 'recipes_recipe_fts'
+SEARCH_VECTOR_COLUMN = 'search_vector'
+MAX_SEARCH_WORDS = 10
+# Вес совпадения в названии относительно совпадения в описании.
+NAME_WEIGHT = 10.0
+# unicode61 не приводит «ё» к «е», поэтому таблица FTS5 хранит
+# нормализованный текст.
+FTS_SELECT = (
+    "SELECT id, REPLACE(REPLACE(name, 'ё', 'е'), 'Ё', 'Е'), "
+    "REPLACE(REPLACE(text, 'ё', 'е'), 'Ё', 'Е') FROM {table}"
+)
+
+
+def search_words(term):
+    return re.findall(r'\w+', normalize(term))[:MAX_SEARCH_WORDS]
+
+
+def index_recipe(recipe):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s',
+                       [recipe.pk])
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, name, text) '
+            'VALUES (%s, %s, %s)',
+            [recipe.pk, normalize(recipe.name), normalize(recipe.text)]
+        )
+
+
+def unindex_recipe(recipe_id):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s',
+                       [recipe_id])
+
+
+def rebuild_search_index():
+    """Перестраивает таблицу FTS5 после массовой записи в обход сигналов."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, name, text) '
+            + FTS_SELECT.format(table=Recipe._meta.db_table)
+        )
+
+
+def search_recipes(queryset, term):
+    """
+    Оставляет рецепты, в названии или описании которых есть все слова
+    запроса (в том числе как начало слова), и добавляет аннотацию
+    search_rank: чем больше, тем выше релевантность.
+    """
+    words = search_words(term)
+    if not words:
+        return queryset
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                                    SearchVectorField)
+
+        query = SearchQuery(
+            ' & '.join(f'{word}:*' for word in words),
+            config='russian', search_type='raw'
+        )
+        return queryset.alias(search_vector=RawSQL(
+            f'{Recipe._meta.db_table}.{SEARCH_VECTOR_COLUMN}', [],
+            output_field=SearchVectorField()
+        )).filter(search_vector=query).annotate(
+            search_rank=SearchRank(F('search_vector'), query))
+    match = ' '.join(f'"{word}"*' for word in words)
+    # bm25() доступна только в запросе с MATCH по самой таблице FTS5,
+    # поэтому таблица присоединяется к выборке, а не опрашивается
+    # коррелированным подзапросом для каждой строки.
+    return queryset.extra(
+        tables=[FTS_TABLE],
+        where=[f'{FTS_TABLE}.rowid = {Recipe._meta.db_table}.id',
+               f'{FTS_TABLE} MATCH %s'],
+        params=[match],
+        select={'search_rank': f'-bm25({FTS_TABLE}, {NAME_WEIGHT}, 1.0)'},
+    )
@@ -0,0 +1,317 @@
+import csv
+import random
+import time
+from bisect import bisect
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from io import StringIO
+from itertools import accumulate, islice
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Max
+
+from .counters import reconcile_counters
+from .ingredient_loader import load_ingredients, read_ingredients
+from .models import (Favorite, Ingredient, Recipe, RecipeIngredient,
+                     ShoppingCart, Subscription, Tag)
+from .response_cache import invalidate_recipe_responses
+from .search import rebuild_search_index
+from .tag_masks import tags_mask
+
+User = get_user_model()
+
+DEFAULT_TAGS = (
+    ('Завтрак', '#E26C2D', 'breakfast'),
+    ('Обед', '#49B64E', 'lunch'),
+    ('Ужин', '#8775D2', 'dinner'),
+)
+DISHES = ('Салат', 'Суп', 'Рагу', 'Пирог', 'Запеканка', 'Паста', 'Каша',
+          'Омлет', 'Плов', 'Котлеты')
+WORDS = ('нарезать', 'смешать', 'обжарить', 'потушить', 'добавить',
+         'посолить', 'запечь', 'подавать', 'горячим', 'охладить', 'минут',
+         'огонь', 'сковорода', 'кастрюля', 'духовка', 'тесто', 'соус')
+PUB_DATE_START = date(2020, 1, 1)
+PUB_DATE_DAYS = 3 * 365
+DATE_JOINED = datetime(2020, 1, 1, tzinfo=timezone.utc)
+PASSWORD = 'seed-Password-42'
+
+
+class ZipfSampler:
+    """
+    Выбор элементов с вероятностью 1 / rank ** exponent: немногие
+    элементы популярны, большинство — нет.
+    """
+
+    def __init__(self, items, rng, exponent=1.1):
+        self.items = items
+        self.rng = rng
+        self.cum_weights = list(accumulate(
+            1 / rank ** exponent for rank in range(1, len(items) + 1)
+        ))
+
+    def choice(self):
+        value = self.rng.random() * self.cum_weights[-1]
+        return self.items[bisect(self.cum_weights, value)]
+
+    def sample(self, count):
+        """До count различных элементов."""
+        chosen = set()
+        for _ in range(count * 3):
+            if len(chosen) >= count:
+                break
+            chosen.add(self.choice())
+        return chosen
+
+
+class Seeder:
+    """
+    Детерминированный генератор данных для нагрузочного тестирования.
+    Пишет пачками через bulk_create, а на PostgreSQL — через COPY FROM STDIN.
+    Производные данные (счётчики, итоги списков покупок, поисковый индекс)
+    пересчитываются в конце одним проходом.
+    """
+
+    def __init__(self, seed=1, batch_size=10000, prefix='seed',
+                 ingredients_file=None, log=None):
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.prefix = prefix
+        self.ingredients_file = ingredients_file
+        self.log = log or (lambda message: None)
+        self.stats = {}
+
+    def write_rows(self, model, fields, rows):
+        """Записывает кортежи значений полей fields пачками."""
+        fields = [model._meta.get_field(field) for field in fields]
+        columns = [field.column for field in fields]
+        attnames = [field.attname for field in fields]
+        started = time.perf_counter()
+        written = 0
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+            if connection.vendor == 'postgresql':
+                buffer = StringIO()
+                csv.writer(buffer).writerows(batch)
+                buffer.seek(0)
+                with connection.cursor() as cursor:
+                    cursor.copy_expert(
+                        f'COPY {model._meta.db_table} ({", ".join(columns)}) '
+                        f'FROM STDIN WITH (FORMAT csv)',
+                        buffer
+                    )
+            else:
+                model.objects.bulk_create(
+                    model(**dict(zip(attnames, row))) for row in batch)
+            written += len(batch)
+        elapsed = time.perf_counter() - started
+        self.stats[model._meta.model_name] = (written, elapsed)
+        self.log(f'{model._meta.model_name}: {written} строк за '
+                 f'{elapsed:.2f} с ({written / max(elapsed, 1e-9):.0f} '
+                 f'строк/с)')
+        return written
+
+    @contextmanager
+    def deferred_indexes(self, models):
+        """
+        Удаляет вторичные индексы таблиц models на время загрузки и создаёт
+        их заново в конце: построить индекс один раз быстрее, чем
+        обновлять его на каждую вставку. Индексы ограничений остаются.
+        """
+        tables = [model._meta.db_table for model in models]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    'SELECT i.indexname, i.indexdef FROM pg_indexes i '
+                    'WHERE i.tablename = ANY(%s) AND NOT EXISTS ('
+                    'SELECT 1 FROM pg_constraint c '
+                    'WHERE c.conindid = (quote_ident(i.schemaname) || '
+                    "'.' || quote_ident(i.indexname))::regclass)",
+                    [tables]
+                )
+            else:
+                cursor.execute(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                    "AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%%' "
+                    'AND tbl_name IN (%s)' % ', '.join(['%s'] * len(tables)),
+                    tables
+                )
+            indexes = cursor.fetchall()
+            for name, _ in indexes:
+                cursor.execute(f'DROP INDEX {connection.ops.quote_name(name)}')
+        self.log(f'Отложено индексов: {len(indexes)}')
+        try:
+            yield
+        finally:
+            started = time.perf_counter()
+            with connection.cursor() as cursor:
+                for _, definition in indexes:
+                    cursor.execute(definition)
+            self.log(f'Индексы созданы за '
+                     f'{time.perf_counter() - started:.2f} с')
+
+    @staticmethod
+    def new_pks(model, after):
+        return list(model.objects.filter(
+            pk__gt=after).order_by('pk').values_list('pk', flat=True))
+
+    @staticmethod
+    def last_pk(model):
+        return model.objects.aggregate(pk=Max('pk'))['pk'] or 0
+
+    def ingredients(self):
+        stats = load_ingredients(read_ingredients(self.ingredients_file),
+                                 batch_size=self.batch_size)
+        self.log(f'ingredient: добавлено {stats["created"]} за '
+                 f'{stats["elapsed"]:.2f} с')
+        return list(Ingredient.objects.order_by('pk').values_list(
+            'pk', 'name'))
+
+    def tags(self):
+        if not Tag.objects.exists():
+            for name, color, slug in DEFAULT_TAGS:
+                Tag.objects.create(name=name, color=color, slug=slug)
+        return list(Tag.objects.values_list('pk', 'bit'))
+
+    def users(self, count):
+        after = self.last_pk(User)
+        user = User()
+        user.set_password(PASSWORD)
+        password = user.password
+        self.write_rows(
+            User,
+            ('username', 'email', 'first_name', 'last_name', 'password',
+             'is_active', 'is_staff', 'is_superuser', 'date_joined',
+             'recipes_count', 'subscribers_count'),
+            (
+                (f'{self.prefix}{number}', f'{self.prefix}{number}@seed.ru',
+                 'Имя', 'Фамилия', password, True, False, False,
+                 DATE_JOINED, 0, 0)
+                for number in range(count)
+            )
+        )
+        return self.new_pks(User, after)
+
+    def recipes(self, count, user_ids, tags, ingredients):
+        after = self.last_pk(Recipe)
+        authors = ZipfSampler(user_ids, self.rng)
+        names = [name for _, name in ingredients]
+
+        def rows():
+            for _ in range(count):
+                recipe_tags = self.rng.sample(
+                    tags, self.rng.randint(1, len(tags)))
+                yield (
+                    authors.choice(),
+                    f'{self.rng.choice(DISHES)} с '
+                    f'{self.rng.choice(names)}',
+                    'images/seed.png',
+                    ' '.join(self.rng.choices(WORDS, k=30)),
+                    self.rng.randint(1, 180),
+                    PUB_DATE_START + timedelta(
+                        days=self.rng.randrange(PUB_DATE_DAYS)),
+                    tags_mask(bit for _, bit in recipe_tags),
+                    {}, 0, 0,
+                )
+
+        self.write_rows(
+            Recipe,
+            ('author', 'name', 'image', 'text', 'cooking_time', 'pub_date',
+             'tags_mask', 'image_variants', 'favorites_count',
+             'shopping_carts_count'),
+            rows()
+        )
+        recipe_ids = self.new_pks(Recipe, after)
+        bits = dict(tags)
+        tag_by_bit = {bit: pk for pk, bit in tags}
+        masks = Recipe.objects.filter(pk__gt=after).values_list(
+            'pk', 'tags_mask').iterator()
+        self.write_rows(
+            Recipe.tags.through, ('recipe', 'tag'),
+            (
+                (recipe_id, tag_by_bit[bit])
+                for recipe_id, mask in masks
+                for bit in bits.values() if mask & 1 << bit
+            )
+        )
+        return recipe_ids
+
+    def recipe_ingredients(self, recipe_ids, ingredients, per_recipe):
+        sampler = ZipfSampler([pk for pk, _ in ingredients], self.rng)
+        self.write_rows(
+            RecipeIngredient, ('recipe', 'ingredient', 'amount'),
+            (
+                (recipe_id, ingredient_id, self.rng.randint(1, 500))
+                for recipe_id in recipe_ids
+                for ingredient_id in sampler.sample(
+                    self.rng.randint(1, 2 * per_recipe - 1))
+            )
+        )
+
+    def user_relations(self, model, field, total, user_ids, targets,
+                       exclude_self=False):
+        """
+        Связи пользователей с рецептами или авторами: активность
+        пользователей и популярность целей распределены по Ципфу.
+        """
+        activity = ZipfSampler(user_ids, self.rng)
+        counts = Counter(activity.choice() for _ in range(total))
+        popular = ZipfSampler(targets, self.rng)
+        self.write_rows(
+            model, ('user', field),
+            (
+                (user_id, target)
+                for user_id, count in sorted(counts.items())
+                for target in popular.sample(min(count, len(targets)))
+                if not exclude_self or target != user_id
+            )
+        )
+
+    def load(self, users, recipes, ingredients_per_recipe, favorites,
+             shopping_carts, subscriptions):
+        """Пишет строки всех таблиц; производные данные не трогает."""
+        self.started = time.perf_counter()
+        ingredients = self.ingredients()
+        tags = self.tags()
+        user_ids = self.users(users)
+        self.rng.shuffle(user_ids)
+        recipe_ids = self.recipes(recipes, user_ids, tags, ingredients)
+        self.recipe_ingredients(recipe_ids, ingredients,
+                                ingredients_per_recipe)
+        shuffled = recipe_ids[:]
+        self.rng.shuffle(shuffled)
+        self.user_relations(Favorite, 'recipe', favorites, user_ids,
+                            shuffled)
+        self.user_relations(ShoppingCart, 'recipe', shopping_carts,
+                            user_ids, shuffled)
+        self.user_relations(Subscription, 'author', subscriptions,
+                            user_ids, user_ids, exclude_self=True)
+        return user_ids, recipe_ids
+
+    def finish(self):
+        """
+        Пересчитывает производные данные: при массовой записи сигналы
+        не срабатывают. Вызывается после восстановления индексов.
+        """
+        started = time.perf_counter()
+        reconcile_counters()
+        call_command('verify_shopping_totals', '--repair',
+                     stdout=StringIO())
+        rebuild_search_index()
+        invalidate_recipe_responses()
+        self.log(f'Производные данные: '
+                 f'{time.perf_counter() - started:.2f} с')
+        rows = sum(written for written, _ in self.stats.values())
+        elapsed = time.perf_counter() - self.started
+        self.log(f'Всего: {rows} строк за {elapsed:.2f} с '
+                 f'({rows / max(elapsed, 1e-9):.0f} строк/с)')
+
+    def run(self, **counts):
+        user_ids, recipe_ids = self.load(**counts)
+        self.finish()
+        return user_ids, recipe_ids
@@ -2,13 +2,15 @@ from django.contrib.auth import get_user_model
 from django.db import transaction
 from djoser.conf import settings
 from djoser.serializers import UserCreateSerializer, UserSerializer
-from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from rest_framework.fields import SerializerMethodField
 from rest_framework.validators import UniqueValidator
 
-from .models import (Favorite, Ingredient, Recipe, RecipeIngredient,
+from .fields import BoundedBase64ImageField
+from .images import (resized_image_urls, schedule_image_processing,
+                     schedule_image_release)
+from .models import (MAX_PK, Favorite, Ingredient, Recipe, RecipeIngredient,
                      ShoppingCart, Subscription, Tag)
 from .utils import create_update_recipe
 
@@ -19,13 +21,16 @@ class CustomUserSerializer(UserSerializer):
     is_subscribed = SerializerMethodField()
 
     def get_is_subscribed(self, instance):
-        user = self.context['request'].user
-        author_id = instance.id
-        try:
-            return user.is_authenticated and Subscription.objects.filter(
-                user=user, author__id=author_id).exists()
-        except Exception:
+        is_subscribed = getattr(instance, 'is_subscribed', None)
+        if is_subscribed is not None:
+            return is_subscribed
+        request = self.context.get('request')
+        if request is None or not request.user.is_authenticated:
+            return False
+        if request.user.pk == instance.pk:
             return False
+        return Subscription.objects.filter(
+            user=request.user, author__id=instance.id).exists()
 
     class Meta:
         model = User
@@ -53,25 +58,29 @@ class CustomUserCreateSerializer(UserCreateSerializer):
 
 
 class RecipeMinifiedSerializer(serializers.ModelSerializer):
+    image_sizes = serializers.SerializerMethodField()
+
+    @staticmethod
+    def get_image_sizes(obj):
+        return resized_image_urls(obj.image)
+
     class Meta:
-        fields = ('id', 'name', 'image', 'cooking_time',)
+        fields = ('id', 'name', 'image', 'cooking_time', 'image_sizes',)
         model = Recipe
 
 
 class ExtendedCustomUserSerializer(CustomUserSerializer):
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.SerializerMethodField()
 
     def get_recipes(self, instance):
-        recipes_limit = self.context.get('recipes_limit', 2)
-        recipes = instance.recipes.all()[:recipes_limit]
+        recipes = getattr(instance, 'latest_recipes', None)
+        if recipes is None:
+            recipes_limit = self.context.get('recipes_limit', 2)
+            recipes = instance.recipes.all()[:recipes_limit]
         return RecipeMinifiedSerializer(
             recipes, many=True, context=self.context
         ).data
 
-    def get_recipes_count(self, instance):
-        return instance.recipes.count()
-
     class Meta:
         model = User
         fields = [
@@ -83,13 +92,14 @@ class ExtendedCustomUserSerializer(CustomUserSerializer):
             'is_subscribed',
             'recipes',
             'recipes_count',
+            'subscribers_count',
         ]
         read_only_fields = (settings.LOGIN_FIELD,)
 
 
 class TagSerializer(serializers.ModelSerializer):
     class Meta:
-        fields = '__all__'
+        fields = ('id', 'name', 'color', 'slug')
         model = Tag
 
 
@@ -150,23 +160,43 @@ class RecipeSerializer(serializers.ModelSerializer):
     image = serializers.SerializerMethodField('get_image_url')
     is_favorited = serializers.BooleanField()
     is_in_shopping_cart = serializers.BooleanField()
+    image_variants = serializers.SerializerMethodField()
+    image_sizes = serializers.SerializerMethodField()
 
     def get_ingredients(self, instance):
         return RecipeIngredientsSerializer(
-            RecipeIngredient.objects.filter(recipe=instance).all(),
-            many=True
+            instance.recipeingredient_set.all(), many=True
         ).data
 
     @staticmethod
     def get_image_url(obj):
         return obj.image.url
 
+    @staticmethod
+    def get_image_variants(obj):
+        storage = obj.image.storage
+        return {
+            kind: storage.url(name)
+            for kind, name in obj.image_variants.items()
+        }
+
+    @staticmethod
+    def get_image_sizes(obj):
+        return resized_image_urls(obj.image)
+
+    def to_representation(self, instance):
+        is_subscribed = getattr(instance, 'author_is_subscribed', None)
+        if is_subscribed is not None:
+            instance.author.is_subscribed = is_subscribed
+        return super().to_representation(instance)
+
     class Meta:
         fields = (
             'id', 'tags', 'author', 'ingredients', 'is_favorited',
             'is_in_shopping_cart', 'name',
             'image', 'text',
-            'cooking_time')
+            'cooking_time', 'favorites_count', 'shopping_carts_count',
+            'image_variants', 'image_sizes')
         model = Recipe
 
 
@@ -177,7 +207,12 @@ class RecipeCreateUploadSerializer(serializers.ModelSerializer):
         many=True,
         queryset=Tag.objects.all(),
         validators=[UniqueValidator(queryset=Tag.objects.all())])
-    image = Base64ImageField()
+    image = BoundedBase64ImageField()
+    image_sizes = serializers.SerializerMethodField()
+
+    @staticmethod
+    def get_image_sizes(obj):
+        return resized_image_urls(obj.image)
 
     def validate_cooking_time(self, value):
         if value < 0:
@@ -200,28 +235,40 @@ class RecipeCreateUploadSerializer(serializers.ModelSerializer):
 
     @transaction.atomic
     def create(self, validated_data):
-        return create_update_recipe(validated_data)
+        instance = create_update_recipe(validated_data)
+        schedule_image_processing(instance)
+        return instance
 
     @transaction.atomic
     def update(self, instance, validated_data):
-        return super().update(
+        old_image = instance.image.name
+        instance = super().update(
             create_update_recipe(
                 validated_data, instance
             ), validated_data)
+        # Повторно присланное изображение получает то же имя, и его варианты
+        # остаются действительными.
+        if instance.image.name != old_image:
+            instance.image_variants = {}
+            instance.save(update_fields=['image_variants'])
+            schedule_image_processing(instance)
+            schedule_image_release(old_image)
+        return instance
 
     def to_representation(self, instance):
         self.fields.pop('ingredients')
         self.fields['tags'] = TagSerializer(many=True)
         representation = super().to_representation(instance)
         representation['ingredients'] = RecipeIngredientsSerializer(
-            RecipeIngredient.objects.filter(recipe=instance).all(), many=True
+            instance.recipeingredient_set.select_related('ingredient'),
+            many=True
         ).data
         return representation
 
     class Meta:
         fields = (
             'id', 'tags', 'author', 'ingredients', 'name', 'image', 'text',
-            'cooking_time')
+            'cooking_time', 'image_sizes')
         model = Recipe
 
 
@@ -252,6 +299,17 @@ class FavoriteSerializer(serializers.ModelSerializer):
         read_only_fields = ('user', 'recipe')
 
 
+class RecipeIdsSerializer(serializers.Serializer):
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1, max_value=MAX_PK),
+        allow_empty=False,
+        max_length=100,
+    )
+
+    def validate_recipes(self, recipes):
+        return list(dict.fromkeys(recipes))
+
+
 class ShoppingCartSerializer(serializers.ModelSerializer):
     class Meta:
         fields = '__all__'
@@ -0,0 +1,218 @@
+import csv
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Sum
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+from .generations import bump_generation, get_generation
+from .models import RecipeIngredient, ShoppingCart, ShoppingCartIngredient
+
+PDF_FONT_NAME = 'ShoppingListFont'
+PDF_FONT_SIZE = 12
+PDF_MARGIN = 50
+
+
+def cart_generation_name(user_id):
+    return f'shopping-cart:{user_id}'
+
+
+def get_cart_version(user_id):
+    return get_generation(cart_generation_name(user_id))
+
+
+def bump_cart_version(user_id):
+    bump_generation(cart_generation_name(user_id))
+
+
+def bump_recipe_carts_versions(recipe):
+    user_ids = ShoppingCart.objects.filter(
+        recipe=recipe).values_list('user_id', flat=True)
+    for user_id in user_ids.iterator():
+        bump_cart_version(user_id)
+
+
+def recipes_amounts(recipe_ids):
+    """
+    Суммарное количество каждого ингредиента в рецептах recipe_ids.
+    """
+    amounts = RecipeIngredient.objects.filter(
+        recipe_id__in=recipe_ids
+    ).values('ingredient_id').annotate(total=Sum('amount')).order_by()
+    return {row['ingredient_id']: row['total'] for row in amounts}
+
+
+# Строк в одном INSERT: параметров в запросе не больше, чем позволяет
+# SQLite.
+UPSERT_BATCH_SIZE = 500
+
+
+def _shopping_totals_sql():
+    quote = connection.ops.quote_name
+    meta = ShoppingCartIngredient._meta
+    return (quote(meta.db_table), quote(meta.get_field('user').column),
+            quote(meta.get_field('ingredient').column),
+            quote(meta.get_field('amount').column))
+
+
+@transaction.atomic
+def apply_shopping_totals(user_ids, deltas):
+    """
+    Прибавляет deltas (ingredient_id -> количество) к спискам покупок
+    пользователей user_ids. Строки с нулевым остатком удаляются.
+
+    Каждое изменение — один атомарный запрос (INSERT ... ON CONFLICT DO
+    UPDATE или UPDATE amount = amount + delta), поэтому параллельные
+    запросы с общим ингредиентом не читают устаревший остаток и не
+    вставляют одну строку дважды.
+    """
+    user_ids = sorted(set(user_ids))
+    deltas = {
+        ingredient_id: delta for ingredient_id, delta in deltas.items()
+        if delta
+    }
+    if not user_ids or not deltas:
+        return
+    table, user_column, ingredient_column, amount_column = (
+        _shopping_totals_sql())
+    ops = connection.ops
+    added = [
+        (user_id, ingredient_id, ops.adapt_decimalfield_value(delta, 12, 1))
+        for user_id in user_ids
+        for ingredient_id, delta in sorted(deltas.items()) if delta > 0
+    ]
+    removed = sorted(
+        (ingredient_id, ops.adapt_decimalfield_value(-delta, 12, 1))
+        for ingredient_id, delta in deltas.items() if delta < 0
+    )
+    user_placeholders = ', '.join(['%s'] * len(user_ids))
+    with connection.cursor() as cursor:
+        for start in range(0, len(added), UPSERT_BATCH_SIZE):
+            batch = added[start:start + UPSERT_BATCH_SIZE]
+            values = ', '.join(['(%s, %s, %s)'] * len(batch))
+            cursor.execute(
+                f'INSERT INTO {table} '
+                f'({user_column}, {ingredient_column}, {amount_column}) '
+                f'VALUES {values} '
+                f'ON CONFLICT ({user_column}, {ingredient_column}) '
+                f'DO UPDATE SET {amount_column} = '
+                f'{table}.{amount_column} + EXCLUDED.{amount_column}',
+                [value for row in batch for value in row]
+            )
+        for ingredient_id, amount in removed:
+            cursor.execute(
+                f'UPDATE {table} SET {amount_column} = {amount_column} - %s '
+                f'WHERE {ingredient_column} = %s '
+                f'AND {user_column} IN ({user_placeholders})',
+                [amount, ingredient_id, *user_ids]
+            )
+        if removed:
+            ingredient_placeholders = ', '.join(['%s'] * len(removed))
+            cursor.execute(
+                f'DELETE FROM {table} WHERE {amount_column} <= 0 '
+                f'AND {ingredient_column} IN ({ingredient_placeholders}) '
+                f'AND {user_column} IN ({user_placeholders})',
+                [ingredient_id for ingredient_id, _ in removed] + user_ids
+            )
+
+
+def add_to_shopping_totals(user_id, recipe_ids):
+    apply_shopping_totals([user_id], recipes_amounts(recipe_ids))
+
+
+def remove_from_shopping_totals(user_id, recipe_ids):
+    apply_shopping_totals([user_id], {
+        ingredient_id: -total
+        for ingredient_id, total in recipes_amounts(recipe_ids).items()
+    })
+
+
+def update_recipe_shopping_totals(recipe, old_amounts):
+    """
+    Переносит изменение состава рецепта во все корзины с этим рецептом.
+    """
+    new_amounts = recipes_amounts([recipe.pk])
+    deltas = {
+        ingredient_id: (
+            new_amounts.get(ingredient_id, 0)
+            - old_amounts.get(ingredient_id, 0)
+        ) for ingredient_id in new_amounts.keys() | old_amounts.keys()
+    }
+    user_ids = ShoppingCart.objects.filter(
+        recipe=recipe).values_list('user_id', flat=True)
+    apply_shopping_totals(user_ids, deltas)
+
+
+def shopping_list_rows(user):
+    """
+    Список покупок из поддерживаемых итогов пользователя: не больше одной
+    строки на ингредиент. Строки читаются сразу, чтобы потоковый ответ
+    не обращался к БД: под ASGI Django перебирает его в цикле событий.
+    """
+    return list(ShoppingCartIngredient.objects.filter(user=user).values_list(
+        'ingredient__name', 'amount', 'ingredient__measurement_unit'
+    ).order_by('-amount'))
+
+
+def text_lines(rows):
+    for name, total, units in rows:
+        yield f'{name} - {total} {units}\n'
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('name', 'amount', 'measurement_unit'))
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _pdf_font():
+    font_path = getattr(settings, 'SHOPPING_LIST_PDF_FONT', None)
+    if not font_path or not os.path.exists(font_path):
+        return 'Helvetica'
+    if PDF_FONT_NAME not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont(PDF_FONT_NAME, font_path))
+    return PDF_FONT_NAME
+
+
+def build_pdf(rows):
+    buffer = BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+    font = _pdf_font()
+    width, height = A4
+    line_height = PDF_FONT_SIZE * 1.5
+    y = height - PDF_MARGIN
+    pdf.setFont(font, PDF_FONT_SIZE)
+    for line in text_lines(rows):
+        if y < PDF_MARGIN:
+            pdf.showPage()
+            pdf.setFont(font, PDF_FONT_SIZE)
+            y = height - PDF_MARGIN
+        pdf.drawString(PDF_MARGIN, y, line.rstrip('\n'))
+        y -= line_height
+    pdf.save()
+    return buffer.getvalue()
+
+
+def get_pdf(user):
+    """
+    PDF списка покупок, закэшированный по пользователю и версии корзины.
+    """
+    key = f'shopping-list-pdf:{user.id}:{get_cart_version(user.id)}'
+    pdf = cache.get(key)
+    if pdf is None:
+        pdf = build_pdf(shopping_list_rows(user))
+        cache.set(key, pdf, getattr(
+            settings, 'SHOPPING_LIST_PDF_CACHE_TIMEOUT', 60 * 60 * 24))
+    return pdf
@@ -0,0 +1,118 @@
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import invalidate_user_tokens, token_cache
+from .counters import change_counter
+from .images import schedule_image_release
+from .ingredient_index import invalidate_ingredient_index
+from .models import (CustomUser, Favorite, Ingredient, Recipe,
+                     RecipeIngredient, ShoppingCart, Subscription, Tag)
+from .response_cache import invalidate_recipe_responses, invalidate_user_set
+from .search import index_recipe, unindex_recipe
+from .tag_masks import clear_tag_bit, update_tags_masks
+from .utils import (claim_row, subscription_removed, user_recipes_added,
+                    user_recipes_removed)
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def ingredient_changed(**kwargs):
+    invalidate_ingredient_index()
+    invalidate_recipe_responses()
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+@receiver(m2m_changed, sender=Recipe.ingredients.through)
+def recipe_data_changed(action=None, **kwargs):
+    if action is None or action.startswith('post_'):
+        invalidate_recipe_responses()
+
+
+@receiver(post_save, sender=CustomUser)
+def user_saved(instance, created, update_fields, **kwargs):
+    # Автор показывается в ленте, но новый пользователь рецептов ещё не
+    # имеет, а вход обновляет только last_login. Смена пароля или
+    # деактивация должны сразу сбросить закэшированные токены.
+    if not created and set(update_fields or ()) != {'last_login'}:
+        invalidate_recipe_responses()
+        invalidate_user_tokens(instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(instance, **kwargs):
+    token_cache.discard(instance.key)
+    invalidate_user_tokens(instance.user_id)
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=ShoppingCart)
+def user_recipe_created(sender, instance, created, **kwargs):
+    if created:
+        user_recipes_added(sender, instance.user_id, [instance.recipe_id])
+
+
+# Строку удаляет сам обработчик: если её уже удалил параллельный запрос,
+# DELETE ничего не вернёт, и счётчики с итогами не изменятся. Итоги
+# списка покупок вычитаются в pre_delete, чтобы при каскадном удалении
+# рецепта его ингредиенты ещё были в базе.
+@receiver(pre_delete, sender=Favorite)
+@receiver(pre_delete, sender=ShoppingCart)
+def user_recipe_deleting(sender, instance, **kwargs):
+    if claim_row(sender, instance.pk):
+        user_recipes_removed(sender, instance.user_id, [instance.recipe_id])
+
+
+@receiver(post_save, sender=Subscription)
+def subscription_created(instance, created, **kwargs):
+    if created:
+        change_counter(CustomUser, [instance.author_id],
+                       'subscribers_count', 1)
+        invalidate_user_set(Subscription, instance.user_id)
+
+
+# Как и для избранного: счётчик уменьшается, только если строку удалил
+# этот обработчик.
+@receiver(pre_delete, sender=Subscription)
+def subscription_deleting(instance, **kwargs):
+    if claim_row(Subscription, instance.pk):
+        subscription_removed(instance.user_id, instance.author_id)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_created(instance, created, **kwargs):
+    if created:
+        change_counter(CustomUser, [instance.author_id], 'recipes_count', 1)
+    index_recipe(instance)
+    invalidate_recipe_responses()
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(instance, **kwargs):
+    change_counter(CustomUser, [instance.author_id], 'recipes_count', -1)
+    schedule_image_release(instance.image.name)
+    unindex_recipe(instance.pk)
+    invalidate_recipe_responses()
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def recipe_tags_changed(instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    invalidate_recipe_responses()
+    if not reverse:
+        # Обновляем и сам объект, чтобы последующий save() не затёр маску.
+        instance.tags_mask = update_tags_masks([instance.pk])[instance.pk]
+    elif action == 'post_clear':
+        clear_tag_bit(instance)
+    else:
+        update_tags_masks(pk_set)
+
+
+@receiver(pre_delete, sender=Tag)
+def tag_deleting(instance, **kwargs):
+    clear_tag_bit(instance)
@@ -0,0 +1,43 @@
+import hashlib
+import os
+import posixpath
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.crypto import get_random_string
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Хранилище, которое называет файлы по SHA-256 их содержимого.
+    Повторная загрузка того же файла ничего не записывает и возвращает
+    имя уже существующего файла, поэтому один файл может принадлежать
+    нескольким рецептам.
+    """
+
+    @staticmethod
+    def content_name(name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        directory, filename = posixpath.split(name)
+        extension = posixpath.splitext(filename)[1].lower()
+        return posixpath.join(directory, digest.hexdigest() + extension)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.content_name(name, content)
+        if self.exists(name):
+            # Обновляем время изменения: файл снова используется и не
+            # должен быть удалён как осиротевший.
+            os.utime(self.path(name))
+            return name
+        # Пишем во временный файл и атомарно переименовываем, чтобы
+        # параллельная загрузка того же содержимого не увидела половину файла.
+        temporary = self._save(f'{name}.{get_random_string(8)}.tmp', content)
+        os.replace(self.path(temporary), self.path(name))
+        return name
@@ -0,0 +1,68 @@
+from itertools import combinations
+
+from django.db.models import F
+
+from .models import Recipe, Tag
+
+# При небольшом числе тегов фильтр перечисляет все подходящие маски
+# в IN, чтобы использовать индекс по tags_mask.
+MASK_ENUMERATION_LIMIT = 8
+
+
+def tags_mask(bits):
+    mask = 0
+    for bit in bits:
+        mask |= 1 << bit
+    return mask
+
+
+def update_tags_masks(recipe_ids):
+    """Пересчитывает маски тегов рецептов и возвращает их по id."""
+    recipe_bits = {recipe_id: [] for recipe_id in recipe_ids}
+    for recipe_id, bit in Recipe.tags.through.objects.filter(
+        recipe_id__in=recipe_ids
+    ).values_list('recipe_id', 'tag__bit'):
+        recipe_bits[recipe_id].append(bit)
+    masks = {
+        recipe_id: tags_mask(bits) for recipe_id, bits in recipe_bits.items()
+    }
+    recipes_by_mask = {}
+    for recipe_id, mask in masks.items():
+        recipes_by_mask.setdefault(mask, []).append(recipe_id)
+    for mask, ids in recipes_by_mask.items():
+        Recipe.objects.filter(pk__in=ids).update(tags_mask=mask)
+    return masks
+
+
+def clear_tag_bit(tag):
+    """Снимает бит тега со всех рецептов, например перед удалением тега."""
+    bit = 1 << tag.bit
+    Recipe.objects.alias(
+        tag_bit=F('tags_mask').bitand(bit)
+    ).filter(tag_bit=bit).update(tags_mask=F('tags_mask') - bit)
+
+
+def filter_by_tags(queryset, slugs, match_all=False):
+    """
+    Оставляет рецепты, у которых есть любой (или при match_all — каждый)
+    из тегов slugs. Фильтр проверяет маску тегов без JOIN и DISTINCT.
+    """
+    bits = dict(Tag.objects.values_list('slug', 'bit'))
+    wanted = {bits[slug] for slug in slugs if slug in bits}
+    if not wanted or match_all and len(wanted) < len(set(slugs)):
+        return queryset.none()
+    mask = tags_mask(wanted)
+    if len(bits) <= MASK_ENUMERATION_LIMIT:
+        candidates = (
+            tags_mask(subset)
+            for size in range(len(bits) + 1)
+            for subset in combinations(bits.values(), size)
+        )
+        return queryset.filter(tags_mask__in=[
+            candidate for candidate in candidates
+            if (candidate & mask == mask if match_all else candidate & mask)
+        ])
+    queryset = queryset.alias(matched_tags=F('tags_mask').bitand(mask))
+    if match_all:
+        return queryset.filter(matched_tags=mask)
+    return queryset.filter(matched_tags__gt=0)
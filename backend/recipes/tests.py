@@ -1,14 +1,51 @@
 # coverage run manage.py test -v 2
 # coverage html
+import asyncio
+import csv
+import json
+import os
+import tempfile
+import threading
+from base64 import b64encode, urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
+
+import psycopg2
+from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.db.utils import ConnectionHandler
+from django.test import (AsyncClient, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, resolve
 from openapi_tester import SchemaTester
+from PIL import Image
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
 from rest_framework.test import (APIClient, APIRequestFactory, APITestCase,
                                  force_authenticate)
 
-from .models import Ingredient, Recipe, Tag
+from foodgram.db.pool import ConnectionPool, PoolTimeout, close_pools
+
+from . import images, utils
+from .async_views import use_async_reads
+from .authentication import token_cache
+from .counters import reconcile_counters
+from .images import get_resized_image
+from .ingredient_loader import iter_json_array
+from .metrics import request_metrics
+from .models import (Favorite, Ingredient, Recipe, RecipeIngredient,
+                     ShoppingCart, ShoppingCartIngredient, Subscription, Tag)
+from .tag_masks import tags_mask
+from .urls import router
 
 User = get_user_model()
 schema_tester = SchemaTester(schema_file_path="../../docs/openapi-schema.yml")
@@ -345,3 +382,1427 @@ class MyAPITests(BaseAPITestCase):
         print(response.headers)
         #schema_tester.validate_response(response=response)
         #self.assertResponse(response)
+
+
+class RecipeQueryCountTests(TestCase):
+    def setUp(self):
+        self.guest_client = APIClient()
+        self.user = User.objects.create_user(username='Stas',
+                                             email='stas@stas.ru')
+        self.authorized_client = APIClient()
+        self.authorized_client.force_authenticate(self.user)
+        self.tag = Tag.objects.create(name='Завтрак', color='#FFFFF1',
+                                      slug='breakfast')
+        self.ingredients = [
+            Ingredient.objects.create(name=f'Ингредиент {i}',
+                                      measurement_unit='г')
+            for i in range(3)
+        ]
+
+    def create_recipes(self, count):
+        for i in range(count):
+            author = User.objects.create_user(username=f'author{i}',
+                                              email=f'author{i}@mail.ru')
+            recipe = Recipe.objects.create(
+                author=author, name=f'Рецепт {i}', text='Текст',
+                cooking_time=10, image='images/test.png',
+            )
+            recipe.tags.add(self.tag)
+            RecipeIngredient.objects.bulk_create(
+                RecipeIngredient(recipe=recipe, ingredient=ingredient,
+                                 amount=1)
+                for ingredient in self.ingredients
+            )
+
+    def count_queries(self, client, url):
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        assert response.status_code == 200, 'Рецепты должны возвращать 200'
+        return len(context.captured_queries)
+
+    # Количество запросов не зависит от размера страницы
+    def test_recipes_list_query_count(self):
+        self.create_recipes(12)
+        for client in (self.guest_client, self.authorized_client):
+            small_page = self.count_queries(client, '/api/recipes/?limit=2')
+            large_page = self.count_queries(client, '/api/recipes/?limit=12')
+            assert small_page == large_page, (
+                f'Количество запросов растёт с размером страницы: '
+                f'{small_page} != {large_page}')
+
+    # Подписка отображается без отдельного запроса на каждого пользователя
+    def test_users_list_query_count(self):
+        self.create_recipes(2)
+        author = User.objects.get(username='author0')
+        Subscription.objects.create(user=self.user, author=author)
+        small_page = self.count_queries(self.authorized_client,
+                                        '/api/users/?limit=1')
+        response = self.authorized_client.get('/api/users/?limit=3')
+        large_page = self.count_queries(self.authorized_client,
+                                        '/api/users/?limit=3')
+        assert small_page == large_page, (
+            'Количество запросов растёт с размером страницы')
+        subscribed = {
+            user['username']: user['is_subscribed']
+            for user in response.json()['results']
+        }
+        assert subscribed == {'Stas': False, 'author0': True,
+                              'author1': False}, (
+            'Поле is_subscribed заполнено неверно')
+        response = self.authorized_client.get('/api/recipes/')
+        for recipe in response.json()['results']:
+            assert recipe['author']['is_subscribed'] == (
+                recipe['author']['username'] == 'author0'), (
+                'Поле is_subscribed автора рецепта заполнено неверно')
+
+    # Подписки: recipes_limit и постоянное количество запросов
+    def test_subscriptions_query_count(self):
+        self.create_recipes(6)
+        for author in User.objects.filter(username__startswith='author'):
+            Subscription.objects.create(user=self.user, author=author)
+            Recipe.objects.create(
+                author=author, name='Ещё рецепт', text='Текст',
+                cooking_time=5, image='images/test.png',
+            )
+        url = '/api/users/subscriptions/'
+        small_page = self.count_queries(self.authorized_client,
+                                        f'{url}?limit=2&recipes_limit=1')
+        large_page = self.count_queries(self.authorized_client,
+                                        f'{url}?limit=6&recipes_limit=1')
+        assert small_page == large_page, (
+            'Количество запросов растёт с размером страницы')
+        response = self.authorized_client.get(f'{url}?recipes_limit=1')
+        for author in response.json()['results']:
+            assert author['recipes_count'] == 2, (
+                'Количество рецептов автора не верно')
+            assert len(author['recipes']) == 1, (
+                'Параметр recipes_limit не учитывается')
+            assert author['recipes'][0]['name'] == 'Ещё рецепт', (
+                'Должны возвращаться последние рецепты автора')
+        response = self.authorized_client.get(f'{url}?recipes_limit=abc')
+        assert response.status_code == 400, (
+            'Некорректный recipes_limit должен возвращать 400 код')
+
+    # Пагинация по курсору: стабильный порядок и без COUNT
+    def test_recipes_cursor_pagination(self):
+        self.create_recipes(5)
+        expected = list(
+            Recipe.objects.order_by('-pub_date', '-id')
+            .values_list('id', flat=True)
+        )
+        url = '/api/recipes/?cursor=&limit=2'
+        received = []
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.guest_client.get(url)
+            assert response.status_code == 200, (
+                'Рецепты должны возвращать 200 код')
+            assert not any(
+                'COUNT(' in query['sql']
+                for query in context.captured_queries
+            ), 'Пагинация по курсору не должна выполнять COUNT'
+            data = response.json()
+            assert 'count' not in data, 'Поле count не должно возвращаться'
+            received.extend(recipe['id'] for recipe in data['results'])
+            last_page = data
+            url = data['next']
+        assert received == expected, 'Порядок рецептов не верен'
+        response = self.guest_client.get(last_page['previous'])
+        assert [recipe['id'] for recipe in response.json()['results']] == (
+            expected[2:4]), 'Ссылка previous ведёт не на ту страницу'
+        response = self.guest_client.get('/api/recipes/?cursor=broken')
+        assert response.status_code == 404, (
+            'Неверный курсор должен возвращать 404 код')
+        cursor = urlsafe_b64encode(
+            f'2020-01-01:{2 ** 63}:f'.encode()).decode()
+        response = self.guest_client.get(f'/api/recipes/?cursor={cursor}')
+        assert response.status_code == 404, (
+            'Курсор с id вне диапазона должен возвращать 404 код')
+
+
+class IngredientIndexTests(TestCase):
+    def setUp(self):
+        self.guest_client = APIClient()
+        for name in ('Свёкла', 'Свекольный сок', 'Сахар', 'Борщ со свеклой'):
+            Ingredient.objects.create(name=name, measurement_unit='г')
+
+    # Совпадения по началу названия идут первыми, ё и е не различаются
+    def test_ingredient_search_ranking(self):
+        request = self.guest_client.get('/api/ingredients/?name=СВЕК')
+        assert request.status_code == 200, (
+            'Поиск ингредиентов должен возвращать 200 код')
+        names = [ingredient['name'] for ingredient in request.json()]
+        assert names == ['Свёкла', 'Свекольный сок', 'Борщ со свеклой'], (
+            f'Неверное ранжирование результатов поиска: {names}')
+
+    # Изменения справочника сразу видны в поиске
+    def test_ingredient_index_invalidation(self):
+        self.guest_client.get('/api/ingredients/?name=сах')
+        Ingredient.objects.create(name='Сахарная пудра', measurement_unit='г')
+        request = self.guest_client.get('/api/ingredients/?name=сах')
+        assert len(request.json()) == 2, (
+            'Новый ингредиент должен находиться поиском')
+
+    # Изменения, сделанные другим процессом без общего кэша, видны по БД
+    # и по сроку жизни индекса
+    @override_settings(INGREDIENT_INDEX_CHECK_INTERVAL=0)
+    def test_ingredient_index_fingerprint(self):
+        self.guest_client.get('/api/ingredients/?name=сах')
+        # bulk_create и update не шлют сигналов и не сдвигают поколение.
+        Ingredient.objects.bulk_create(
+            [Ingredient(name='Сахарная пудра', measurement_unit='г')])
+        request = self.guest_client.get('/api/ingredients/?name=сах')
+        assert len(request.json()) == 2, (
+            'Новый ингредиент должен находиться поиском')
+        Ingredient.objects.filter(name='Сахар').update(name='Соль')
+        request = self.guest_client.get('/api/ingredients/?name=сах')
+        assert len(request.json()) == 2, (
+            'До истечения срока индекс не должен перестраиваться')
+        with override_settings(INGREDIENT_INDEX_MAX_AGE=0):
+            request = self.guest_client.get('/api/ingredients/?name=сах')
+        assert len(request.json()) == 1, (
+            'Индекс должен перестраиваться по истечении срока')
+
+
+class IngredientLoaderTests(TestCase):
+    def setUp(self):
+        self.guest_client = APIClient()
+        self.directory = tempfile.mkdtemp()
+        Ingredient.objects.create(name='соль', measurement_unit='г')
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        return path
+
+    # Повторы и пустые строки отбрасываются, существующие не дублируются
+    def test_load_csv(self):
+        path = self.write('ingredients.csv', (
+            'соль,г\nсахар,г\n сахар , г\n\nмука,\nмолоко,мл\n'))
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('load_ingredients', path, stdout=out)
+        assert 'добавлено 2' in out.getvalue(), out.getvalue()
+        assert Ingredient.objects.count() == 3
+        request = self.guest_client.get('/api/ingredients/?name=мол')
+        assert len(request.json()) == 1, (
+            'Загруженные ингредиенты должны находиться поиском')
+        call_command('load_ingredients', path, stdout=out)
+        assert Ingredient.objects.count() == 3, (
+            'Повторная загрузка не должна создавать дубликаты')
+
+    # JSON читается кусками, элементы на границе куска не теряются
+    def test_load_json(self):
+        items = [{'name': f'ингредиент {number}', 'measurement_unit': 'г'}
+                 for number in range(50)]
+        path = self.write('ingredients.json', json.dumps(
+            items, ensure_ascii=False, indent=1))
+        with open(path, encoding='utf-8') as file:
+            assert list(iter_json_array(file, chunk_size=7)) == items
+        call_command('load_ingredients', path, '--batch-size', '8',
+                     stdout=StringIO())
+        assert Ingredient.objects.count() == 51
+
+    def test_load_invalid_file(self):
+        path = self.write('ingredients.json', '{"name": "соль"}')
+        with self.assertRaises(CommandError):
+            call_command('load_ingredients', path, stdout=StringIO())
+
+    def test_unique_name_measurement_unit(self):
+        with self.assertRaises(IntegrityError):
+            Ingredient.objects.create(name='соль', measurement_unit='г')
+
+
+class ShoppingListTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='Stas',
+                                             email='stas@stas.ru')
+        self.authorized_client = APIClient()
+        self.authorized_client.force_authenticate(self.user)
+        self.sugar = Ingredient.objects.create(name='Сахар',
+                                               measurement_unit='г')
+        self.milk = Ingredient.objects.create(name='Молоко',
+                                              measurement_unit='мл')
+        for amount in (100, 50):
+            recipe = Recipe.objects.create(
+                author=self.user, name='Рецепт', text='Текст',
+                cooking_time=10, image='images/test.png',
+            )
+            RecipeIngredient.objects.create(recipe=recipe,
+                                            ingredient=self.sugar,
+                                            amount=amount)
+            RecipeIngredient.objects.create(recipe=recipe,
+                                            ingredient=self.milk,
+                                            amount=200)
+            ShoppingCart.objects.create(user=self.user, recipe=recipe)
+        self.url = '/api/recipes/download_shopping_cart/'
+
+    def download(self, url):
+        response = self.authorized_client.get(url)
+        assert response.status_code == 200, (
+            'Выгрузка списка покупок должна возвращать 200 код')
+        return response, b''.join(response.streaming_content)
+
+    # Выгрузка в текстовом формате и CSV
+    def test_download_txt_and_csv(self):
+        response, content = self.download(self.url)
+        assert response['Content-Type'].startswith('text/plain'), (
+            'По умолчанию список покупок выгружается в txt')
+        rows = [line.replace(' - ', ' ').split(' ')
+                for line in content.decode().splitlines()]
+        assert [(name, Decimal(total), units)
+                for name, total, units in rows] == [
+            ('Молоко', 400, 'мл'), ('Сахар', 150, 'г')], (
+            'Список покупок сформирован неверно')
+        response, content = self.download(f'{self.url}?format=csv')
+        assert response['Content-Type'].startswith('text/csv'), (
+            'Неверный тип содержимого CSV')
+        rows = list(csv.reader(content.decode().splitlines()))[1:]
+        assert [(name, Decimal(total), units)
+                for name, total, units in rows] == [
+            ('Молоко', 400, 'мл'), ('Сахар', 150, 'г')], (
+            'CSV список покупок сформирован неверно')
+
+    # Ошибки выгрузки возвращаются в JSON, а не ключами словаря
+    def test_download_errors(self):
+        for export_format in ('txt', 'csv', 'pdf'):
+            response = APIClient().get(f'{self.url}?format={export_format}')
+            assert response.status_code == 401
+            assert response['Content-Type'] == 'application/json', (
+                response['Content-Type'])
+            assert 'detail' in json.loads(response.content), response.content
+        response = self.authorized_client.get(self.url,
+                                              HTTP_ACCEPT='application/xml')
+        assert response.status_code == 406
+        assert response['Content-Type'] == 'application/json'
+        assert 'detail' in json.loads(response.content), response.content
+
+    # PDF кэшируется, пока не изменится корзина
+    def test_download_pdf_cache(self):
+        response = self.authorized_client.get(f'{self.url}?format=pdf')
+        assert response.status_code == 200, (
+            'Выгрузка PDF должна возвращать 200 код')
+        assert response.content.startswith(b'%PDF'), 'Ожидался PDF файл'
+        with CaptureQueriesContext(connection) as context:
+            cached = self.authorized_client.get(f'{self.url}?format=pdf')
+        assert len(context.captured_queries) == 0, (
+            'Повторная выгрузка неизменной корзины не должна обращаться к БД')
+        assert cached.content == response.content, 'PDF из кэша отличается'
+        ShoppingCart.objects.filter(user=self.user).first().delete()
+        with CaptureQueriesContext(connection) as context:
+            self.authorized_client.get(f'{self.url}?format=pdf')
+        assert len(context.captured_queries) > 0, (
+            'После изменения корзины PDF должен формироваться заново')
+
+    def totals(self):
+        return {
+            name: amount for name, amount in
+            ShoppingCartIngredient.objects.filter(user=self.user)
+            .values_list('ingredient__name', 'amount')
+        }
+
+    # Итоги списка покупок следуют за корзиной и рецептами
+    def test_shopping_totals_follow_changes(self):
+        assert self.totals() == {'Сахар': 150, 'Молоко': 400}, (
+            'Итоги списка покупок не совпадают с корзиной')
+        first, second = Recipe.objects.order_by('id')
+        response = self.authorized_client.patch(
+            f'/api/recipes/{first.id}/',
+            {'ingredients': [{'id': self.milk.id, 'amount': 10}]},
+            format='json'
+        )
+        assert response.status_code == 200, 'Рецепт должен обновляться'
+        assert self.totals() == {'Сахар': 50, 'Молоко': 210}, (
+            'Изменение рецепта не учтено в списке покупок')
+        response = self.authorized_client.delete(
+            f'/api/recipes/{second.id}/shopping_cart/')
+        assert response.status_code == 204, (
+            'Рецепт должен удаляться из списка покупок')
+        assert self.totals() == {'Молоко': 10}, (
+            'Удаление из корзины не учтено в списке покупок')
+        first.delete()
+        assert self.totals() == {}, (
+            'Удаление рецепта не учтено в списке покупок')
+
+    # Повторное удаление уже удалённой строки не вычитает итоги дважды
+    def test_stale_delete(self):
+        recipe = Recipe.objects.order_by('id').first()
+        other = User.objects.create_user(username='Ivan',
+                                         email='Ivan@Ivan.ru')
+        ShoppingCart.objects.create(user=other, recipe=recipe)
+        cart = ShoppingCart.objects.get(user=self.user, recipe=recipe)
+        stale = ShoppingCart.objects.get(pk=cart.pk)
+        cart.delete()
+        stale.delete()
+        assert self.totals() == {'Сахар': 50, 'Молоко': 200}, (
+            'Итоги списка покупок вычтены дважды')
+        recipe.refresh_from_db()
+        assert recipe.shopping_carts_count == 1, (
+            'Счётчик корзин уменьшен дважды')
+
+    # Команда сверки находит и исправляет расхождения
+    def test_verify_shopping_totals(self):
+        ShoppingCartIngredient.objects.filter(
+            ingredient=self.sugar).update(amount=1)
+        ShoppingCartIngredient.objects.filter(ingredient=self.milk).delete()
+        out = StringIO()
+        call_command('verify_shopping_totals', stdout=out)
+        assert 'расхождений найдено: 2' in out.getvalue(), out.getvalue()
+        assert self.totals() == {'Сахар': 1}, (
+            'Без --repair итоги не должны меняться')
+        call_command('verify_shopping_totals', '--repair', stdout=out)
+        assert self.totals() == {'Сахар': 150, 'Молоко': 400}, (
+            'Итоги списка покупок не восстановлены')
+
+
+class CounterTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user(username='Stas',
+                                               email='stas@stas.ru')
+        self.user = User.objects.create_user(username='Ivan',
+                                             email='Ivan@Ivan.ru')
+        self.authorized_client = APIClient()
+        self.authorized_client.force_authenticate(self.user)
+        self.recipe = Recipe.objects.create(
+            author=self.author, name='Рецепт', text='Текст',
+            cooking_time=10, image='images/test.png',
+        )
+
+    def assert_counters(self, **expected):
+        self.recipe.refresh_from_db()
+        self.author.refresh_from_db()
+        actual = {
+            'favorites_count': self.recipe.favorites_count,
+            'shopping_carts_count': self.recipe.shopping_carts_count,
+            'recipes_count': self.author.recipes_count,
+            'subscribers_count': self.author.subscribers_count,
+        }
+        assert actual == expected, f'Счётчики не верны: {actual}'
+
+    # Счётчики меняются вместе с избранным, корзиной и подписками
+    def test_counters_follow_changes(self):
+        self.assert_counters(favorites_count=0, shopping_carts_count=0,
+                             recipes_count=1, subscribers_count=0)
+        self.authorized_client.post(f'/api/recipes/{self.recipe.id}/favorite/')
+        self.authorized_client.post(
+            f'/api/recipes/{self.recipe.id}/shopping_cart/')
+        self.authorized_client.post(f'/api/users/{self.author.id}/subscribe/')
+        self.assert_counters(favorites_count=1, shopping_carts_count=1,
+                             recipes_count=1, subscribers_count=1)
+        response = self.authorized_client.get(
+            f'/api/recipes/{self.recipe.id}/')
+        assert response.json()['favorites_count'] == 1, (
+            'Счётчик избранного не возвращается в API')
+        self.user.delete()
+        self.assert_counters(favorites_count=0, shopping_carts_count=0,
+                             recipes_count=1, subscribers_count=0)
+
+    # Ошибка учёта не выдаётся за повторное добавление
+    def test_bookkeeping_error_not_masked(self):
+        url = f'/api/recipes/{self.recipe.id}/favorite/'
+        with mock.patch('recipes.views.user_recipes_added',
+                        side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.authorized_client.post(url)
+        assert not Favorite.objects.exists(), 'Добавление не откатилось'
+        response = self.authorized_client.post(url)
+        assert response.status_code == 201
+        response = self.authorized_client.post(url)
+        assert response.status_code == 400
+        self.assert_counters(favorites_count=1, shopping_carts_count=0,
+                             recipes_count=1, subscribers_count=0)
+
+    # Повторное удаление уже удалённой подписки не уменьшает счётчик
+    def test_stale_subscription_delete(self):
+        other = User.objects.create_user(username='Other',
+                                         email='other@other.ru')
+        for user in (self.user, other):
+            Subscription.objects.create(user=user, author=self.author)
+        subscription = Subscription.objects.get(user=self.user)
+        stale = Subscription.objects.get(pk=subscription.pk)
+        subscription.delete()
+        stale.delete()
+        self.assert_counters(favorites_count=0, shopping_carts_count=0,
+                             recipes_count=1, subscribers_count=1)
+
+    # Команда сверки исправляет расхождения счётчиков
+    def test_reconcile_counters(self):
+        Favorite.objects.create(user=self.user, recipe=self.recipe)
+        Recipe.objects.update(favorites_count=5)
+        User.objects.update(recipes_count=0)
+        out = StringIO()
+        call_command('reconcile_counters', '--dry-run', stdout=out)
+        assert 'recipes.Recipe.favorites_count: расхождений 1' in (
+            out.getvalue()), out.getvalue()
+        call_command('reconcile_counters', stdout=out)
+        self.assert_counters(favorites_count=1, shopping_carts_count=0,
+                             recipes_count=1, subscribers_count=0)
+
+
+class BatchEndpointsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='Stas',
+                                             email='stas@stas.ru')
+        self.authorized_client = APIClient()
+        self.authorized_client.force_authenticate(self.user)
+        self.ingredient = Ingredient.objects.create(name='Сахар',
+                                                    measurement_unit='г')
+        self.recipes = []
+        for i in range(10):
+            recipe = Recipe.objects.create(
+                author=self.user, name=f'Рецепт {i}', text='Текст',
+                cooking_time=10, image='images/test.png',
+            )
+            RecipeIngredient.objects.create(recipe=recipe,
+                                            ingredient=self.ingredient,
+                                            amount=10)
+            self.recipes.append(recipe.id)
+
+    def batch(self, method, url, recipes):
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.authorized_client, method)(
+                url, {'recipes': recipes}, format='json')
+        assert response.status_code == 200, (
+            'Пакетный запрос должен возвращать 200 код')
+        return response.json()['results'], len(context.captured_queries)
+
+    # Пакетное добавление и удаление с постоянным числом запросов
+    def test_batch_shopping_cart(self):
+        url = '/api/recipes/shopping_cart/'
+        results, small = self.batch('post', url, self.recipes[:2])
+        assert [result['status'] for result in results] == ['added'] * 2, (
+            'Рецепты должны добавляться в корзину')
+        results, large = self.batch('post', url, self.recipes + [10 ** 6])
+        assert small == large, (
+            f'Количество запросов зависит от размера пакета: {small} != '
+            f'{large}')
+        statuses = [result['status'] for result in results]
+        assert statuses == ['exists'] * 2 + ['added'] * 8 + ['not_found'], (
+            f'Неверные статусы: {statuses}')
+        assert ShoppingCartIngredient.objects.get(user=self.user).amount == (
+            100), 'Итоги списка покупок не обновлены'
+        assert Recipe.objects.filter(shopping_carts_count=1).count() == 10, (
+            'Счётчики корзины не обновлены')
+        results, small = self.batch('delete', url, self.recipes[:2])
+        results, large = self.batch('delete', url, self.recipes)
+        assert small == large, (
+            'Количество запросов зависит от размера пакета')
+        statuses = [result['status'] for result in results]
+        assert statuses == ['not_added'] * 2 + ['removed'] * 8, (
+            f'Неверные статусы: {statuses}')
+        assert not ShoppingCartIngredient.objects.exists(), (
+            'Итоги списка покупок не обновлены')
+        assert not Recipe.objects.filter(shopping_carts_count__gt=0), (
+            'Счётчики корзины не обновлены')
+
+    # Строки, которые успел добавить или удалить параллельный запрос, не
+    # учитываются в счётчиках и итогах второй раз
+    def test_batch_concurrent_rows(self):
+        url = '/api/recipes/shopping_cart/'
+        first, second = self.recipes[:2]
+
+        def concurrent(action):
+            original = getattr(utils, action)
+
+            def wrapper(model, user_id, recipe_ids):
+                if action == 'insert_user_recipes':
+                    ShoppingCart.objects.bulk_create(
+                        [ShoppingCart(user=self.user, recipe_id=first)])
+                else:
+                    ShoppingCart.objects.filter(recipe_id=first)._raw_delete(
+                        connection.alias)
+                return original(model, user_id, recipe_ids)
+
+            return mock.patch.object(utils, action, wrapper)
+
+        with concurrent('insert_user_recipes'):
+            results, _ = self.batch('post', url, [first, second])
+        assert [result['status'] for result in results] == [
+            'exists', 'added']
+        assert Recipe.objects.get(pk=first).shopping_carts_count == 0, (
+            'Строку другого запроса учли в счётчике')
+        assert ShoppingCartIngredient.objects.get(user=self.user).amount == (
+            10), 'Строку другого запроса учли в итогах'
+        with concurrent('delete_user_recipes'):
+            results, _ = self.batch('delete', url, [first, second])
+        assert [result['status'] for result in results] == [
+            'not_added', 'removed']
+        assert not ShoppingCartIngredient.objects.exists()
+        assert Recipe.objects.get(pk=second).shopping_carts_count == 0
+
+    def test_batch_favorite_validation(self):
+        response = self.authorized_client.post(
+            '/api/recipes/favorite/', {'recipes': []}, format='json')
+        assert response.status_code == 400, (
+            'Пустой список рецептов должен возвращать 400 код')
+        results, _ = self.batch('post', '/api/recipes/favorite/',
+                                [self.recipes[0], self.recipes[0]])
+        assert results == [{'id': self.recipes[0], 'status': 'added'}], (
+            'Повторяющиеся id должны схлопываться')
+        response = self.authorized_client.post(
+            '/api/recipes/favorite/', {'recipes': [2 ** 63]}, format='json')
+        assert response.status_code == 400, (
+            'Слишком большой id должен возвращать 400 код')
+
+
+class ConcurrentToggleTests(TransactionTestCase):
+    threads = 8
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='Stas',
+                                             email='stas@stas.ru')
+        self.other = User.objects.create_user(username='Other',
+                                              email='other@other.ru')
+        ingredient = Ingredient.objects.create(name='Сахар',
+                                               measurement_unit='г')
+        self.recipe, self.second = [
+            Recipe.objects.create(
+                author=self.user, name=f'Рецепт {amount}', text='Текст',
+                cooking_time=10, image='images/test.png',
+            ) for amount in (10, 5)
+        ]
+        for recipe, amount in ((self.recipe, 10), (self.second, 5)):
+            RecipeIngredient.objects.create(
+                recipe=recipe, ingredient=ingredient, amount=amount)
+
+    def hammer(self, method, url, data=None):
+        return self.hammer_urls(method, [url] * self.threads, data)
+
+    def hammer_urls(self, method, urls, data=None):
+        barrier = threading.Barrier(len(urls))
+
+        def request(url):
+            client = APIClient()
+            client.force_authenticate(self.user)
+            barrier.wait()
+            try:
+                return getattr(client, method)(
+                    url, data, format='json').status_code
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(len(urls)) as executor:
+            return sorted(executor.map(request, urls))
+
+    def assert_toggled(self, codes, success):
+        assert codes == [success] + [400] * (self.threads - 1), (
+            f'Ровно один запрос должен пройти: {codes}')
+
+    def cart_total(self):
+        return ShoppingCartIngredient.objects.filter(
+            user=self.user).values_list('amount', flat=True).first()
+
+    # Одновременные запросы не приводят к 500, дублям и сбою счётчиков
+    def test_concurrent_favorite_toggle(self):
+        Favorite.objects.create(user=self.other, recipe=self.recipe)
+        url = f'/api/recipes/{self.recipe.id}/favorite/'
+        self.assert_toggled(self.hammer('post', url), 201)
+        assert Favorite.objects.filter(user=self.user).count() == 1, (
+            'Избранное продублировано')
+        self.recipe.refresh_from_db()
+        assert self.recipe.favorites_count == 2
+        self.assert_toggled(self.hammer('delete', url), 204)
+        assert not Favorite.objects.filter(user=self.user).exists(), (
+            'Рецепт остался в избранном')
+        self.recipe.refresh_from_db()
+        assert self.recipe.favorites_count == 1, 'Счётчик избранного сбился'
+
+    # Итоги корзины с другим рецептом меняются ровно один раз
+    def test_concurrent_cart_toggle(self):
+        ShoppingCart.objects.create(user=self.user, recipe=self.second)
+        url = f'/api/recipes/{self.recipe.id}/shopping_cart/'
+        self.assert_toggled(self.hammer('post', url), 201)
+        assert self.cart_total() == 15, 'Итоги корзины сбились'
+        self.assert_toggled(self.hammer('delete', url), 204)
+        assert self.cart_total() == 5, 'Итоги корзины сбились'
+        self.recipe.refresh_from_db()
+        self.second.refresh_from_db()
+        assert (self.recipe.shopping_carts_count,
+                self.second.shopping_carts_count) == (0, 1)
+
+    # Разные рецепты с общим новым ингредиентом добавляются одновременно
+    def test_concurrent_shared_ingredient(self):
+        codes = self.hammer_urls('post', [
+            f'/api/recipes/{recipe.id}/shopping_cart/'
+            for recipe in (self.recipe, self.second)
+        ])
+        assert codes == [201, 201], codes
+        assert self.cart_total() == 15, 'Итоги корзины сбились'
+        codes = self.hammer_urls('delete', [
+            f'/api/recipes/{recipe.id}/shopping_cart/'
+            for recipe in (self.recipe, self.second)
+        ])
+        assert codes == [204, 204], codes
+        assert self.cart_total() is None, 'Итоги корзины сбились'
+
+    # Одновременные отписки уменьшают счётчик подписчиков один раз
+    def test_concurrent_unsubscribe(self):
+        third = User.objects.create_user(username='Third',
+                                         email='third@third.ru')
+        for user in (self.user, third):
+            Subscription.objects.create(user=user, author=self.other)
+        url = f'/api/users/{self.other.id}/subscribe/'
+        self.assert_toggled(self.hammer('delete', url), 204)
+        self.other.refresh_from_db()
+        assert self.other.subscribers_count == 1, (
+            'Счётчик подписчиков сбился')
+
+    # Одинаковые пакетные запросы учитывают каждую строку один раз
+    def test_concurrent_batch(self):
+        url = '/api/recipes/shopping_cart/'
+        data = {'recipes': [self.recipe.id, self.second.id]}
+        assert self.hammer('post', url, data) == [200] * self.threads
+        assert ShoppingCart.objects.count() == 2
+        assert self.cart_total() == 15, 'Итоги корзины сбились'
+        assert set(Recipe.objects.values_list(
+            'shopping_carts_count', flat=True)) == {1}
+        assert self.hammer('delete', url, data) == [200] * self.threads
+        assert self.cart_total() is None, 'Итоги корзины сбились'
+        assert set(Recipe.objects.values_list(
+            'shopping_carts_count', flat=True)) == {0}
+
+
+def make_image_base64(size=(40, 20), image_format='PNG'):
+    buffer = BytesIO()
+    Image.new('RGB', size, (255, 0, 0)).save(buffer, image_format)
+    encoded = b64encode(buffer.getvalue()).decode()
+    return f'data:image/{image_format.lower()};base64,{encoded}'
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), RECIPE_IMAGE_WORKERS=0)
+class RecipeImageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='Stas',
+                                             email='stas@stas.ru')
+        self.authorized_client = APIClient()
+        self.authorized_client.force_authenticate(self.user)
+        self.tag = Tag.objects.create(name='Завтрак', color='#FFFFF1',
+                                      slug='breakfast')
+        self.ingredient = Ingredient.objects.create(name='Сахар',
+                                                    measurement_unit='г')
+
+    def create_recipe(self, image):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.authorized_client.post('/api/recipes/', {
+                'name': 'Рецепт', 'text': 'Текст', 'cooking_time': 10,
+                'tags': [self.tag.id], 'image': image,
+                'ingredients': [{'id': self.ingredient.id, 'amount': 10}],
+            }, format='json')
+
+    # Варианты изображения строятся после сохранения рецепта
+    def test_image_variants(self):
+        response = self.create_recipe(make_image_base64())
+        assert response.status_code == 201, response.json()
+        recipe = Recipe.objects.get()
+        assert set(recipe.image_variants) == set(
+            settings.RECIPE_IMAGE_VARIANTS), 'Варианты изображения не созданы'
+        storage = recipe.image.storage
+        with storage.open(recipe.image_variants['webp']) as file:
+            assert Image.open(file).format == 'WEBP', 'Ожидался WebP'
+        response = self.authorized_client.get(f'/api/recipes/{recipe.id}/')
+        assert set(response.json()['image_variants']) == set(
+            settings.RECIPE_IMAGE_VARIANTS), (
+            'Варианты изображения не возвращаются в API')
+
+    # Слишком большие изображения отклоняются до декодирования
+    def test_image_limits(self):
+        with override_settings(RECIPE_IMAGE_MAX_BYTES=100):
+            response = self.create_recipe(make_image_base64((500, 500)))
+        assert response.status_code == 400, (
+            'Слишком большой файл должен отклоняться')
+        with override_settings(RECIPE_IMAGE_MAX_PIXELS=100):
+            response = self.create_recipe(make_image_base64())
+        assert response.status_code == 400, (
+            'Изображение с большим числом пикселей должно отклоняться')
+        assert not Recipe.objects.exists(), 'Рецепт не должен создаваться'
+
+    # Уменьшенная копия создаётся один раз и кэшируется по хэшу содержимого
+    def test_resized_image(self):
+        response = self.create_recipe(make_image_base64((900, 600)))
+        assert response.status_code == 201, response.json()
+        url = response.json()['image_sizes']['300x300']
+        response = self.client.get(url)
+        assert response.status_code == 200, 'Копия изображения не отдаётся'
+        assert 'immutable' in response['Cache-Control']
+        image = Image.open(BytesIO(b''.join(response.streaming_content)))
+        assert image.size == (300, 200), 'Неверный размер копии'
+        recipe = Recipe.objects.get()
+        storage = recipe.image.storage
+        directory, _, filename = get_resized_image(
+            recipe.image.name, 300, 300).rpartition('/')
+        assert storage.listdir(directory)[1] == [filename], (
+            'Копия должна создаваться один раз')
+        with override_settings(MEDIA_ACCEL_REDIRECT_PREFIX='/media-internal/'):
+            response = self.client.get(url)
+        assert response['X-Accel-Redirect'].startswith(
+            '/media-internal/cache/'), 'Файл должен отдаваться через nginx'
+        assert self.client.get(
+            f'/media/r/123x45/{recipe.image.name}').status_code == 404
+        assert self.client.get(
+            '/media/r/300x300/../../etc/passwd').status_code == 404
+
+    # Одинаковые изображения хранятся одним файлом, пока на него ссылаются
+    @override_settings(MEDIA_ORPHAN_GRACE_PERIOD=0)
+    def test_image_deduplication(self):
+        image = make_image_base64()
+        first = self.create_recipe(image).json()
+        second = self.create_recipe(image).json()
+        recipes = Recipe.objects.in_bulk([first['id'], second['id']])
+        name = recipes[first['id']].image.name
+        assert name == recipes[second['id']].image.name, (
+            'Одинаковые изображения должны храниться одним файлом')
+        storage = recipes[first['id']].image.storage
+        variants = recipes[first['id']].image_variants
+        with self.captureOnCommitCallbacks(execute=True):
+            self.authorized_client.patch(
+                f'/api/recipes/{first["id"]}/', {
+                    'name': 'Рецепт', 'text': 'Текст', 'cooking_time': 10,
+                    'tags': [self.tag.id], 'image': image,
+                    'ingredients': [{'id': self.ingredient.id, 'amount': 10}],
+                }, format='json')
+        recipe = Recipe.objects.get(pk=first['id'])
+        assert (recipe.image.name, recipe.image_variants) == (name, variants)
+        image = make_image_base64((30, 30))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.authorized_client.patch(
+                f'/api/recipes/{first["id"]}/', {
+                    'name': 'Рецепт', 'text': 'Текст', 'cooking_time': 10,
+                    'tags': [self.tag.id], 'image': image,
+                    'ingredients': [{'id': self.ingredient.id, 'amount': 10}],
+                }, format='json')
+        assert Recipe.objects.get(pk=first['id']).image.name != name
+        assert storage.exists(name), 'Файл другого рецепта удалён'
+        resized = get_resized_image(name, 300, 300)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.authorized_client.delete(f'/api/recipes/{second["id"]}/')
+        assert not storage.exists(name), 'Файл без ссылок не удалён'
+        assert not any(
+            storage.exists(variant) for variant in variants.values())
+        assert not storage.exists(resized), 'Уменьшенная копия не удалена'
+
+    # Осиротевшие файлы удаляются, используемые и недавние остаются
+    def test_collect_orphaned_media(self):
+        with override_settings(MEDIA_ROOT=tempfile.mkdtemp()):
+            self.create_recipe(make_image_base64())
+            recipe = Recipe.objects.get()
+            storage = default_storage
+            orphans = [
+                storage.save('images/old.png', ContentFile(b'old')),
+                'images/old.png.thumbnail.jpg',
+            ]
+            storage.save(orphans[1], ContentFile(b'old'))
+            resized = get_resized_image(recipe.image.name, 300, 300)
+            orphans.append(storage.save(
+                f'cache/ab/{"ab" * 32}.300x300.jpg', ContentFile(b'old')))
+            for name in [*orphans, resized]:
+                os.utime(storage.path(name), (0, 0))
+            recent = storage.save('images/recent.png', ContentFile(b'new'))
+            out = StringIO()
+            call_command('collect_orphaned_media', '--dry-run', stdout=out)
+            assert 'осиротевших найдено: 3' in out.getvalue(), out.getvalue()
+            assert all(storage.exists(name) for name in orphans)
+            call_command('collect_orphaned_media', stdout=StringIO())
+            assert not any(storage.exists(name) for name in orphans), (
+                'Осиротевшие файлы не удалены')
+            assert storage.exists(recent), 'Недавний файл удалён'
+            assert storage.exists(recipe.image.name)
+            assert storage.exists(resized), 'Используемая копия удалена'
+            assert all(storage.exists(name)
+                       for name in recipe.image_variants.values())
+
+    # Копии старых изображений без хэша в имени не удаляются, а сами
+    # изображения читаются только при первом запуске
+    def test_collect_orphaned_media_legacy(self):
+        with override_settings(MEDIA_ROOT=tempfile.mkdtemp()):
+            storage = default_storage
+            buffer = BytesIO()
+            Image.new('RGB', (400, 400)).save(buffer, 'PNG')
+            name = storage.save('images/legacy.png',
+                                ContentFile(buffer.getvalue()))
+            Recipe.objects.create(
+                author=self.user, name='Рецепт', text='Текст',
+                cooking_time=10, image=name,
+            )
+            resized = get_resized_image(name, 300, 300)
+            for image in (name, resized):
+                os.utime(storage.path(image), (0, 0))
+            with mock.patch('recipes.images.file_digest',
+                            wraps=images.file_digest) as file_digest:
+                for _ in range(2):
+                    call_command('collect_orphaned_media',
+                                 stdout=StringIO())
+            assert storage.exists(resized), 'Используемая копия удалена'
+            assert file_digest.call_count == 1, file_digest.call_count
+
+
+class RecipeSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='Stas',
+                                             email='stas@stas.ru')
+        self.client = APIClient()
+        recipes = (
+            ('Борщ', 'Свёкла, капуста и картофель'),
+            ('Свекольный салат', 'Нарезать и заправить'),
+            ('Омлет', 'Взбить яйца с молоком'),
+        )
+        self.recipes = {
+            name: Recipe.objects.create(
+                author=self.user, name=name, text=text, cooking_time=10,
+                image='images/test.png',
+            )
+            for name, text in recipes
+        }
+
+    def search(self, term, **params):
+        response = self.client.get('/api/recipes/',
+                                   {'search': term, **params})
+        assert response.status_code == 200, response.json()
+        return [recipe['name'] for recipe in response.json()['results']]
+
+    # Поиск по началу слов в названии и описании, название важнее
+    def test_search(self):
+        assert self.search('свек') == ['Свекольный салат', 'Борщ']
+        assert self.search('яйца омлет') == ['Омлет']
+        assert self.search('КАПУСТА') == ['Борщ']
+        assert self.search('пельмени') == []
+        assert len(self.search('  ')) == 3, 'Пустой запрос не фильтрует'
+        assert self.search('!') == [], 'Запрос без слов ничего не находит'
+        assert self.search('свек', cursor='') == [
+            'Свекольный салат', 'Борщ']
+
+    # Индекс обновляется при изменении и удалении рецепта
+    def test_search_index_updates(self):
+        recipe = self.recipes['Омлет']
+        recipe.name = 'Яичница'
+        recipe.save()
+        assert self.search('омлет') == []
+        assert self.search('яичница') == ['Яичница']
+        recipe.delete()
+        assert self.search('яичница') == []
+
+
+class RecipeTagFilterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='Stas',
+                                             email='stas@stas.ru')
+        self.client = APIClient()
+        self.tags = {
+            slug: Tag.objects.create(name=slug, color=color, slug=slug)
+            for slug, color in (('breakfast', '#000001'),
+                                ('lunch', '#000002'),
+                                ('dinner', '#000003'))
+        }
+        self.recipes = {}
+        for name, slugs in (('Каша', ['breakfast']),
+                            ('Суп', ['lunch', 'dinner']),
+                            ('Салат', ['breakfast', 'lunch', 'dinner'])):
+            recipe = Recipe.objects.create(
+                author=self.user, name=name, text='Текст', cooking_time=10,
+                image='images/test.png',
+            )
+            recipe.tags.set([self.tags[slug] for slug in slugs])
+            self.recipes[name] = recipe
+
+    def filter(self, *slugs, match=None):
+        params = {'tags': slugs}
+        if match:
+            params['tags_match'] = match
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/recipes/', params)
+        assert response.status_code == 200, response.json()
+        assert not any('DISTINCT' in query['sql']
+                       for query in context.captured_queries)
+        return {recipe['name'] for recipe in response.json()['results']}
+
+    def check_filters(self):
+        assert self.filter('breakfast') == {'Каша', 'Салат'}
+        assert self.filter('breakfast', 'dinner') == {'Каша', 'Суп',
+                                                      'Салат'}
+        assert self.filter('lunch', 'dinner', match='all') == {'Суп',
+                                                               'Салат'}
+        assert self.filter('breakfast', 'unknown', match='all') == set()
+        assert self.filter('unknown') == set()
+
+    # Фильтр по тегам «любой из» и «все» через маску тегов
+    def test_tags_filter(self):
+        self.check_filters()
+
+    # Без перечисления масок фильтр проверяет маску побитово
+    def test_tags_filter_bitwise(self):
+        with mock.patch('recipes.tag_masks.MASK_ENUMERATION_LIMIT', 0):
+            self.check_filters()
+
+    # Маска обновляется при изменении тегов рецепта и удалении тега
+    def test_tags_mask_maintained(self):
+        recipe = self.recipes['Каша']
+        recipe.tags.add(self.tags['lunch'])
+        assert self.filter('lunch') == {'Каша', 'Суп', 'Салат'}
+        self.tags['lunch'].delete()
+        recipe.refresh_from_db()
+        assert recipe.tags_mask == 1 << self.tags['breakfast'].bit
+        recipe.tags.clear()
+        assert self.filter('breakfast') == {'Салат'}
+
+
+@override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class BenchCommandTests(TestCase):
+    # Бенчмарк проходит все маршруты и сравнивает результат с базовым
+    def test_bench(self):
+        output = os.path.join(tempfile.mkdtemp(), 'bench.json')
+        options = ['--current-db', '--users', '5', '--recipes', '10',
+                   '--favorites', '10', '--subscriptions', '5',
+                   '--iterations', '2']
+        call_command('bench', *options, '--output', output,
+                     stdout=StringIO())
+        with open(output, encoding='utf-8') as file:
+            report = json.load(file)
+        endpoints = report['endpoints']
+        assert {'recipes-list', 'users-subscriptions',
+                'recipes-download-txt'} <= set(endpoints)
+        for name, result in endpoints.items():
+            assert result['status'] < 400, (name, result)
+            assert result['p95_ms'] >= result['p50_ms'] > 0
+        baseline = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        endpoints['recipes-list']['queries'] -= 1
+        with open(baseline, 'w', encoding='utf-8') as file:
+            json.dump(report, file)
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('bench', *options, '--output', output,
+                         '--baseline', baseline, '--threshold', '100',
+                         stdout=out)
+        assert '- recipes-list: запросов' in out.getvalue(), out.getvalue()
+
+
+class SeedCommandTests(TestCase):
+    # Генератор создаёт согласованные данные с пересчитанными счётчиками
+    def test_seed(self):
+        out = StringIO()
+        call_command('seed', '--users', '20', '--recipes', '50',
+                     '--favorites', '100', '--shopping-carts', '30',
+                     '--subscriptions', '40', '--batch-size', '7',
+                     '--defer-indexes', stdout=out)
+        assert 'строк/с' in out.getvalue()
+        assert User.objects.filter(username__startswith='seed').count() == 20
+        assert Recipe.objects.count() == 50
+        assert Ingredient.objects.exists(), 'Ингредиенты не загружены'
+        assert Favorite.objects.exists() and Subscription.objects.exists()
+        assert not any(reconcile_counters(repair=False).values()), (
+            'Счётчики не пересчитаны')
+        for recipe in Recipe.objects.prefetch_related('tags'):
+            assert recipe.tags_mask == tags_mask(
+                tag.bit for tag in recipe.tags.all())
+        recipe = Recipe.objects.first()
+        response = APIClient().get('/api/recipes/',
+                                   {'search': recipe.name.split()[0]})
+        assert response.json()['count'] > 0, 'Поисковый индекс не построен'
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        self.guest_client = APIClient()
+        Tag.objects.create(name='Завтрак', color='#E26C2D', slug='breakfast')
+        request_metrics.reset()
+
+    # Ответ содержит полное время, время SQL и время рендеринга
+    def test_server_timing(self):
+        response = self.guest_client.get('/api/tags/')
+        timing = response['Server-Timing']
+        for metric in ('app;dur=', 'db;dur=', 'desc="1 queries"',
+                       'render;dur='):
+            assert metric in timing, f'Нет {metric} в Server-Timing: {timing}'
+
+    # Гистограммы группируются по маршруту и действию
+    def test_metrics_endpoint(self):
+        self.guest_client.get('/api/tags/')
+        self.guest_client.get('/api/tags/')
+        self.guest_client.get('/api/recipes/')
+        self.guest_client.get('/api/no-such-route/')
+        response = self.guest_client.get('/api/metrics')
+        assert response.status_code == 200
+        assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+        text = response.content.decode()
+        labels = 'view="Tag-list",action="list",method="GET"'
+        assert f'foodgram_requests_total{{{labels},status="200"}} 2' in text
+        assert f'foodgram_request_queries_bucket{{{labels},le="1"}} 2' in text
+        assert (f'foodgram_request_duration_seconds_count{{{labels}}} 2'
+                in text)
+        assert 'view="Recipe-list",action="list"' in text
+        assert 'view="unmatched",action="",method="GET",status="404"' in text
+
+    @override_settings(REQUEST_METRICS_ENABLED=False)
+    def test_metrics_disabled(self):
+        response = APIClient().get('/api/tags/')
+        assert 'Server-Timing' not in response
+        assert not request_metrics.requests.series
+
+
+class RecipeResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='Stas',
+                                             email='stas@stas.ru')
+        self.token = Token.objects.create(user=self.user)
+        self.tag = Tag.objects.create(name='Завтрак', color='#E26C2D',
+                                      slug='breakfast')
+        self.recipe = Recipe.objects.create(
+            author=self.user, name='Борщ', text='Свёкла', cooking_time=10,
+            image='images/test.png',
+        )
+        self.recipe.tags.set([self.tag])
+        self.guest_client = APIClient()
+
+    # Повторный анонимный запрос отдаётся из кэша без обращений к БД
+    def test_anonymous_responses_cached(self):
+        for url in ('/api/recipes/?tags=breakfast&limit=5',
+                    f'/api/recipes/{self.recipe.pk}/'):
+            first = self.guest_client.get(url)
+            with self.assertNumQueries(0):
+                second = self.guest_client.get(url)
+            assert second.status_code == 200
+            assert second.content == first.content
+            assert second['Content-Type'] == first['Content-Type']
+        # Порядок параметров не важен
+        with self.assertNumQueries(0):
+            self.guest_client.get('/api/recipes/?limit=5&tags=breakfast')
+
+    # Запись рецепта, тега или автора меняет поколение кэша
+    def test_invalidation(self):
+        url = '/api/recipes/'
+        self.guest_client.get(url)
+        self.recipe.name = 'Щи'
+        self.recipe.save()
+        assert self.guest_client.get(url).json()['results'][0]['name'] == (
+            'Щи'), 'Изменение рецепта должно сбрасывать кэш'
+        self.tag.name = 'Обед'
+        self.tag.save()
+        tags = self.guest_client.get(url).json()['results'][0]['tags']
+        assert tags[0]['name'] == 'Обед'
+        self.user.first_name = 'Станислав'
+        self.user.save()
+        author = self.guest_client.get(url).json()['results'][0]['author']
+        assert author['first_name'] == 'Станислав'
+
+    # Запросы с лишними параметрами и фильтрами по спискам пользователя
+    # не кэшируются
+    def test_not_cached(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        for client, url in ((client, '/api/recipes/?is_favorited=1'),
+                            (self.guest_client, '/api/recipes/?_=1')):
+            client.get(url)
+            with CaptureQueriesContext(connection) as queries:
+                client.get(url)
+            assert len(queries) > 0, f'Ответ {url} не должен кэшироваться'
+
+    # Общая страница дополняется списками пользователя
+    @override_settings(TOKEN_CACHE_SINGLE_PROCESS=True)
+    def test_personalized_feed(self):
+        reader = User.objects.create_user(username='reader',
+                                          email='reader@stas.ru')
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=reader)}')
+        author_client = APIClient()
+        author_client.credentials(
+            HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        Favorite.objects.create(user=reader, recipe=self.recipe)
+        Subscription.objects.create(user=reader, author=self.user)
+        url = '/api/recipes/'
+        detail_url = f'/api/recipes/{self.recipe.pk}/'
+
+        def flags(client, url=url):
+            recipe = client.get(url).json()
+            recipe = recipe['results'][0] if 'results' in recipe else recipe
+            return (recipe['is_favorited'], recipe['is_in_shopping_cart'],
+                    recipe['author']['is_subscribed'])
+
+        assert flags(client) == (True, False, True)
+        assert flags(author_client) == (False, False, False)
+        assert flags(client, detail_url) == (True, False, True)
+        # Токен, страница и множества id берутся из кэша
+        with self.assertNumQueries(0):
+            assert flags(client) == (True, False, True)
+        client.post(f'/api/recipes/{self.recipe.pk}/shopping_cart/')
+        client.delete(f'/api/recipes/{self.recipe.pk}/favorite/')
+        assert flags(client) == (False, True, True), (
+            'Изменение списков должно сразу отражаться в ленте')
+        client.delete('/api/recipes/shopping_cart/',
+                      {'recipes': [self.recipe.pk]}, format='json')
+        client.delete(f'/api/users/{self.user.pk}/subscribe/')
+        assert flags(client, detail_url) == (False, False, False)
+        assert flags(author_client) == (False, False, False)
+
+
+# Тесты идут в одном процессе, поэтому поколения в locmem общие.
+@override_settings(TOKEN_CACHE_SINGLE_PROCESS=True)
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='Stas', email='stas@stas.ru', password='Pass-word-42')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        token_cache.reset_stats()
+
+    def me(self):
+        return self.client.get('/api/users/me/').status_code
+
+    # Повторный запрос аутентифицируется без обращения к БД
+    def test_token_cached(self):
+        assert self.me() == 200
+        with CaptureQueriesContext(connection) as queries:
+            assert self.me() == 200
+        assert not any('authtoken_token' in query['sql']
+                       for query in queries.captured_queries), (
+            'Токен должен браться из кэша')
+        assert token_cache.stats['hit'] == 1
+        assert token_cache.stats['miss'] == 1
+        response = self.client.get('/api/metrics')
+        assert ('foodgram_token_cache_lookups_total{result="hit"}'
+                in response.content.decode())
+
+    # Выход удаляет токен, и он сразу перестаёт действовать
+    def test_logout(self):
+        assert self.me() == 200
+        response = self.client.post('/api/auth/token/logout/')
+        assert response.status_code == 204
+        assert self.me() == 401
+
+    # Смена пароля и деактивация сбрасывают запись кэша
+    def test_user_changes(self):
+        assert self.me() == 200
+        response = self.client.post('/api/users/set_password/', {
+            'current_password': 'Pass-word-42',
+            'new_password': 'New-pass-word-42',
+        })
+        assert response.status_code == 204, response.content
+        assert self.me() == 200
+        assert token_cache.stats['miss'] == 2, (
+            'После смены пароля пользователь читается из БД заново')
+        self.user.refresh_from_db()
+        self.user.is_active = False
+        self.user.save()
+        assert self.me() == 401
+
+    @override_settings(TOKEN_CACHE_SHARED=True)
+    def test_shared_tier(self):
+        assert self.me() == 200
+        token_cache.clear()
+        assert self.me() == 200
+        assert token_cache.stats['shared_hit'] == 1
+
+    # С кэшем в памяти процесса и несколькими воркерами токен читается
+    # из БД: смену пароля в другом процессе кэш бы не увидел
+    @override_settings(TOKEN_CACHE_SINGLE_PROCESS=False)
+    def test_process_local_cache(self):
+        assert self.me() == 200
+        with CaptureQueriesContext(connection) as queries:
+            assert self.me() == 200
+        assert any('authtoken_token' in query['sql']
+                   for query in queries.captured_queries), (
+            'Без общего кэша токен должен читаться из БД')
+        assert token_cache.stats['hit'] == 0
+
+
+class AsyncReadUrls:
+    urlpatterns = [path('api/', include(use_async_reads(router.get_urls())))]
+
+
+# Потоки пула асинхронных представлений читают БД своими соединениями,
+# поэтому данные должны быть зафиксированы.
+@override_settings(ROOT_URLCONF=AsyncReadUrls)
+class AsyncReadTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.user = User.objects.create_user(username='Stas',
+                                             email='stas@stas.ru')
+        self.token = Token.objects.create(user=self.user)
+        self.recipe = Recipe.objects.create(
+            author=self.user, name='Рецепт', text='Текст',
+            cooking_time=10, image='images/test.png',
+        )
+
+    def request(self, method, url, authenticated=False):
+        # AsyncClient в Django 4.0 принимает заголовки именами HTTP,
+        # а не ключами META.
+        headers = {}
+        if authenticated:
+            headers['authorization'] = f'Token {self.token.key}'
+
+        async def send():
+            response = await getattr(AsyncClient(), method)(url, **headers)
+            if response.streaming:
+                # ASGIHandler читает потоковый ответ в цикле событий.
+                response.body = b''.join(response.streaming_content)
+            return response
+
+        return async_to_sync(send)()
+
+    # Чтение обслуживается асинхронным представлением с тем же ответом
+    def test_read(self):
+        match = resolve('/api/recipes/', urlconf=AsyncReadUrls)
+        assert asyncio.iscoroutinefunction(match.func)
+        response = self.request('get', '/api/recipes/')
+        assert response.status_code == 200
+        assert 'desc="0 queries"' not in response['Server-Timing'], (
+            'Запросы из пула потоков не учтены в метриках')
+        with override_settings(ROOT_URLCONF='foodgram.urls',
+                               RECIPE_RESPONSE_CACHE_TIMEOUT=0):
+            expected = APIClient().get('/api/recipes/').json()
+        assert response.json() == expected
+        response = self.request('get', '/api/users/me/', authenticated=True)
+        assert response.status_code == 200
+        assert response.json()['username'] == 'Stas'
+
+    # Запись проходит через синхронное представление
+    def test_write(self):
+        url = f'/api/recipes/{self.recipe.id}/favorite/'
+        assert self.request('post', url).status_code == 401
+        response = self.request('post', url, authenticated=True)
+        assert response.status_code == 201
+        assert Favorite.objects.filter(user=self.user).exists()
+        assert 'desc="0 queries"' not in response['Server-Timing'], (
+            'Запросы синхронного представления не учтены в метриках')
+
+    # Выгрузка списка покупок не обращается к БД из цикла событий
+    def test_shopping_list_export(self):
+        ingredient = Ingredient.objects.create(name='Сахар',
+                                               measurement_unit='г')
+        RecipeIngredient.objects.create(recipe=self.recipe,
+                                        ingredient=ingredient, amount=10)
+        ShoppingCart.objects.create(user=self.user, recipe=self.recipe)
+        url = '/api/recipes/download_shopping_cart/'
+        response = self.request('get', url, authenticated=True)
+        assert response.status_code == 200
+        assert response.body.decode() == 'Сахар - 10.0 г\n'
+        response = self.request('get', f'{url}?format=csv',
+                                authenticated=True)
+        assert response.body.decode().splitlines()[1] == 'Сахар,10.0,г'
+
+    # Бенчмарк сравнивает синхронный и асинхронный режимы
+    def test_bench_concurrency(self):
+        output = os.path.join(tempfile.mkdtemp(), 'concurrency.json')
+        call_command('bench_concurrency', '--current-db', '--users', '3',
+                     '--recipes', '5', '--requests', '4', '--concurrency',
+                     '2', '--db-latency', '0', '--output', output,
+                     stdout=StringIO())
+        with open(output, encoding='utf-8') as file:
+            modes = json.load(file)['modes']
+        assert set(modes) == {'wsgi', 'asgi'}
+        for result in modes.values():
+            assert result['errors'] == 0
+            assert result['rps'] > 0
+
+
+class FakeConnection:
+    closed = 0
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTests(TestCase):
+    def make_pool(self, max_size=2, **kwargs):
+        return ConnectionPool(max_size, timeout=0.05, **kwargs)
+
+    # Пул переиспользует соединения и не открывает больше max_size
+    def test_limits(self):
+        pool = self.make_pool()
+        first = pool.acquire(FakeConnection)
+        pool.acquire(FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(FakeConnection)
+        pool.release(first)
+        assert pool.acquire(FakeConnection) is first
+        assert pool.counters['opened'] == 2
+        assert pool.counters['reused'] == 1
+        assert pool.counters['timeout'] == 1
+
+    # Поток без свободного соединения дожидается возврата
+    def test_wait(self):
+        pool = self.make_pool(max_size=1)
+        pool.timeout = 5
+        connection = pool.acquire(FakeConnection)
+        timer = threading.Timer(0.05, pool.release, [connection])
+        timer.start()
+        assert pool.acquire(FakeConnection) is connection
+        timer.join()
+        assert pool.waits[-1] >= 0.05, 'Ожидание не учтено'
+
+    # Сломанные и устаревшие соединения заменяются новыми
+    def test_health_checks(self):
+        broken = set()
+
+        def ping(connection):
+            if connection in broken:
+                raise ConnectionError
+
+        pool = self.make_pool(ping=ping)
+        connection = pool.acquire(FakeConnection)
+        pool.release(connection)
+        broken.add(connection)
+        assert pool.acquire(FakeConnection) is not connection
+        assert connection.closed
+        assert pool.counters['ping_failed'] == 1
+        pool.max_age = 0
+        old = pool.acquire(FakeConnection)
+        pool.release(old)
+        assert pool.acquire(FakeConnection) is not old
+        assert old.closed
+
+        def reset(connection):
+            raise ConnectionError
+
+        pool = self.make_pool(reset=reset)
+        connection = pool.acquire(FakeConnection)
+        pool.release(connection)
+        assert connection.closed and pool.size == 0, (
+            'Соединение, которое не удалось сбросить, осталось в пуле')
+
+    # Закрытие пула закрывает свободные соединения сразу, занятые - при
+    # возврате
+    def test_close(self):
+        pool = self.make_pool()
+        idle, busy = (pool.acquire(FakeConnection),
+                      pool.acquire(FakeConnection))
+        pool.release(idle)
+        pool.close()
+        assert idle.closed and not busy.closed
+        pool.release(busy)
+        assert busy.closed and pool.size == 0
+
+    # Бэкенд PostgreSQL берёт соединения из пула и возвращает их при close()
+    @mock.patch('psycopg2.extras.register_default_jsonb')
+    @mock.patch('django.db.backends.postgresql.base.Database.connect')
+    def test_backend(self, connect, register_jsonb):
+        handler = ConnectionHandler({'default': {
+            'ENGINE': 'foodgram.db.postgresql', 'NAME': 'pooltest',
+            'POOL': {'MAX_SIZE': 1, 'TIMEOUT': 0.05},
+        }})
+        connect.side_effect = lambda **params: mock.MagicMock(closed=0)
+        try:
+            for _ in range(2):
+                wrapper = handler.create_connection('default')
+                wrapper.ensure_connection()
+                wrapper.close()
+            assert connect.call_count == 1, 'Соединение не переиспользовано'
+            raw = wrapper.connection_pool._idle[0][0]
+            cursor = raw.cursor.return_value.__enter__.return_value
+            cursor.execute.assert_any_call('DISCARD ALL')
+            content = self.client.get('/api/metrics').content.decode()
+            assert ('foodgram_db_pool_events_total{alias="default",'
+                    'database="pooltest",event="reused"} 1') in content
+            # Соединение, долго простоявшее у management-команды, перед
+            # запросом проверяется и заменяется
+            wrapper.ensure_connection()
+            wrapper.last_used = 0
+            raw.cursor.side_effect = psycopg2.OperationalError
+            wrapper.ensure_connection()
+            assert connect.call_count == 2
+        finally:
+            close_pools('pooltest')
@@ -1,17 +1,22 @@
+from django.conf import settings
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
+from .async_views import use_async_reads
 from .views import (CustomUserViewSet, IngredientViewSet, RecipeViewSet,
-                    TagViewSet)
+                    TagViewSet, metrics)
 
 router = DefaultRouter()
 router.register('recipes', RecipeViewSet, basename='Recipe')
 router.register('tags', TagViewSet, basename='Tag')
 router.register('ingredients', IngredientViewSet, basename='Ingredient')
 router.register(r'users', CustomUserViewSet, basename='Users')
+if settings.ASYNC_READ_API:
+    use_async_reads(router.urls)
 
 
 urlpatterns = [
+    path('metrics', metrics, name='metrics'),
     path('', include(router.urls)),
     path('', include('djoser.urls')),
     path('auth/', include('djoser.urls.authtoken')),
@@ -1,14 +1,30 @@
-from .models import Recipe, RecipeIngredient
+from django.db import connection, transaction
+
+from .counters import change_counter
+from .models import (CustomUser, Favorite, Recipe, RecipeIngredient,
+                     ShoppingCart, Subscription)
+from .response_cache import invalidate_user_set
+from .shopping_list import (add_to_shopping_totals, bump_cart_version,
+                            bump_recipe_carts_versions, recipes_amounts,
+                            remove_from_shopping_totals,
+                            update_recipe_shopping_totals)
+
+USER_RECIPE_COUNTERS = {
+    Favorite: 'favorites_count',
+    ShoppingCart: 'shopping_carts_count',
+}
 
 
 def create_update_recipe(validated_data, instance=None):
     ingredients = validated_data.pop('ingredients', None)
     tags = validated_data.pop('tags', None)
-    if instance is None:
+    created = instance is None
+    if created:
         instance = Recipe.objects.create(**validated_data)
     if tags is not None:
         instance.tags.set(tags)
     if ingredients is not None:
+        old_amounts = {} if created else recipes_amounts([instance.pk])
         instance.ingredients.clear()
         create_ingredients = [
             RecipeIngredient(
@@ -18,4 +34,151 @@ def create_update_recipe(validated_data, instance=None):
             ) for ingredient in ingredients
         ]
         RecipeIngredient.objects.bulk_create(create_ingredients)
+        if not created:
+            update_recipe_shopping_totals(instance, old_amounts)
+            bump_recipe_carts_versions(instance)
     return instance
+
+
+def user_recipes_added(model, user_id, recipe_ids):
+    change_counter(Recipe, recipe_ids, USER_RECIPE_COUNTERS[model], 1)
+    invalidate_user_set(model, user_id)
+    if model is ShoppingCart:
+        add_to_shopping_totals(user_id, recipe_ids)
+        bump_cart_version(user_id)
+
+
+def user_recipes_removed(model, user_id, recipe_ids):
+    change_counter(Recipe, recipe_ids, USER_RECIPE_COUNTERS[model], -1)
+    invalidate_user_set(model, user_id)
+    if model is ShoppingCart:
+        remove_from_shopping_totals(user_id, recipe_ids)
+        bump_cart_version(user_id)
+
+
+def subscription_removed(user_id, author_id):
+    change_counter(CustomUser, [author_id], 'subscribers_count', -1)
+    invalidate_user_set(Subscription, user_id)
+
+
+def remove_subscription(user_id, author_id):
+    """
+    Удаляет подписку одним DELETE без сигналов. True, если подписку
+    удалил именно этот вызов: счётчик подписчиков уменьшается один раз.
+    """
+    quote = connection.ops.quote_name
+    meta = Subscription._meta
+    user_column = quote(meta.get_field('user').column)
+    author_column = quote(meta.get_field('author').column)
+    with transaction.atomic():
+        deleted = _returned_ids(
+            f'DELETE FROM {quote(meta.db_table)} WHERE {user_column} = %s '
+            f'AND {author_column} = %s RETURNING {author_column}',
+            [user_id, author_id]
+        )
+        if deleted:
+            subscription_removed(user_id, author_id)
+    return bool(deleted)
+
+
+def _user_recipes_sql(model):
+    quote = connection.ops.quote_name
+    return (quote(model._meta.db_table),
+            quote(model._meta.get_field('user').column),
+            quote(model._meta.get_field('recipe').column))
+
+
+def _returned_ids(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return {row[0] for row in cursor.fetchall()}
+
+
+def insert_user_recipes(model, user_id, recipe_ids):
+    """
+    Добавляет связи пользователя с рецептами, которых ещё нет. Возвращает
+    id рецептов, строки которых вставил именно этот вызов: параллельный
+    запрос с теми же id получит пустое множество.
+    """
+    if not recipe_ids:
+        return set()
+    table, user_column, recipe_column = _user_recipes_sql(model)
+    values = ', '.join(['(%s, %s)'] * len(recipe_ids))
+    return _returned_ids(
+        f'INSERT INTO {table} ({user_column}, {recipe_column}) '
+        f'VALUES {values} ON CONFLICT DO NOTHING RETURNING {recipe_column}',
+        [value for pk in recipe_ids for value in (user_id, pk)]
+    )
+
+
+def delete_user_recipes(model, user_id, recipe_ids):
+    """
+    Удаляет связи пользователя с рецептами одним DELETE без сигналов.
+    Возвращает id рецептов, строки которых удалил именно этот вызов.
+    """
+    if not recipe_ids:
+        return set()
+    table, user_column, recipe_column = _user_recipes_sql(model)
+    placeholders = ', '.join(['%s'] * len(recipe_ids))
+    return _returned_ids(
+        f'DELETE FROM {table} WHERE {user_column} = %s '
+        f'AND {recipe_column} IN ({placeholders}) RETURNING {recipe_column}',
+        [user_id, *recipe_ids]
+    )
+
+
+def claim_row(model, pk):
+    """
+    Удаляет строку избранного, корзины или подписки по pk до удаления
+    через ORM. True, если строку удалил именно этот вызов, а не
+    параллельный запрос.
+    """
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    pk_column = quote(model._meta.pk.column)
+    return bool(_returned_ids(
+        f'DELETE FROM {table} WHERE {pk_column} = %s RETURNING {pk_column}',
+        [pk]
+    ))
+
+
+def add_user_recipes(model, user, recipe_ids):
+    """
+    Добавляет рецепты в избранное или корзину пакетом.
+    Возвращает статус для каждого id.
+    """
+    found = set(Recipe.objects.filter(
+        pk__in=recipe_ids).values_list('pk', flat=True))
+    # Вставка идёт первой в транзакции: счётчики и итоги меняются только
+    # для строк, которые добавил этот запрос.
+    with transaction.atomic():
+        added = insert_user_recipes(model, user.pk, found)
+        if added:
+            user_recipes_added(model, user.pk, added)
+    return [
+        {'id': pk, 'status': (
+            'added' if pk in added
+            else 'exists' if pk in found
+            else 'not_found'
+        )} for pk in recipe_ids
+    ]
+
+
+def remove_user_recipes(model, user, recipe_ids):
+    """
+    Удаляет рецепты из избранного или корзины одним DELETE.
+    Возвращает статус для каждого id.
+    """
+    found = set(Recipe.objects.filter(
+        pk__in=recipe_ids).values_list('pk', flat=True))
+    with transaction.atomic():
+        removed = delete_user_recipes(model, user.pk, found)
+        if removed:
+            user_recipes_removed(model, user.pk, removed)
+    return [
+        {'id': pk, 'status': (
+            'removed' if pk in removed
+            else 'not_added' if pk in found
+            else 'not_found'
+        )} for pk in recipe_ids
+    ]
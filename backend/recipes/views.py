@@ -1,8 +1,15 @@
+from django.conf import settings as django_settings
 from django.contrib.auth import get_user_model
-from django.db.models import F, Sum
-from django.http import HttpResponse
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import (FileResponse, Http404, HttpResponse,
+                         StreamingHttpResponse)
+from django.views.decorators.http import require_safe
 from djoser.conf import settings
 from djoser.views import UserViewSet
+from PIL import UnidentifiedImageError
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
@@ -10,16 +17,24 @@ from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 
-from .filters import IngredientSearchFilter, RecipeFilterBackend
+from .authentication import token_cache
+from .filters import (IngredientSearchFilter, RecipeFilterBackend,
+                      RecipeSearchFilter)
+from .images import CONTENT_TYPES, get_resized_image, is_allowed_size
+from .metrics import render_counter, render_pool_metrics, request_metrics
 from .models import (Favorite, Ingredient, Recipe, RecipeIngredient,
                      ShoppingCart, Subscription, Tag)
-from .pagination import LimitPagination
+from .pagination import LimitPagination, RecipePagination
+from .renderers import CSVRenderer, PDFRenderer, PlainTextRenderer
+from .response_cache import RecipeResponseCacheMixin
 from .serializers import (CustomUserSerializer, ExtendedCustomUserSerializer,
-                          FavoriteSerializer, IngredientSerializer,
-                          RecipeCreateUploadSerializer,
-                          RecipeMinifiedSerializer, RecipeSerializer,
-                          ShoppingCartSerializer, SubscribeSerializer,
-                          TagSerializer)
+                          IngredientSerializer, RecipeCreateUploadSerializer,
+                          RecipeIdsSerializer, RecipeMinifiedSerializer,
+                          RecipeSerializer, SubscribeSerializer, TagSerializer)
+from .shopping_list import csv_lines, get_pdf, shopping_list_rows, text_lines
+from .utils import (add_user_recipes, delete_user_recipes, insert_user_recipes,
+                    remove_subscription, remove_user_recipes,
+                    user_recipes_added, user_recipes_removed)
 
 User = get_user_model()
 
@@ -31,7 +46,7 @@ class CustomUserViewSet(UserViewSet):
 
     def get_queryset(self):
         user = self.request.user
-        queryset = self.queryset
+        queryset = self.queryset.add_subscription_annotation(user.id)
         if settings.HIDE_USERS and self.action == "list" and (
                 not user.is_staff and not user.is_anonymous):
             return queryset.filter(pk=user.pk)
@@ -56,12 +71,10 @@ class CustomUserViewSet(UserViewSet):
                 )
             if serializer.is_valid():
                 serializer.save(user=self.request.user, author=user)
+                user.is_subscribed = True
                 return Response(self.get_serializer(user, many=False).data)
         if self.request.method == 'DELETE':
-            obj = Subscription.objects.filter(user=self.request.user,
-                                              author=user)
-            if obj.exists():
-                obj.delete()
+            if remove_subscription(self.request.user.pk, user.pk):
                 return Response(status=status.HTTP_204_NO_CONTENT)
             else:
                 return Response({"errors": "Вы не подписаны на автора"},
@@ -71,9 +84,24 @@ class CustomUserViewSet(UserViewSet):
     @action(detail=False, methods=['get'],
             permission_classes=(IsAuthenticated,))
     def subscriptions(self, request):
+        recipes_limit = request.query_params.get('recipes_limit', '2')
+        if not recipes_limit.isdigit():
+            raise ValidationError(
+                {'recipes_limit': 'Значение должно быть целым числом'},
+                status.HTTP_400_BAD_REQUEST
+            )
+        recipes_limit = int(recipes_limit)
         queryset = User.objects.filter(
-            following__user=self.request.user)
+            following__user=self.request.user
+        ).add_subscription_annotation(self.request.user.id).prefetch_related(
+            Prefetch(
+                'recipes',
+                queryset=Recipe.objects.latest_per_author(recipes_limit),
+                to_attr='latest_recipes'
+            )
+        )
         context = self.get_serializer_context()
+        context['recipes_limit'] = recipes_limit
         page = self.paginate_queryset(queryset.order_by('id'))
         serializer = ExtendedCustomUserSerializer(
             page,
@@ -83,9 +111,9 @@ class CustomUserViewSet(UserViewSet):
         return self.get_paginated_response(serializer.data)
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
-    pagination_class = LimitPagination
-    filter_backends = [RecipeFilterBackend]
+class RecipeViewSet(RecipeResponseCacheMixin, viewsets.ModelViewSet):
+    pagination_class = RecipePagination
+    filter_backends = [RecipeFilterBackend, RecipeSearchFilter]
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
@@ -95,57 +123,71 @@ class RecipeViewSet(viewsets.ModelViewSet):
             return RecipeCreateUploadSerializer
         elif self.action in ('shopping_cart', 'favorite'):
             return RecipeMinifiedSerializer
+        elif self.action in ('shopping_cart_batch', 'favorite_batch'):
+            return RecipeIdsSerializer
         else:
             return RecipeSerializer
 
     def get_permissions(self):
         if self.action in ('create', 'update', 'partial_update'):
             permission_classes = [IsAuthenticated]
-        elif self.action in ('shopping_cart', 'favorite'):
+        elif self.action in ('shopping_cart', 'favorite',
+                             'shopping_cart_batch', 'favorite_batch',
+                             'download_shopping_cart'):
             permission_classes = [IsAuthenticated]
         else:
             permission_classes = [AllowAny]
         return [permission() for permission in permission_classes]
 
     def get_queryset(self):
-        user = self.request.user
-        queryset = Recipe.objects
-        queryset = queryset.add_user_annotations(user.id)
-        return queryset.order_by('-pub_date').all()
+        # Общая страница кэша строится без учёта пользователя.
+        user_id = None if self.shared_page else self.request.user.id
+        queryset = Recipe.objects.select_related('author').prefetch_related(
+            Prefetch(
+                'recipeingredient_set',
+                queryset=RecipeIngredient.objects.select_related('ingredient')
+            ),
+            'tags',
+        )
+        queryset = queryset.add_user_annotations(user_id)
+        return queryset.order_by('-pub_date', '-pk').all()
 
     def shopping_cart_and_favorite(self, request, pk=None):
         recipe = get_object_or_404(Recipe, pk=pk)
-        if self.action in 'shopping_cart':
-            serializer = ShoppingCartSerializer(data=request.data)
-            obj = ShoppingCart.objects.filter(user=self.request.user,
-                                              recipe=recipe)
-        elif self.action in 'favorite':
-            serializer = FavoriteSerializer(data=request.data)
-            obj = Favorite.objects.filter(
-                user=self.request.user, recipe=recipe)
+        if self.action == 'shopping_cart':
+            model = ShoppingCart
+            exists_error = 'Рецепт уже есть в списке покупок'
+            missing_error = 'Вы не добавляли рецепт в список покупок'
+        else:
+            model = Favorite
+            exists_error = 'Рецепт уже есть в избранном'
+            missing_error = 'Вы не добавляли рецепт в избранное'
         if self.request.method == 'POST':
-            if obj.exists():
-                raise ValidationError(
-                    {'errors': 'Рецепт уже есть в списке покупок'},
-                    status.HTTP_400_BAD_REQUEST
-                )
-            if serializer.is_valid():
-                serializer.save(user=self.request.user, recipe=recipe)
-                return Response(RecipeMinifiedSerializer(recipe).data,
-                                status=status.HTTP_201_CREATED)
-            else:
-                raise ValidationError(serializer.errors,
-                                      status.HTTP_400_BAD_REQUEST
-                                      )
-        if self.request.method == 'DELETE':
-            if obj.exists():
-                obj.delete()
-                return Response(status=status.HTTP_204_NO_CONTENT)
-            else:
-                return Response(
-                    {"errors": "Вы не добавляли рецепт в избранное"},
-                    status=status.HTTP_400_BAD_REQUEST)
-        return Response('errors', status=status.HTTP_400_BAD_REQUEST)
+            # Повторное добавление отсекает ON CONFLICT DO NOTHING, а учёт
+            # ведётся только для строки, вставленной этим запросом: ошибки
+            # учёта не выдаются за повторное добавление.
+            with transaction.atomic():
+                added = insert_user_recipes(model, self.request.user.pk,
+                                            [recipe.pk])
+                if added:
+                    user_recipes_added(model, self.request.user.pk, added)
+            if not added:
+                raise ValidationError({'errors': exists_error},
+                                      status.HTTP_400_BAD_REQUEST)
+            return Response(RecipeMinifiedSerializer(recipe).data,
+                            status=status.HTTP_201_CREATED)
+        # QuerySet.delete() шлёт сигналы и для строки, которую уже удалил
+        # параллельный запрос, поэтому учёт ведётся по строке, удалённой
+        # именно этим DELETE.
+        with transaction.atomic():
+            deleted = delete_user_recipes(model, self.request.user.pk,
+                                          [recipe.pk])
+            if deleted:
+                user_recipes_removed(model, self.request.user.pk, deleted)
+        if not deleted:
+            return Response({'errors': missing_error},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=True, methods=['post', 'delete'])
     def favorite(self, request, pk=None):
@@ -155,23 +197,43 @@ class RecipeViewSet(viewsets.ModelViewSet):
     def shopping_cart(self, request, pk=None):
         return self.shopping_cart_and_favorite(request, pk)
 
+    def shopping_cart_and_favorite_batch(self, model):
+        serializer = self.get_serializer(data=self.request.data)
+        serializer.is_valid(raise_exception=True)
+        recipe_ids = serializer.validated_data['recipes']
+        if self.request.method == 'POST':
+            results = add_user_recipes(model, self.request.user, recipe_ids)
+        else:
+            results = remove_user_recipes(
+                model, self.request.user, recipe_ids)
+        return Response({'results': results})
+
+    @action(detail=False, methods=['post', 'delete'], url_path='favorite',
+            url_name='favorite-batch')
+    def favorite_batch(self, request):
+        return self.shopping_cart_and_favorite_batch(Favorite)
+
+    @action(detail=False, methods=['post', 'delete'],
+            url_path='shopping_cart', url_name='shopping-cart-batch')
+    def shopping_cart_batch(self, request):
+        return self.shopping_cart_and_favorite_batch(ShoppingCart)
+
     @action(methods=['get'], detail=False,
-            permission_classes=(IsAuthenticated,))
+            permission_classes=(IsAuthenticated,),
+            renderer_classes=(PlainTextRenderer, CSVRenderer, PDFRenderer))
     def download_shopping_cart(self, request):
-        items = RecipeIngredient.objects.select_related('recipe', 'ingredient')
-        items = items.filter(recipe__shopping_carts__user=request.user)
-        items = items.values(
-            'ingredient__name',
-            'ingredient__measurement_unit').annotate(
-            name=F('ingredient__name'),
-            units=F('ingredient__measurement_unit'),
-            total=Sum('amount')).order_by('-total')
-
-        text = '\n'.join(
-            f"{item['name']} - {item['total']} {item['units']}" for item in
-            items)
-        filename = 'shopping_cart.txt'
-        response = HttpResponse(text, content_type='text/plain')
+        export_format = request.accepted_renderer.format
+        filename = f'shopping_cart.{export_format}'
+        content_type = request.accepted_renderer.media_type
+        if export_format == 'pdf':
+            response = HttpResponse(get_pdf(request.user),
+                                    content_type=content_type)
+        else:
+            rows = shopping_list_rows(request.user)
+            lines = csv_lines(rows) if export_format == 'csv' else (
+                text_lines(rows))
+            response = StreamingHttpResponse(
+                lines, content_type=f'{content_type}; charset=utf-8')
         response['Content-Disposition'] = f'attachment; filename={filename}'
         return response
 
@@ -194,3 +256,43 @@ class IngredientViewSet(viewsets.ModelViewSet):
     search_fields = ['name']
 
     http_method_names = ['get']
+
+
+@require_safe
+def resized_image(request, width, height, path):
+    """
+    Уменьшенная копия изображения из MEDIA_ROOT. Копия создаётся один раз
+    и хранится под именем из хэша содержимого, поэтому ответ можно
+    кэшировать бессрочно. Если задан MEDIA_ACCEL_REDIRECT_PREFIX, сам файл
+    отдаёт nginx.
+    """
+    if not is_allowed_size(width, height):
+        raise Http404('Недопустимый размер изображения.')
+    storage = default_storage
+    try:
+        if not storage.exists(path):
+            raise Http404('Изображение не найдено.')
+        name = get_resized_image(path, width, height)
+    except (SuspiciousFileOperation, UnidentifiedImageError):
+        raise Http404('Изображение не найдено.')
+    content_type = CONTENT_TYPES[name.rsplit('.', 1)[-1]]
+    prefix = django_settings.MEDIA_ACCEL_REDIRECT_PREFIX
+    if prefix:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = f'{prefix}{name}'
+    else:
+        response = FileResponse(storage.open(name), content_type=content_type)
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@require_safe
+def metrics(request):
+    """Метрики этого процесса в текстовом формате Prometheus."""
+    content = request_metrics.render() + render_counter(
+        'foodgram_token_cache_lookups',
+        'Поиск токенов в кэше аутентификации.', 'result',
+        dict(token_cache.stats)
+    ) + render_pool_metrics()
+    return HttpResponse(
+        content, content_type='text/plain; version=0.0.4; charset=utf-8')